@@ -0,0 +1,38 @@
+""" This module keeps an in-process, sorted index of the tarot indices used by the cards
+    of each deck, and across all decks, for finding the next and previous cards without
+    querying the database. The index for a deck is built the first time it is needed and
+    is thrown away by the signal handlers whenever cards change, or when the data generation
+    changes, so that edits made in another process are seen too. """
+
+from models import Card
+from fragments import get_generation
+
+_tarot_indices = {}
+
+# The data generation the index was built in
+_generation = [None]
+
+def get_tarot_indices(deck_id=None):
+    """ Returns the sorted list of distinct tarot indices used by the cards in a deck, or
+        by the cards of all decks if no deck is given. """
+    
+    generation = get_generation()
+    if generation != _generation[0]:
+        invalidate()
+        _generation[0] = generation
+    
+    if deck_id is not None:
+        deck_id = int(deck_id)
+        
+    if deck_id not in _tarot_indices:
+        cards = Card.objects.all()
+        if deck_id is not None:
+            cards = cards.filter(deck=deck_id)
+        _tarot_indices[deck_id] = sorted(set(cards.values_list('tarot_index', flat=True)))
+        
+    return _tarot_indices[deck_id]
+
+def invalidate():
+    """ Throws away the index of every deck, so they are rebuilt on their next use. """
+    
+    _tarot_indices.clear()
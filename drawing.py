@@ -0,0 +1,111 @@
+""" This module keeps an in-process cache of the card, deck and spread ids used when 
+    choosing things at random, so that drawing cards doesn't make the database sort a 
+    whole table on every page load. The lists are built the first time they are needed
+    and are thrown away by the signal handlers whenever cards, decks or spreads change.
+    They are also thrown away when the data generation changes, so that edits made in
+    another process are seen too. """
+
+import random
+from models import Card, Deck, Spread
+from fragments import get_generation
+
+# Chance of each drawn card being reversed
+REVERSAL_CHANCE = 0.3
+
+_card_ids = {}
+_card_keys = []
+_deck_ids = []
+_spread_ids = []
+
+# The data generation the lists were built in
+_generation = [None]
+
+def check_generation():
+    """ Throws away every cached list if the data has been edited since they were built. """
+    
+    generation = get_generation()
+    if generation != _generation[0]:
+        invalidate_decks()
+        invalidate_spreads()
+        _generation[0] = generation
+
+def get_deck_card_ids(deck_id):
+    """ Returns the list of ids of all the cards in a deck. """
+    
+    check_generation()
+    deck_id = int(deck_id)
+    if deck_id not in _card_ids:
+        _card_ids[deck_id] = list(Card.objects.filter(deck=deck_id).values_list('id', flat=True))
+    return _card_ids[deck_id]
+
+def get_card_keys():
+    """ Returns a list of (id, tarot_index, deck_id) tuples for every card in the system,
+        which is enough to link to any card without loading it. """
+    
+    check_generation()
+    if not _card_keys:
+        _card_keys[:] = Card.objects.values_list('id', 'tarot_index', 'deck')
+    return _card_keys
+
+def get_deck_ids():
+    """ Returns the list of ids of all the decks. """
+    
+    check_generation()
+    if not _deck_ids:
+        _deck_ids[:] = Deck.objects.values_list('id', flat=True)
+    return _deck_ids
+    
+def get_spread_ids():
+    """ Returns the list of ids of all the spreads. """
+    
+    check_generation()
+    if not _spread_ids:
+        _spread_ids[:] = Spread.objects.values_list('id', flat=True)
+    return _spread_ids
+
+def invalidate_cards():
+    """ Throws away the cached card lists, so they are rebuilt on their next use. """
+    
+    _card_ids.clear()
+    del _card_keys[:]
+    
+def invalidate_decks():
+    """ Throws away the cached deck list, and the card lists since cards belong to decks. """
+    
+    del _deck_ids[:]
+    invalidate_cards()
+    
+def invalidate_spreads():
+    """ Throws away the cached spread list. """
+    
+    del _spread_ids[:]
+
+def draw_cards(deck_id, count, reversal_chance=REVERSAL_CHANCE, seed=None):
+    """ Draws count different cards at random from a deck, without replacement, and returns
+        them as a list of thrown card dictionaries with the Card object and its reversal 
+        status. Only the drawn cards are loaded, in a single query. Passing the same seed 
+        draws the same cards, for reproducible readings. """
+    
+    generator = random.Random(seed)
+    
+    card_ids = get_deck_card_ids(deck_id)
+    drawn_ids = generator.sample(card_ids, min(count, len(card_ids)))
+    
+    cards = Card.objects.select_related('deck').in_bulk(drawn_ids)
+    
+    # If cards were deleted since the ids were cached, draw others in their place from the
+    # cards the deck has now, so the reading isn't short of cards
+    if len(cards) < len(drawn_ids):
+        _card_ids.pop(int(deck_id), None)
+        card_ids = [card_id for card_id in get_deck_card_ids(deck_id) if card_id not in cards]
+        redrawn_ids = generator.sample(card_ids, min(count - len(cards), len(card_ids)))
+        cards.update(Card.objects.select_related('deck').in_bulk(redrawn_ids))
+        drawn_ids = [card_id for card_id in drawn_ids if card_id in cards] + redrawn_ids
+    
+    # Keep the order of the draw, skipping any card deleted since then
+    reading = []
+    for card_id in drawn_ids:
+        if card_id in cards:
+            reading += [{'card': cards[card_id],
+                         'reversed': generator.random() < reversal_chance}]
+    return reading
@@ -0,0 +1,108 @@
+""" This module is the versioned cache used for the parts of pages which are built from data
+    that only changes when it is edited in the admin: the navigation menus, the deck, suit
+    and spread lists, rendered template fragments and the result counts of the listings.
+    Every key includes the data generation, a counter which the signal handlers bump
+    whenever cards, decks, suits, meanings or spreads are saved or deleted, so stale
+    entries are never used again and simply expire. The generation is stored in the
+    database, with the time of the last change, and kept in the cache, so every process
+    sees the same one with a shared backend like memcached. """
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import urlquote
+from django.db.models.query import QuerySet
+from django.utils.tree import Node
+from models import DataVersion, Deck, Spread, Suit
+
+# How long fragments are kept, in seconds
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'DIYTAROT_FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+VERSION_KEY = 'diytarot:version'
+
+def get_data_version():
+    """ Returns the current data version: a DataVersion, which is kept in the cache and only
+        loaded from the database when it isn't there. """
+    
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = DataVersion.get_current()
+        cache.set(VERSION_KEY, version, FRAGMENT_CACHE_TIMEOUT)
+    return version
+
+def get_generation():
+    """ Returns the current data generation, as a string. It includes the time of the last
+        change, so that it can't collide with an older one if the database is restored. """
+    
+    version = get_data_version()
+    return '%d.%s' % (version.generation, version.modified.strftime('%Y%m%d%H%M%S%f'))
+
+def invalidate():
+    """ Bumps the data generation, so every fragment is rebuilt on next use. """
+    
+    cache.set(VERSION_KEY, DataVersion.bump(), FRAGMENT_CACHE_TIMEOUT)
+
+def make_key(name, vary_on=()):
+    """ Returns the cache key of a fragment in the current generation. The values it varies
+        on are hashed, so the key is always safe for memcached. """
+    
+    args = md5_constructor(u':'.join([urlquote(value) for value in vary_on]))
+    return 'diytarot:fragment:%s:%s:%s' % (get_generation(), name, args.hexdigest())
+
+def get_fragment(name, build, vary_on=()):
+    """ Returns the cached value of a fragment, calling build to make it (and caching the
+        result) if it isn't cached in the current generation. """
+    
+    key = make_key(name, vary_on)
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, FRAGMENT_CACHE_TIMEOUT)
+    return value
+
+def normalize_query(query):
+    """ Returns a string which is the same for equivalent filters, for a Q object or a
+        (lookup, value) pair from one: the children of a Q and the values of an __in lookup
+        are sorted, and values are compared as text, since an option may be an integer or
+        the string it was parsed from. A subquery is compared by its SQL, without running it. """
+    
+    if isinstance(query, Node):
+        children = sorted([normalize_query(child) for child in query.children])
+        return u'%s%s(%s)' % (query.negated and u'NOT ' or u'', query.connector,
+                              u', '.join(children))
+    
+    lookup, value = query
+    if isinstance(value, QuerySet):
+        value = unicode(value.query)
+    elif isinstance(value, (set, frozenset, list, tuple)):
+        value = u','.join(sorted([unicode(item) for item in value]))
+    return u'%s=%s' % (lookup, value)
+
+def get_count(name, queryset, filter_args=None, query_list=()):
+    """ Returns the number of results of a listing's queryset, counting them only once per
+        generation for each set of filters. The filters are the keyword arguments and Q
+        objects built by the apply_*_filter helpers, which the key is made from, so the
+        name has to tell apart the listings whose querysets differ in anything else. """
+    
+    vary_on = [normalize_query(item) for item in (filter_args or {}).items()]
+    vary_on += [normalize_query(query) for query in query_list]
+    return get_fragment('count:' + name, queryset.count, sorted(vary_on))
+
+def get_deck_list():
+    """ Returns the list of decks, as dictionaries with their id and name, ordered by name. """
+    
+    return get_fragment('decks', lambda: list(Deck.objects.values('id', 'name').order_by('name')))
+
+def get_spread_list():
+    """ Returns the list of spreads, as dictionaries with their id and title, ordered by
+        title. """
+    
+    return get_fragment('spreads',
+                        lambda: list(Spread.objects.values('id', 'title').order_by('title')))
+
+def get_suit_list(deck_id):
+    """ Returns the suits of a deck, as dictionaries with their number and name. """
+    
+    return get_fragment('suits', lambda: list(Suit.objects.filter(deck=deck_id)
+                                                          .values('suit', 'name')),
+                        [deck_id])
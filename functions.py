@@ -1,51 +1,114 @@
-from models import Card
-from django.db.models import Max
-from django.db.models import Min
+import base64
+import bisect
+import re
+from models import Card, MajorArcana, MinorArcana, Deck, Meaning, Suit
+from models import Spread, CardPosition
+from drawing import draw_cards, REVERSAL_CHANCE
+from card_index import get_tarot_indices
+from search import matching, count_matching
+from fragments import get_deck_list, get_spread_list
 from django.db.models import Q
-from django.core.paginator import InvalidPage, EmptyPage
+from django.core.paginator import Paginator, InvalidPage, EmptyPage
 
 def get_nearest_indices(tarot_index, deck_id=None):
     """ This is a helper function for finding the indices of the next and previous cards in a deck,
-        by tarot_index. It handles gaps in the set by querying the database, and
-        also automatically loops around when you reach the beginning or end of
-        the sequence of cards. """
+        by tarot_index. It handles gaps in the set by searching the cached, sorted index of 
+        the deck's tarot indices, and also automatically loops around when you reach the 
+        beginning or end of the sequence of cards. """
     
-    before_filter_args = {'tarot_index__lt': tarot_index}
-    after_filter_args = {'tarot_index__gt': tarot_index}
-    if deck_id is not None:
-        before_filter_args['deck'] = deck_id
-        after_filter_args['deck'] = deck_id
+    tarot_index = int(tarot_index)
+    tarot_indices = get_tarot_indices(deck_id)
     
-    # Find the minimum index less than the current tarot_index
-    min_index = Card.objects.filter(**before_filter_args).aggregate(
-                                                Min('tarot_index'))['tarot_index__min'] 
-                                                
-    # Find the maxmimum index less than the curent tarot_index                                            
-    previous_index = Card.objects.filter(**before_filter_args).aggregate(
-                                                Max('tarot_index'))['tarot_index__max']
+    if len(tarot_indices) == 0:
+        return {'next_index': tarot_index,
+                'previous_index': tarot_index}
     
-    # Find the minimum index greater than the current tarot_index                                                                           
-    next_index = Card.objects.filter(**after_filter_args).aggregate(
-                                                Min('tarot_index'))['tarot_index__min']     
+    # Find the first index greater than the current one, and the last index less than it,
+    # wrapping around to the other end of the list if there isn't one.
+    next_position = bisect.bisect_right(tarot_indices, tarot_index)
+    previous_position = bisect.bisect_left(tarot_indices, tarot_index) - 1
+        
+    return {'next_index': tarot_indices[next_position % len(tarot_indices)],
+            'previous_index': tarot_indices[previous_position]}
+    
+def prefetch_meanings(cards):
+    """ Helper function which loads the meanings for a whole list of cards at once and
+        attaches them to the cards, so that the Card helpers used by the templates 
+        (get_keywords, get_predictions, etc.) don't need to run a query per card.
+        Accepts any iterable of Card objects (ideally with the deck already loaded via
+        select_related) or CardSummary objects, and returns them as a list. """
+    
+    cards = list(cards)
+    
+    # Find the meaning set of each card's deck, using the summary or the deck if it was
+    # already loaded and otherwise looking up all the missing decks in a single query.
+    meaning_sets = {}
+    for card in cards:
+        if hasattr(card, 'meaning_set_id'):
+            meaning_sets[card.deck_id] = card.meaning_set_id
+        elif hasattr(card, '_deck_cache'):
+            meaning_sets[card.deck_id] = card.deck.meaning_set_id
+            
+    missing_decks = set(card.deck_id for card in cards) - set(meaning_sets)
+    if len(missing_decks) > 0:
+        meaning_sets.update(Deck.objects.filter(id__in=missing_decks).values_list('id', 'meaning_set'))
+    
+    # Pull every meaning which could match one of the cards, then group them by their
+    # (meaning_set, tarot_index) pair in Python.
+    grouped_meanings = {}
+    if len(cards) > 0:
+        meanings = Meaning.objects.filter(meaning_set__in=set(meaning_sets.values()),
+                                          tarot_index__in=set(card.tarot_index for card in cards))
+        for meaning in meanings:
+            key = (meaning.meaning_set_id, meaning.tarot_index)
+            grouped_meanings.setdefault(key, []).append(meaning)
     
-    # Find the maximum index greater than the current tarot_index                                                                   
-    max_index = Card.objects.filter(**after_filter_args).aggregate(
-                                                Max('tarot_index'))['tarot_index__max'] 
+    for card in cards:
+        key = (meaning_sets.get(card.deck_id), card.tarot_index)
+        card._meaning_cache = grouped_meanings.get(key, [])
+        
+    return cards
+
+def downcast_cards(cards):
+    """ Helper function which replaces plain Card objects with their MajorArcana or 
+        MinorArcana subclass, so that templates get the subclass-specific name (e.g. 
+        "9 of Wands" as opposed to just "9") without trying card.majorarcana and
+        card.minorarcana, which costs a query per card for each of them. The minor arcana
+        are loaded with their suit and deck in one query, and the cards that are left are
+        looked up in the major arcana in a second one. Cards which are already a subclass
+        are kept, and cards found in neither stay plain Cards. Returns the cards as a list
+        in the same order. Call it before attaching anything else to the cards, since the
+        subclass objects are new ones. """
     
-    if max_index is None:
-        max_index = tarot_index
+    cards = list(cards)
+    card_ids = set(card.pk for card in cards if type(card) is Card)
     
-    if min_index is None:
-        min_index = tarot_index
+    subclass_cards = {}
+    if len(card_ids) > 0:
+        subclass_cards.update(MinorArcana.objects.select_related('suit', 'deck').in_bulk(card_ids))
+        card_ids -= set(subclass_cards)
         
-    if previous_index is None:
-        previous_index = max_index
+    if len(card_ids) > 0:
+        subclass_cards.update(MajorArcana.objects.select_related('deck').in_bulk(card_ids))
+    
+    return [subclass_cards.get(card.pk, card) for card in cards]
+
+def attach_suits(decks):
+    """ Helper function which loads the suits for a whole list of decks in a single query
+        and attaches them to the decks, so that Deck.get_suits and Deck.get_suit_names 
+        don't need to run a query per deck. Returns the decks as a list. """
+    
+    decks = list(decks)
+    
+    grouped_suits = dict((deck.id, []) for deck in decks)
+    if len(decks) > 0:
+        for suit in Suit.objects.filter(deck__in=grouped_suits.keys()).order_by('suit'):
+            grouped_suits[suit.deck_id].append(suit)
         
-    if next_index is None:
-        next_index = min_index
+    for deck in decks:
+        deck._suit_cache = grouped_suits[deck.id]
         
-    return {'next_index': next_index,
-            'previous_index': previous_index}
+    return decks
     
 def calculate_layout(positions, max_x_coordinate, max_y_coordinate):
     """ Helper function for the reading view that converts from the logical coordinates for positions
@@ -67,7 +130,7 @@ def calculate_layout(positions, max_x_coordinate, max_y_coordinate):
     # The width as derived from the height and aspect_ratio
     card_width = int(card_height * aspect_ratio)
     thumbnail_string = "%dx%d" % (card_width, card_height)
-
+    
     # Calculate the total height and width containing the thrown cards
     height = ((max_y_coordinate + 1) * (card_height + card_y_padding))
     width = ((max_x_coordinate + 1) * (card_width + card_x_padding))
@@ -89,24 +152,49 @@ def calculate_layout(positions, max_x_coordinate, max_y_coordinate):
                       'thumbnail_string': thumbnail_string},
                       'coordinates': coordinate_list}
 
-def load_saved_reading(reading_string, num_positions, deck_id):
-    """ Helper function for the reading view which attempts to parse out a string encoding 
-        of a particular set of cards, including reversals. If the encoding is invalid 
-        (due to not matching a valid card, having the wrong format, etc) then an
-        exception is thrown with a custom error message. Otherwise it returns a list of
-        thrown card dictionaries with Card objects and reversal status."""
+# Prefix which marks a save string in the compact format. The original format always starts
+# with a digit, so the two can't be confused. The digit is the version of the compact format.
+COMPACT_READING_PREFIX = 'b1'
+
+def encode_reading(reading):
+    """ Helper function which builds the compact save string for a list of thrown card 
+        dictionaries. Each card is packed into a single byte, with the tarot_index in the 
+        top 7 bits and the reversal status in the lowest bit, and the bytes are then 
+        encoded as url-safe base64 without padding. """
     
-    # Format: card0_id.reversed,card1_id.reversed ...
-    saved_card_list = reading_string.split(',')
+    packed = []
+    for thrown_card in reading:
+        tarot_index = thrown_card['card'].tarot_index
+        if tarot_index > 127:
+            raise ValueError('Only tarot indices up to 127 can be saved in the compact format.')
+        packed += [(tarot_index << 1) | int(thrown_card['reversed'])]
     
-    # Check the number of items in the string against the number positions
-    if len( saved_card_list ) != num_positions:
-        raise IndexError('Number of cards in the save string does not match the number of' +
-                                ' positions in the spread.')
-     
-    # Parse each card, raising an exception if there is a problem at any point
-    cards = []
-    for saved_card in saved_card_list:
+    encoded = base64.urlsafe_b64encode(bytes(bytearray(packed))).rstrip('=')
+    return COMPACT_READING_PREFIX + encoded
+
+def parse_reading_string(reading_string):
+    """ Helper function which parses a save string in either the original or the compact
+        format into a list of (tarot_index, reversed) tuples, without looking anything up.
+        Raises an IndexError or ValueError with a custom message if the string is invalid. """
+    
+    if reading_string.startswith(COMPACT_READING_PREFIX):
+        
+        # Put back the padding which was stripped when encoding
+        encoded = reading_string[len(COMPACT_READING_PREFIX):]
+        if not re.match(r'^[A-Za-z0-9_-]*$', encoded):
+            raise ValueError('The compact save string is not valid base64.')
+        
+        encoded = str(encoded) + '=' * (-len(encoded) % 4)
+        try:
+            packed = bytearray(base64.urlsafe_b64decode(encoded))
+        except (TypeError, ValueError):
+            raise ValueError('The compact save string is not valid base64.')
+        
+        return [(value >> 1, bool(value & 1)) for value in packed]
+    
+    # Format: card0_id.reversed,card1_id.reversed ...
+    saved_cards = []
+    for saved_card in reading_string.split(','):
         
         # Separate the card id and the reversal status
         thrown_card = saved_card.split('.')
@@ -127,19 +215,132 @@ def load_saved_reading(reading_string, num_positions, deck_id):
         else:
             raise ValueError('Reversal encoding for a card must be 0 or 1.')
         
-        # Look up the card by id. Note this is the primary key, not the tarot_index.
-        try:
-            card = Card.objects.get(tarot_index=tarot_index, deck=deck_id,)
-        except Card.DoesNotExist:
-            raise Card.DoesNotExist('The save string includes a card that does not exist.')
+        saved_cards += [(tarot_index, reversed)]
         
-        # Save the card and reversal info into a dictionary together    
-        cards += [{'card': card, 
-                   'reversed': reversed} ]
+    return saved_cards
+
+def load_saved_reading(reading_string, num_positions, deck_id):
+    """ Helper function for the reading view which attempts to parse out a string encoding 
+        of a particular set of cards, including reversals, in either the original or the 
+        compact format. If the encoding is invalid (due to not matching a valid card, having
+        the wrong format, etc) then an exception is thrown with a custom error message. 
+        Otherwise it returns a list of thrown card dictionaries with Card objects and 
+        reversal status. The whole string is validated first, and then all the cards are
+        looked up in a single query. """
+    
+    saved_cards = parse_reading_string(reading_string)
+    
+    # Check the number of items in the string against the number positions
+    if len(saved_cards) != num_positions:
+        raise IndexError('Number of cards in the save string does not match the number of' +
+                                ' positions in the spread.')
+    
+    # Look up all the cards by tarot_index at once, then put them back in the saved order
+    tarot_indices = set(tarot_index for tarot_index, reversed in saved_cards)
+    deck_cards = Card.objects.filter(tarot_index__in=tarot_indices, deck=deck_id).select_related('deck')
+    cards_by_index = dict((card.tarot_index, card) for card in deck_cards)
+    
+    missing_indices = sorted(tarot_indices - set(cards_by_index))
+    if len(missing_indices) > 0:
+        raise Card.DoesNotExist('The save string includes cards that do not exist: %s.' % 
+                                ', '.join([str(index) for index in missing_indices]))
+    
+    # Save the card and reversal info into a dictionary together
+    cards = []
+    for tarot_index, reversed in saved_cards:
+        cards += [{'card': cards_by_index[tarot_index], 
+                   'reversed': reversed}]
          
-    return cards;
+    return cards
 
 
+def assemble_reading(spread_id, deck_id, session_deck_id, reading_string=None, 
+                     reversal_chance=REVERSAL_CHANCE, seed=None):
+    """ Helper function for the reading view which loads everything needed to display a
+        reading with a small, fixed number of queries: the spread, the navigation lists,
+        the positions (counted and measured in Python) and the thrown cards with their
+        meanings. The deck and the session's preferred deck are looked up in the deck 
+        list that is loaded for navigation anyway.
+        
+        If reading_string is given the saved reading is loaded instead of a random one,
+        and if it can't be parsed the returned context only contains an error message.
+        Otherwise the cards are drawn with the given reversal chance, and seed can be
+        used to get the same draw every time.
+        Raises Spread.DoesNotExist or Deck.DoesNotExist if either doesn't exist. """
+    
+    spread = Spread.objects.get(pk=spread_id)
+    
+    # Lists for use in the navigation menu, also used to look up the decks by id
+    deck_list = get_deck_list()
+    spread_list = get_spread_list()
+    deck_names = dict((deck['id'], deck['name']) for deck in deck_list)
+    
+    try:
+        deck_name = deck_names[int(deck_id)]
+    except (KeyError, ValueError):
+        raise Deck.DoesNotExist('Deck %s does not exist.' % deck_id)
+    
+    # Get all the positions in the spread in one go and pull out the maximums for layout
+    positions = list(CardPosition.objects.filter(spread=spread.id).order_by('index'))
+    num_positions = len(positions)
+    max_x_coordinate = max([position.x_coordinate for position in positions] or [0])
+    max_y_coordinate = max([position.y_coordinate for position in positions] or [0])
+    
+    # Get all of the layout information for the template to use later
+    layout = calculate_layout(positions, max_x_coordinate, max_y_coordinate)
+    
+    if reading_string is not None:
+        try:
+            # Try to parse out the saved reading encoding, and catch the exceptions.
+            reading = load_saved_reading(reading_string, num_positions, deck_id)
+        
+        except (IndexError, TypeError, ValueError, Card.DoesNotExist):
+            # Exceptions with custom messages are raised in the helper function,
+            # then they are caught and their text is passed to the template for display
+            return {'error': 'Problem loading saved reading.',
+                    'spread': spread,
+                    'deck': {'id': int(deck_id), 'name': deck_name}}
+    else:
+        # Otherwise, create a random reading that is different every time the page is loaded,
+        # drawing as many cards from the deck as there are positions in the spread.
+        reading = draw_cards(deck_id, num_positions, reversal_chance, seed)
+            
+    # Swap in the subclass of every thrown card for its name, then load the meanings of all
+    # of them at once, for the predictions and keywords
+    cards = downcast_cards([thrown_card['card'] for thrown_card in reading])
+    for thrown_card, card in zip(reading, cards):
+        thrown_card['card'] = card
+    prefetch_meanings(cards)
+    
+    # Put together the card object, position object, layout coordinates for display in the template
+    # and generate a save string for the thrown cards.
+    card_list = []
+    for (thrown_card, position, coordinates) in zip(reading, positions, layout['coordinates']):
+        card_list += [(position, thrown_card, coordinates)]
+    
+    # Build the string to re-create this reading.  
+    save_string = encode_reading(reading)
+    
+    # If the preferred deck has gone missing, treat the displayed deck as the preferred one
+    deck_options = {}
+    try:
+        deck_options['session_deck_name'] = deck_names[int(session_deck_id)]
+        deck_options['session_deck_id'] = session_deck_id
+    except (KeyError, ValueError):
+        deck_options['session_deck_name'] = deck_name
+        deck_options['session_deck_id'] = deck_id
+    
+    deck_options['display_deck_id'] = deck_id
+    deck_options['display_deck_name'] = deck_name
+    
+    return {'spread': spread,
+            'card_list': card_list,
+            'save_string': save_string,
+            'layout': layout['sizes'],
+            'deck_options': deck_options,
+            'deck_list': deck_list,
+            'spread_list': spread_list}
+
 def validate_integer(input_dict, key):
     """ If the key is present in input_dict and is not an integer, remove it. Return
         True if the key is in the dictionary and an integer, and false otherwise. """
@@ -158,7 +359,7 @@ def validate_string(input_dict, key, allowed_values):
     """ If the key is present in input_dict but is not equal to one of the items in the
         allowed_values list, then remove it. Return True if the key is in the dictionary
         and one of the allowed_values, otherwise False. """
-
+    
     if (key in input_dict and 
         input_dict[key] in allowed_values):
         return True
@@ -182,7 +383,7 @@ def apply_string_option_filter(active_options, keyword_args, option_name, option
     """ This is a helper function for options which use pre-definied set of allowed string
     inputs (e.g., radio buttons, not a search box), which correspond individual ways to affect
     the QuerySet.
-
+        
         Inputs:
         display_options: a QueryDict of input parameters used to look up options
         keyword_args: keyword argument dictionary used to affect the QuerySet (via filter, order_by, etc.)
@@ -192,7 +393,7 @@ def apply_string_option_filter(active_options, keyword_args, option_name, option
                         Example: {"majors": {'tarot_index__lt': 22},
                                   "minors": {'tarot_index__gt': 21}}
    """                     
-
+    
     # Validate the string, removing from dispaly_options if input was invalid
     if validate_string(active_options, option_name, option_values):
         
@@ -236,7 +437,7 @@ def apply_rank_filter(active_options, filter_args):
     
     if ('cards' in active_options and
         active_options['cards'] == 'minors'):
-
+        
         option_name = 'ranks'
         option_values = {'acefive': {'rank__lte': 5},
                          'fiveten': {'rank__lte': 10, 
@@ -246,37 +447,33 @@ def apply_rank_filter(active_options, filter_args):
         apply_string_option_filter(active_options, filter_args, option_name, option_values)
     
         
-def apply_sorting_order(active_options, order_args):
+def apply_sorting_order(active_options, order_args, relevance=False):
     """ This is a helper function for sorting the cards in a query. Since sorting order is less
-        complex than filtering, order_args is a list of fields to sort on."""
+        complex than filtering, order_args is a list of fields to sort on. If relevance is
+        set and there is a search, the cards can also be sorted by their relevance to the
+        search (the 'relevance' column added by search.rank), which is then the default."""
     
     option_name = 'order_by'
     option_values = {'rank': ['rank', 'suit__suit'],
                      'suit': ['tarot_index', 'deck']}
     
-    # Default sorting order is by tarot_index
+    # Default sorting order is by tarot_index, or by relevance for searches
+    default_value = 'suit'
+    if relevance and len(active_options.get('search', '')) > 0:
+        option_values['relevance'] = ['-relevance', 'tarot_index', 'deck']
+        default_value = 'relevance'
+    
     if not validate_string(active_options, option_name, option_values):
-        active_options[option_name] = 'suit'
+        active_options[option_name] = default_value
         
     selected_option = active_options[option_name]
     order_args += option_values[selected_option]
 
-def apply_keyword_search_filter(active_options, query_list):
-  option_name = 'search'
-  
-  if option_name in active_options:
-    search_term = active_options[option_name]
-    
-    # Any value is valid except nothing
-    if len(search_term) > 0:
-        # OR together Q objects for all the fields to search, since a match on any of them is ok.
-        search_query = [Q(keywords__icontains=search_term)]
-        
-        query_list += search_query
-    
 def apply_card_search_filter(active_options, query_list):
-  """ This is a helper function for searching cards. It only checks the title, caption, and
-      description fields, and it uses Q's in order to giving OR'ing behavior. """
+  """ This is a helper function for searching cards. It looks the search up in the full-text
+      index of the cards, which covers the title, caption and description of the cards as
+      well as their meanings (in the meaning set of their deck), and matches the cards
+      containing every word of the search. """
       
   option_name = 'search'
   if option_name in active_options:
@@ -284,20 +481,16 @@ def apply_card_search_filter(active_options, query_list):
     
     # Any value is valid except nothing
     if len(search_term) > 0:
-        # OR together Q objects for all the fields to search, since a match on any of them is ok.
-        search_query = [Q(title__icontains=search_term) |
-                        Q(caption__icontains=search_term) |
-                        Q(description__icontains=search_term)]
+        search_query = [Q(pk__in=matching('cards', search_term))]
         
         query_list += search_query
         
 
 def apply_spread_search_filter(active_options, query_list):
-    """ This is a helper function for searching Spreads. Since it is a search
-        action, it operates around Q's which are OR'd together, rather than
-        using keyword arguments. It takes a QueryDict of all the currently
-        active options, and a list of Q objects which it will add to if
-        the search option is activated. """
+    """ This is a helper function for searching Spreads. It takes a QueryDict of all the 
+        currently active options, and a list of Q objects which it will add to if the 
+        search option is activated. The search is looked up in the full-text index of 
+        the spreads' titles and descriptions. """
     
     option_name = 'search'
     if option_name in active_options:
@@ -306,12 +499,8 @@ def apply_spread_search_filter(active_options, query_list):
         # Since this is a search filter, any value is valid except for a blank.
         if len(search_term) > 0:
             
-            # OR together the Q objects for each field we want to search
-            search_query = [Q(title__icontains=search_term) |
-                            Q(description__icontains=search_term)]
-            
             # Append this query to the list so that the overal query will be AND'd together.
-            query_list += search_query
+            query_list += [Q(id__in=matching('spreads', search_term))]
             
 def apply_spread_size_filter(active_options, query_list):
     """ This is a helper function for filtering spreads by the number of
@@ -331,6 +520,29 @@ def apply_spread_size_filter(active_options, query_list):
         # Stick the dictionary of filter argument into the Q objects as keyword arguments
         query_list += [Q(**option_values[selected_value])]
 
+def count_spread_tags(tags):
+    """ This is a helper function for the spread list facets, which counts how many spreads
+        each of the given tags finds when searched for, from the search index, so that the
+        counts match the results of the facet links. The tags are all counted in a single
+        grouped query. Returns a dictionary of counts keyed by tag. """
+    
+    return count_matching('spreads', tags)
+    
+class CountedPaginator(Paginator):
+    """ Paginator which gets its count from a function (e.g. a cached count from
+        fragments.get_count) instead of counting the object list. """
+    
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 count=None):
+        Paginator.__init__(self, object_list, per_page, orphans, allow_empty_first_page)
+        self._count_function = count
+        
+    def _get_count(self):
+        if self._count is None and self._count_function is not None:
+            self._count = self._count_function()
+        return Paginator._get_count(self)
+    count = property(_get_count)
+    
 def get_current_page(active_options, pages):
     """ This is a function to separate the logic for fetching the current page from
         the current display options, checking if it is valid based on the underlying
@@ -356,4 +568,16 @@ def get_current_page(active_options, pages):
         
     return current_page
     
-        
+def get_keyset_page(active_options, pages):
+    """ This is the counterpart of get_current_page for the lists paginated by keyset. It
+        fetches the page for the cursor in the page option, or the first page if there is no
+        cursor or it is invalid (e.g. an old page number), in which case the option is
+        removed. Accepts an active_options dictionary of all currently active display
+        options and a KeysetPaginator. """
+    
+    try:
+        return pages.page(active_options.get('page'))
+    except ValueError:
+        if 'page' in active_options:
+            del active_options['page']
+        return pages.page()
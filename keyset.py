@@ -0,0 +1,261 @@
+""" This module paginates the long listings (the card catalog and the spread list) by keyset
+    instead of by page number. Each page is fetched by filtering on the sort keys of the
+    last row of the previous page (or the first row of the next one), so it costs the same
+    at any depth, where LIMIT/OFFSET has to skip every row before the page.
+    
+    The position is kept in the 'page' parameter of the query string as an opaque cursor,
+    so the filter links which drop the page with remove_and_reencode go back to the first
+    page just like before. The total count is optional: it is only counted if the page
+    asks for it, and a cheaper (cached or approximate) count can be passed instead.
+    
+    Sort keys may be NULL (e.g. the rank and suit of the major arcana). The seek filters
+    put NULLs where the database sorts them, since they never match a comparison. """
+
+import base64
+import json
+import operator
+import re
+from django.db import connection
+from django.db.models import Model, Q
+from django.db.models.fields import FieldDoesNotExist
+
+# Directions of a cursor: the page starts after, or ends before, the row it points to
+AFTER = 'a'
+BEFORE = 'b'
+
+# Databases which sort NULLs after every value in ascending order, instead of before
+NULLS_LAST_VENDORS = ('postgresql', 'oracle')
+
+def encode_cursor(direction, values):
+    """ Builds the cursor pointing after or before a row with the given key values, as
+        url-safe base64 without padding. """
+    
+    return base64.urlsafe_b64encode(json.dumps([direction] + list(values))).rstrip('=')
+
+def decode_cursor(cursor, key_count):
+    """ Parses a cursor into a (direction, values) pair. Raises a ValueError if the cursor
+        is invalid or doesn't have one value per key. """
+    
+    cursor = unicode(cursor)
+    if not re.match(r'^[A-Za-z0-9_-]+$', cursor):
+        raise ValueError('The cursor is not valid base64.')
+    
+    # Put back the padding which was stripped when encoding
+    encoded = str(cursor) + '=' * (-len(cursor) % 4)
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(encoded))
+    except (TypeError, ValueError):
+        raise ValueError('The cursor is not valid.')
+    
+    if (not isinstance(decoded, list) or len(decoded) != key_count + 1 or
+        decoded[0] not in (AFTER, BEFORE)):
+        raise ValueError('The cursor does not match the sort order.')
+    
+    # Only plain values (or NULL) can be compared with the keys
+    for value in decoded[1:]:
+        if value is None:
+            continue
+        if not isinstance(value, (int, long, float, basestring)) or isinstance(value, bool):
+            raise ValueError('The cursor does not match the sort order.')
+    
+    return decoded[0], decoded[1:]
+
+def get_key_value(obj, key):
+    """ Returns the value of a sort key (e.g. 'rank', 'deck' or 'suit__suit') for an object,
+        following the relations in it. Related objects are compared by primary key, which
+        is read from the foreign key column when the key ends on one, without loading them.
+        The value is None if a relation on the way is empty. """
+    
+    names = key.lstrip('-').split('__')
+    value = obj
+    for name in names[:-1]:
+        value = getattr(value, name)
+        if value is None:
+            return None
+    
+    try:
+        value = getattr(value, value._meta.get_field(names[-1]).attname)
+    except FieldDoesNotExist:
+        value = getattr(value, names[-1])
+    
+    if isinstance(value, Model):
+        value = value.pk
+    return value
+
+def is_nullable(model, key):
+    """ Tells whether a sort key of a model can be NULL, because its field or a relation on
+        the way to it is nullable. Keys which aren't fields (e.g. extra selects) may be. """
+    
+    opts = model._meta
+    for name in key.lstrip('-').split('__'):
+        if name == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return True
+        if field.null:
+            return True
+        if field.rel is not None:
+            opts = field.rel.to._meta
+    return False
+
+def equal_query(field, value):
+    """ Builds the Q object selecting the rows whose key is equal to a value, or is NULL. """
+    
+    if value is None:
+        return Q(**{field + '__isnull': True})
+    return Q(**{field: value})
+
+def past_query(field, value, greater, nullable):
+    """ Builds the Q object selecting the rows whose key sorts after a value (or before it
+        if greater is False) in ascending order, with NULLs where the database sorts them.
+        Returns None if no row can. """
+    
+    nulls_last = connection.vendor in NULLS_LAST_VENDORS
+    if value is None:
+        # Every value is past NULL on the side where the values are, and nothing on the other
+        if greater != nulls_last:
+            return Q(**{field + '__isnull': False})
+        return None
+    
+    query = Q(**{field + (greater and '__gt' or '__lt'): value})
+    if nullable and greater == nulls_last:
+        query = query | Q(**{field + '__isnull': True})
+    return query
+
+def seek_query(model, keys, values, direction):
+    """ Builds the Q object selecting the rows of a model after (or before) the row with the
+        given key values in the order of the keys: the first key is past its value, or it's
+        equal and the second one is past its value, and so on. Keys starting with '-' are
+        descending, and keys which may be NULL are compared the way the database sorts them. """
+    
+    queries = []
+    for i, key in enumerate(keys):
+        field = key.lstrip('-')
+        greater = (direction == AFTER) != key.startswith('-')
+        query = past_query(field, values[i], greater, is_nullable(model, field))
+        if query is None:
+            continue
+        
+        for previous, value in zip(keys[:i], values[:i]):
+            query = query & equal_query(previous.lstrip('-'), value)
+        queries.append(query)
+    
+    # Nothing is past the row if every key is NULL on the wrong side
+    if len(queries) == 0:
+        return Q(pk__isnull=True)
+    return reduce(operator.or_, queries)
+
+def reverse_key(key):
+    """ Returns the key sorted the other way. """
+    
+    if key.startswith('-'):
+        return key[1:]
+    return '-' + key
+
+class KeysetPaginator(object):
+    """ Paginator over a queryset sorted by the given keys, with pages fetched from a cursor
+        rather than a page number. The primary key is added as the last key if it isn't
+        there, so the order is total and no row is skipped or repeated between pages.
+        
+        count is the total number of rows to show, or a function returning it (e.g. from a
+        cache). It defaults to counting the queryset, which only happens if the count is
+        used. """
+    
+    def __init__(self, queryset, per_page, keys, count=None):
+        self.keys = list(keys)
+        if 'pk' not in self.keys and '-pk' not in self.keys:
+            self.keys += ['pk']
+        
+        self.queryset = queryset.order_by(*self.keys)
+        self.per_page = per_page
+        self._count = count
+    
+    def _get_count(self):
+        if self._count is None:
+            self._count = self.queryset.count()
+        elif callable(self._count):
+            self._count = self._count()
+        return self._count
+    count = property(_get_count)
+    
+    def get_cursor(self, obj, direction):
+        """ Returns the cursor of the page starting after, or ending before, an object. """
+        
+        return encode_cursor(direction, [get_key_value(obj, key) for key in self.keys])
+    
+    def page(self, cursor=None):
+        """ Returns the page for a cursor, or the first page if there is none. Raises a
+            ValueError if the cursor is invalid. """
+        
+        if not cursor:
+            object_list = list(self.queryset[:self.per_page + 1])
+            return KeysetPage(object_list[:self.per_page], self,
+                              has_previous=False, has_next=len(object_list) > self.per_page)
+        
+        direction, values = decode_cursor(cursor, len(self.keys))
+        
+        if direction == AFTER:
+            queryset = self.queryset.filter(seek_query(self.queryset.model, self.keys, values, AFTER))
+            object_list = list(queryset[:self.per_page + 1])
+            
+            # If the rows after the cursor have been deleted since, show the last page
+            if len(object_list) == 0:
+                return self.last_page()
+            return KeysetPage(object_list[:self.per_page], self,
+                              has_previous=True, has_next=len(object_list) > self.per_page)
+        
+        queryset = self.queryset.filter(seek_query(self.queryset.model, self.keys, values, BEFORE))
+        return self._page_backwards(queryset, has_next=True)
+    
+    def last_page(self):
+        """ Returns the last page. """
+        
+        return self._page_backwards(self.queryset, has_next=False)
+    
+    def _page_backwards(self, queryset, has_next):
+        """ Returns the page at the end of a queryset, which is fetched backwards and put
+            back in order. """
+        
+        queryset = queryset.order_by(*[reverse_key(key) for key in self.keys])
+        object_list = list(queryset[:self.per_page + 1])
+        page_list = object_list[:self.per_page]
+        page_list.reverse()
+        return KeysetPage(page_list, self,
+                          has_previous=len(object_list) > self.per_page, has_next=has_next)
+
+class KeysetPage(object):
+    """ A page of a KeysetPaginator, with the cursors of the pages before and after it. """
+    
+    def __init__(self, object_list, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_previous = has_previous and len(object_list) > 0
+        self._has_next = has_next and len(object_list) > 0
+    
+    def __repr__(self):
+        return '<Page of %d>' % len(self.object_list)
+    
+    def __len__(self):
+        return len(self.object_list)
+    
+    def has_previous(self):
+        return self._has_previous
+    
+    def has_next(self):
+        return self._has_next
+    
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+    
+    def previous_cursor(self):
+        if not self.has_previous():
+            return None
+        return self.paginator.get_cursor(self.object_list[0], BEFORE)
+    
+    def next_cursor(self):
+        if not self.has_next():
+            return None
+        return self.paginator.get_cursor(self.object_list[-1], AFTER)
@@ -0,0 +1,137 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.backends.util import truncate_name
+from diyTarot.models import Meaning, Card, Suit, CardPosition
+
+# The unique pairs of columns declared with unique_together, and the indexed columns
+UNIQUE_TOGETHER = [Meaning, Card, Suit, CardPosition]
+INDEXED_FIELDS = [(Card, 'tarot_index')]
+
+# Queries finding an index by name, for each database vendor
+INDEX_QUERIES = {
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND name = %s",
+    'postgresql': 'SELECT indexname FROM pg_indexes WHERE indexname = %s',
+    'mysql': 'SELECT index_name FROM information_schema.statistics '
+             'WHERE table_schema = DATABASE() AND index_name = %s',
+}
+
+def get_index_name(name):
+    """ Returns an index name, shortened for the database if needed. """
+    
+    return truncate_name(name, connection.ops.max_name_length())
+
+def get_indexes():
+    """ Returns the indexes to create, as (index name, model, columns, unique) tuples. The
+        names of the single column indexes are the ones syncdb gives them. """
+    
+    indexes = []
+    for model in UNIQUE_TOGETHER:
+        table = model._meta.db_table
+        for fields in model._meta.unique_together:
+            columns = [model._meta.get_field(field).column for field in fields]
+            indexes.append((get_index_name('%s_%s_uniq' % (table, '_'.join(columns))),
+                            model, columns, True))
+    
+    for model, field in INDEXED_FIELDS:
+        table = model._meta.db_table
+        column = model._meta.get_field(field).column
+        indexes.append((get_index_name('%s_%s' % (table, connection.creation._digest(column))),
+                        model, [column], False))
+    
+    return indexes
+
+def get_create_statement(name, model, columns, unique):
+    """ Returns the statement creating an index. """
+    
+    quote_name = connection.ops.quote_name
+    return '%s %s ON %s (%s)' % (unique and 'CREATE UNIQUE INDEX' or 'CREATE INDEX',
+                                 quote_name(name), quote_name(model._meta.db_table),
+                                 ', '.join([quote_name(column) for column in columns]))
+
+def strip_lookup_constraints():
+    """ Takes the unique pairs and the indexed columns off the models, so that their tables
+        are created as they were before the constraints were declared (e.g. to benchmark
+        the lookups without them). Returns a function which puts them back. """
+    
+    saved = []
+    for model in UNIQUE_TOGETHER:
+        saved.append((model._meta, 'unique_together', model._meta.unique_together))
+        model._meta.unique_together = ()
+    for model, field in INDEXED_FIELDS:
+        field = model._meta.get_field(field)
+        saved.append((field, 'db_index', field.db_index))
+        field.db_index = False
+    
+    def restore():
+        for obj, name, value in saved:
+            setattr(obj, name, value)
+    return restore
+
+def find_duplicates(model, columns):
+    """ Returns the values of the columns which more than one row of a model's table has,
+        with the number of rows, as a list of tuples. """
+    
+    quote_name = connection.ops.quote_name
+    columns = ', '.join([quote_name(column) for column in columns])
+    
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, COUNT(*) FROM %s GROUP BY %s HAVING COUNT(*) > 1' % (
+                        columns, quote_name(model._meta.db_table), columns))
+    return cursor.fetchall()
+
+class Command(BaseCommand):
+    """ Adds the unique constraints and indexes of the tarot_index lookups to a database
+        created before they were declared in the models, since syncdb doesn't change
+        existing tables. The constraints are added as unique indexes. Every pair of columns
+        is checked for duplicates first, and nothing is changed if there are any, so they
+        can be cleaned up in the admin before running the command again. Indexes which
+        already exist are skipped. Databases created by syncdb since then already have the
+        constraints, and don't need it. """
+    
+    help = 'Adds the unique constraints and indexes of the tarot_index lookups.'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--sql', action='store_true', default=False,
+                    help='Print the statements instead of running them.'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        indexes = get_indexes()
+        
+        # Check every unique pair before adding any constraint
+        duplicate_count = 0
+        for name, model, columns, unique in indexes:
+            if not unique:
+                continue
+            for row in find_duplicates(model, columns):
+                duplicate_count += 1
+                self.stderr.write('%d rows of %s have %s\n' % (
+                                        row[-1], model._meta.db_table,
+                                        ', '.join(['%s = %s' % (column, value)
+                                                   for column, value in zip(columns, row)])))
+        if duplicate_count > 0:
+            raise CommandError('Found %d duplicates, remove them and run the command again. '
+                               'Nothing was changed.' % duplicate_count)
+        
+        if options['sql']:
+            for index in indexes:
+                self.stdout.write(get_create_statement(*index) + ';\n')
+            return
+        
+        if connection.vendor not in INDEX_QUERIES:
+            raise CommandError("Can't tell which indexes exist on %s, use --sql to print the "
+                               "statements and run them by hand." % connection.vendor)
+        
+        cursor = connection.cursor()
+        for index in indexes:
+            name = index[0]
+            cursor.execute(INDEX_QUERIES[connection.vendor], [name])
+            if cursor.fetchone() is not None:
+                self.stdout.write('%s already exists.\n' % name)
+                continue
+            
+            cursor.execute(get_create_statement(*index))
+            transaction.commit_unless_managed()
+            self.stdout.write('Created %s.\n' % name)
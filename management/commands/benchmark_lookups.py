@@ -0,0 +1,159 @@
+import random
+import time
+from optparse import make_option
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from diyTarot.models import MeaningSet, Meaning, Deck, Suit, Card, Spread, CardPosition
+from diyTarot.management.commands.add_lookup_constraints import strip_lookup_constraints
+
+def insert_rows(model, columns, rows):
+    """ Inserts many rows into a model's table at once, which is much faster than saving
+        each object when building a large dataset. """
+    
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                            connection.ops.quote_name(model._meta.db_table),
+                            ', '.join([connection.ops.quote_name(column) for column in columns]),
+                            ', '.join(['%s'] * len(columns))), rows)
+
+def get_lookups(deck_count, meaning_set_count, spread_count):
+    """ Returns the lookups made by the views, as (name, function) pairs, where the function
+        returns a queryset for random parameters. """
+    
+    def deck():
+        return random.randint(1, deck_count)
+    def tarot_index():
+        return random.randint(0, 77)
+    
+    return [
+        ('card in deck (card_detail)',
+         lambda: Card.objects.filter(tarot_index=tarot_index(), deck=deck())),
+        ('meaning of card (card_detail)',
+         lambda: Meaning.objects.filter(meaning_set=random.randint(1, meaning_set_count),
+                                        tarot_index=tarot_index())),
+        ('meanings of cards (prefetch_meanings)',
+         lambda: Meaning.objects.filter(meaning_set=random.randint(1, meaning_set_count),
+                                        tarot_index__in=random.sample(range(78), 10))),
+        ('indices of deck (get_nearest_indices)',
+         lambda: Card.objects.filter(deck=deck()).values_list('tarot_index', flat=True)
+                                                 .order_by('tarot_index').distinct()),
+        ('card across decks (tarot_card_detail)',
+         lambda: Card.objects.filter(tarot_index=tarot_index()).select_related('deck')),
+        ('suits of deck (deck_detail)',
+         lambda: Suit.objects.filter(deck=deck()).order_by('suit')),
+        ('positions of spread (reading)',
+         lambda: CardPosition.objects.filter(spread=random.randint(1, spread_count))
+                                     .order_by('index')),
+    ]
+
+class Command(BaseCommand):
+    """ Benchmarks the database lookups the views make by tarot index, deck, meaning set and
+        spread, on a large generated dataset in a throwaway test database, before and after
+        adding the lookup constraints and indexes. The tables are created without them, as
+        in a database from before they were declared, and add_lookup_constraints adds them
+        halfway through, as when upgrading. It shows how long each lookup takes on average
+        both times, with the query plans. """
+    
+    help = 'Benchmarks the main lookups of the views on a large generated dataset.'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--decks', type='int', default=200,
+                    help='Number of decks of 78 cards to generate.'),
+        make_option('--repeat', type='int', default=500,
+                    help='Number of times to run each lookup.'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        restore = strip_lookup_constraints()
+        try:
+            old_name = connection.creation.create_test_db(verbosity=0)
+        finally:
+            restore()
+        
+        try:
+            self.run(options['decks'], options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    
+    def run(self, deck_count, repeat):
+        
+        meaning_set_count = max(deck_count // 10, 1)
+        spread_count = 50
+        start = time.time()
+        
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        
+        insert_rows(MeaningSet, ['id', 'title', 'author', 'description'],
+                    [(i, 'Set %d' % i, 'Benchmark', '') for i in range(1, meaning_set_count + 1)])
+        insert_rows(Meaning, ['meaning_set_id', 'tarot_index', 'predictions', 'keywords',
+                              'reversed_predictions', 'reversed_keywords'],
+                    [(i, tarot_index, '', '', '', '') for i in range(1, meaning_set_count + 1)
+                                                       for tarot_index in range(78)])
+        insert_rows(Deck, ['id', 'meaning_set_id', 'name', 'author', 'description'],
+                    [(i, i % meaning_set_count + 1, 'Deck %d' % i, 'Benchmark', '')
+                     for i in range(1, deck_count + 1)])
+        insert_rows(Suit, ['deck_id', 'suit', 'name'],
+                    [(i, suit, 'Suit %d' % suit) for i in range(1, deck_count + 1)
+                                                 for suit in range(1, 5)])
+        
+        # Insert the cards of the decks in a shuffled order, like decks filled in over time
+        cards = [(deck, tarot_index, 'Card %d' % tarot_index, '', '', 'card.jpg')
+                 for deck in range(1, deck_count + 1) for tarot_index in range(78)]
+        random.shuffle(cards)
+        insert_rows(Card, ['deck_id', 'tarot_index', 'title', 'caption', 'description', 'image'],
+                    cards)
+        
+        insert_rows(Spread, ['id', 'title', 'author', 'source', 'description', 'size'],
+                    [(i, 'Spread %d' % i, 'Benchmark', '', '', 10)
+                     for i in range(1, spread_count + 1)])
+        insert_rows(CardPosition, ['spread_id', 'index', 'x_coordinate', 'y_coordinate',
+                                   'title', 'description'],
+                    [(i, index, index, 0, '', '') for i in range(1, spread_count + 1)
+                                                  for index in range(1, 11)])
+        
+        transaction.commit()
+        transaction.leave_transaction_management()
+        
+        self.stdout.write('Generated %d decks and %d cards in %.1f seconds.\n\n' % (
+                                    deck_count, len(cards), time.time() - start))
+        
+        lookups = get_lookups(deck_count, meaning_set_count, spread_count)
+        before = self.measure(lookups, repeat)
+        call_command('add_lookup_constraints', stdout=self.stdout)
+        self.stdout.write('\n')
+        after = self.measure(lookups, repeat)
+        
+        for name, lookup in lookups:
+            (before_time, before_plan), (after_time, after_plan) = before[name], after[name]
+            self.stdout.write('%s: %.3f ms before, %.3f ms after (%.1f times faster)\n'
+                              '  Before:\n%s\n  After:\n%s\n\n' % (
+                                    name, before_time * 1000, after_time * 1000,
+                                    before_time / max(after_time, 1e-9), before_plan, after_plan))
+    
+    def measure(self, lookups, repeat):
+        """ Runs each lookup repeat times, with the same random parameters on every call.
+            Returns a dictionary of (average time, query plan) pairs keyed by lookup name. """
+        
+        if connection.vendor == 'sqlite':
+            explain = 'EXPLAIN QUERY PLAN '
+        else:
+            explain = 'EXPLAIN '
+        
+        random.seed(0)
+        results = {}
+        cursor = connection.cursor()
+        for name, lookup in lookups:
+            sql, params = lookup().query.get_compiler(connection=connection).as_sql()
+            cursor.execute(explain + sql, params)
+            plan = '\n'.join(['    ' + ' '.join([unicode(value) for value in row])
+                              for row in cursor.fetchall()])
+            
+            querysets = [lookup() for i in range(repeat)]
+            start = time.time()
+            for queryset in querysets:
+                list(queryset)
+            results[name] = ((time.time() - start) / repeat, plan)
+        return results
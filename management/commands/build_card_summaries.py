@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from diyTarot import fragments
+from diyTarot import summaries
+
+class Command(BaseCommand):
+    """ Builds the summary of every card, which the card lists are shown from. The signal
+        handlers keep the summaries up to date as cards, decks and suits are edited, so
+        this is only needed once for existing data, or after editing cards outside of the
+        ORM. The lists raise an error until every card has a summary. """
+    
+    help = 'Builds the summaries of all cards.'
+    
+    def handle(self, *args, **options):
+        
+        start = time.time()
+        count = summaries.summarize_all()
+        
+        # The lists check for missing summaries once per data generation
+        fragments.invalidate()
+        self.stdout.write('Summarized %d cards in %.1f seconds.\n' % (count, time.time() - start))
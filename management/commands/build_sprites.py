@@ -0,0 +1,36 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from diyTarot.models import Deck
+from diyTarot import sprites
+
+class Command(BaseCommand):
+    """ Builds the sprite atlas of every deck (or of the decks whose ids are given) in every
+        sprite size, along with its offset map. Atlases which are already up to date with
+        their deck's cards are skipped, so the command can be run again after adding or
+        changing cards. """
+    
+    args = '[deck_id ...]'
+    help = 'Builds the sprite atlases of card thumbnails for each deck.'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', default=False,
+                    help='Rebuild atlases even if they are up to date.'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        deck_ids = [int(deck_id) for deck_id in args] or list(
+                                                Deck.objects.values_list('id', flat=True))
+        
+        start = time.time()
+        built = 0
+        for deck_id in deck_ids:
+            for size in sprites.SPRITE_SIZES:
+                if options['force'] or sprites.is_outdated(deck_id, size):
+                    count = sprites.build_atlas(deck_id, size)
+                    built += 1
+                    self.stdout.write('Packed %d cards of deck %d at %s.\n' % (count, deck_id,
+                                                                              size))
+        
+        self.stdout.write('Built %d atlases in %.1f seconds.\n' % (built, time.time() - start))
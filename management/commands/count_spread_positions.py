@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from diyTarot.models import Spread, CardPosition
+
+class Command(BaseCommand):
+    """ Counts the positions of every spread again, into the size column which the spread
+        list sorts and filters on. The signal handlers keep it up to date as positions are
+        edited, so this is only needed once for existing data, or after editing positions
+        outside of the ORM. The column is added first if the spread table doesn't have it
+        yet, since syncdb doesn't change existing tables. """
+    
+    help = 'Adds and fills in the number of positions of each spread.'
+    
+    def handle(self, *args, **options):
+        
+        quote_name = connection.ops.quote_name
+        spread_table = Spread._meta.db_table
+        position_table = CardPosition._meta.db_table
+        size_field = Spread._meta.get_field('size')
+        
+        # The columns of the table, read from an empty select so nothing is committed
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM %s WHERE 1 = 0' % quote_name(spread_table))
+        columns = [column[0] for column in cursor.description]
+        if size_field.column not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT 0' % (
+                                quote_name(spread_table), quote_name(size_field.column),
+                                size_field.db_type(connection=connection)))
+            transaction.commit_unless_managed()
+            self.stdout.write('Added the %s column to %s.\n' % (size_field.column, spread_table))
+        
+        # Count every spread's positions in one statement
+        cursor.execute('UPDATE %s SET %s = (SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s)' % (
+                            quote_name(spread_table), quote_name(size_field.column),
+                            quote_name(position_table), quote_name(position_table),
+                            quote_name(CardPosition._meta.get_field('spread').column),
+                            quote_name(spread_table), quote_name(Spread._meta.pk.column)))
+        transaction.commit_unless_managed()
+        self.stdout.write('Counted the positions of %d spreads.\n' % cursor.rowcount)
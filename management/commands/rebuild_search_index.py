@@ -0,0 +1,18 @@
+import time
+from django.core.management.base import BaseCommand
+from diyTarot import search
+
+class Command(BaseCommand):
+    """ Builds the search index of the cards and spreads from scratch. The signal handlers
+        keep it up to date as cards, decks, meanings and spreads are edited, so this is only
+        needed once for existing data (after syncdb creates the table), or after editing
+        the data outside of the ORM. """
+    
+    help = 'Rebuilds the search index of the cards and spreads.'
+    
+    def handle(self, *args, **options):
+        
+        for name in ['cards', 'spreads']:
+            start = time.time()
+            search.rebuild(name)
+            self.stdout.write('Rebuilt the %s index in %.1f seconds.\n' % (name, time.time() - start))
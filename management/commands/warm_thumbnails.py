@@ -0,0 +1,93 @@
+import multiprocessing
+import time
+from optparse import make_option
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from diyTarot.models import Card
+from diyTarot import thumbnails
+
+def render(job):
+    """ Generates the thumbnails of one image in a worker process, decoding it only once.
+        Returns the job, the number of thumbnails written and the error message, if there 
+        was one. """
+    
+    file_path, sizes, formats, force = job
+    try:
+        written = thumbnails.generate_derivatives(file_path, sizes, only_outdated=not force,
+                                                  formats=formats)
+    except Exception as error:
+        return job, 0, str(error)
+    return job, len(written), None
+
+class Command(BaseCommand):
+    """ Generates every thumbnail the templates use, upright and reversed, in every size,
+        pixel density and format, for every card image, across a pool of processes.
+        Thumbnails which are already more recent than their image are skipped, so the
+        command can be run again after adding cards, or after being interrupted, and only
+        does the remaining work. """
+    
+    help = 'Pre-generates the thumbnails of all card images.'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=multiprocessing.cpu_count(),
+                    help='Number of worker processes to use.'),
+        make_option('--force', action='store_true', default=False,
+                    help='Regenerate thumbnails even if they are up to date.'),
+    )
+    
+    def handle(self, *args, **options):
+        
+        sizes = thumbnails.get_standard_sizes()
+        formats = thumbnails.get_standard_formats()
+        image_names = set(Card.objects.values_list('image', flat=True))
+        
+        # Each job is one image, which generates whichever of its thumbnails are outdated
+        jobs = []
+        todo = 0
+        for image_name in sorted(image_names):
+            file_path = default_storage.path(image_name)
+            outdated = 0
+            for size in sizes:
+                for reverse in [False, True]:
+                    for image_format in formats:
+                        thumb_path = thumbnails.get_thumbnail_path(file_path, size, reverse, 
+                                                                   image_format)
+                        if options['force'] or not thumbnails.is_up_to_date(file_path, 
+                                                                             thumb_path):
+                            outdated += 1
+            if outdated > 0:
+                jobs.append((file_path, sizes, formats, options['force']))
+                todo += outdated
+                    
+        total = len(image_names) * len(sizes) * len(formats) * 2
+        self.stdout.write('%d thumbnails of %d images to generate, %d already up to date.\n' % (
+                                    todo, len(jobs), total - todo))
+        if len(jobs) == 0:
+            return
+        
+        start = time.time()
+        done = 0
+        generated = 0
+        errors = 0
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for job, written, error in pool.imap_unordered(render, jobs):
+                done += 1
+                generated += written
+                if error is not None:
+                    errors += 1
+                    self.stderr.write('Could not generate thumbnails of %s: %s\n' % (job[0], error))
+                    
+                if done % 10 == 0:
+                    self.stdout.write('%d/%d images, %.1f thumbnails per second\n' % (
+                                                done, len(jobs), generated / (time.time() - start)))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            self.stdout.write('Interrupted, run again to generate the remaining thumbnails.\n')
+        pool.join()
+        
+        elapsed = time.time() - start
+        self.stdout.write('Generated %d thumbnails of %d images (%d errors) in %.1f seconds, '
+                          '%.1f per second.\n' % (generated, done - errors, errors, elapsed, 
+                                                  generated / max(elapsed, 0.001)))
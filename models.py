@@ -1,4 +1,5 @@
 import os.path
+from datetime import datetime
 from django.db import models
 import tarot_constants
 
@@ -35,6 +36,10 @@ class Meaning(models.Model):
     
     reversed_predictions = models.TextField()
     reversed_keywords = models.TextField()
+    
+    # There is one meaning per card in a set, and meanings are always looked up by both
+    class Meta:
+        unique_together = ('meaning_set', 'tarot_index')
                                        
 
     def __unicode__(self):
@@ -48,15 +53,19 @@ class Deck(models.Model):
     author = models.CharField(max_length=200)
     description = models.TextField()
     
+    # Helper function which returns the list of suits of the deck. If attach_suits has
+    # already loaded the suits for a whole list of decks they are used directly, otherwise
+    # they are queried once and kept.
+    def get_suits(self):
+        if not hasattr(self, '_suit_cache'):
+            self._suit_cache = list(Suit.objects.filter(deck=self.id).order_by('suit'))
+        return self._suit_cache
+    
     # Helper function to get a nice list of only the names of the suits
     # associated with a particular deck.
     def get_suit_names(self):
-        suits = Suit.objects.all().filter(deck=self.id)
-        suit_list = []
-        for suit in suits:
-            suit_list.append(suit.name)
-        return suit_list
-
+        return [suit.name for suit in self.get_suits()]
+    
     def __unicode__(self):
         return "%s Deck" % (self.name)
     
@@ -74,12 +83,17 @@ class Card(models.Model):
     caption = models.CharField(max_length=200)
     description = models.TextField()
     
+    # Indexed for finding a card across all decks. The unique constraint below also indexes
+    # the lookups of a card within a deck, which every card view makes.
     tarot_index = models.PositiveSmallIntegerField(
-                                    choices=tarot_constants.ALL_CARD_CHOICES)  
+                                    choices=tarot_constants.ALL_CARD_CHOICES, db_index=True)  
     
     # this ImageField uses the get_deck_path function to find the upload directory
     image = models.ImageField(upload_to=get_deck_path) 
     
+    class Meta:
+        unique_together = ('deck', 'tarot_index')
+    
     def __unicode__(self):
         return "%s Card of deck %s" % (self.title, self.deck)
     
@@ -87,53 +101,31 @@ class Card(models.Model):
     def get_name(self):
         return "%s" % self.title
     
+    # Helper function which returns the list of Meaning objects for this card in the
+    # meaning set of its deck. If prefetch_meanings has already attached the meanings
+    # to the card they are used directly, otherwise they are queried once and kept.
+    def get_meanings(self):
+        if not hasattr(self, '_meaning_cache'):
+            self._meaning_cache = list(Meaning.objects.filter(
+                                        meaning_set__deck=self.deck_id,
+                                        tarot_index=self.tarot_index))
+        return self._meaning_cache
+    
     # Helper function to be called by the template to get the keywords for the card
     def get_keywords(self):
-        # Pull out the keywords for this card only
-        meanings = Meaning.objects.all().filter(
-                                        meaning_set=self.deck.meaning_set, 
-                                        tarot_index=self.tarot_index).values('keywords')
-                                        
-        # @todo refactor all of this code, move it to views where it belongs
-        # and update the templates accordingly
-        keywords = []
-        for meaning in meanings:
-            keywords += [meaning['keywords']]
-        return keywords
+        return [meaning.keywords for meaning in self.get_meanings()]
     
     # Helper function to be called by the template to get the reversal keywords for the card
     def get_reversed_keywords(self):
-        # Pull out the keywords for this card only
-        meanings = Meaning.objects.all().filter(
-                                        meaning_set=self.deck.meaning_set, 
-                                        tarot_index=self.tarot_index).values('reversed_keywords')                                 
-        keywords = []
-        for meaning in meanings:
-            keywords += [meaning['reversed_keywords']]
-        return keywords
-                                        
+        return [meaning.reversed_keywords for meaning in self.get_meanings()]
     
-    # Helper function to be called by the template to get the reversed predictions for the card
-    def get_predictions(self):     
-        # Pull out the keywords for this card only
-        meanings = Meaning.objects.all().filter(
-                                        meaning_set=self.deck.meaning_set_id, 
-                                        tarot_index=self.tarot_index).values('predictions')
-        predictions = []
-        for meaning in meanings:
-            predictions += [meaning['predictions']]
-        return predictions
+    # Helper function to be called by the template to get the predictions for the card
+    def get_predictions(self):
+        return [meaning.predictions for meaning in self.get_meanings()]
     
     # Helper function to be called by the template to get the reversed predictions for the card
     def get_reversed_predictions(self):
-        # Pull out the keywords for this card only
-        meanings = Meaning.objects.all().filter(
-                                        meaning_set=self.deck.meaning_set_id, 
-                                        tarot_index=self.tarot_index).values('reversed_predictions')
-        predictions = []
-        for meaning in meanings:
-            predictions += [meaning['reversed_predictions']]
-        return predictions
+        return [meaning.reversed_predictions for meaning in self.get_meanings()]
         
 # MajorArcana class, which represents Major Arcana cards for various decks.
 class MajorArcana(Card):
@@ -152,6 +144,9 @@ class Suit(models.Model):
     # The name field gives you the option to change the display name
     name = models.CharField(max_length=100)
     
+    class Meta:
+        unique_together = ('deck', 'suit')
+    
     def __unicode__(self):
         return "%s" % (self.name)
 
@@ -179,6 +174,17 @@ class Spread(models.Model):
     # The description is useful for explaining how to use the spread.
     description = models.TextField()
     
+    # The number of card positions, which the spread list sorts and filters on. It is kept
+    # up to date by the signal handlers when positions are added or removed.
+    size = models.PositiveIntegerField(default=0, editable=False)
+    
+    @classmethod
+    def update_size(cls, spread_id):
+        """ Counts the positions of a spread again. """
+        
+        cls.objects.filter(pk=spread_id).update(
+                            size=CardPosition.objects.filter(spread=spread_id).count())
+    
     def __unicode__(self):
         return "%s spread, by %s" % (self.title, self.author)
 
@@ -197,6 +203,106 @@ class CardPosition(models.Model):
     title = models.CharField(max_length=100)
     description = models.TextField()
     
+    class Meta:
+        unique_together = ('spread', 'index')
+    
+    def __unicode__(self):
+        return "%s position, in spread %s" % (self.title, self.spread)
+
+# CardSummary class, a flattened copy of what is shown about a card in the lists and on the
+# detail pages: its display name, suit and rank (for the minor arcana), deck, caption,
+# description and image. It is kept up to date by the signal handlers, so that the card
+# lists can be shown from the summaries alone, with one query for a whole page, instead of
+# loading each card's deck and subclass (and suit).
+class CardSummary(models.Model):
+    
+    card = models.OneToOneField(Card, primary_key=True, related_name='summary')
+    
+    deck = models.ForeignKey(Deck)
+    deck_name = models.CharField(max_length=200)
+    meaning_set = models.ForeignKey(MeaningSet)
+    
+    tarot_index = models.PositiveSmallIntegerField(db_index=True)
+    name = models.CharField(max_length=300)
+    
+    # Only set for the minor arcana
+    suit = models.PositiveSmallIntegerField(null=True, blank=True)
+    suit_name = models.CharField(max_length=100, blank=True)
+    rank = models.PositiveSmallIntegerField(null=True, blank=True)
+    
+    caption = models.CharField(max_length=200, blank=True)
+    description = models.TextField(blank=True)
+    
+    # The card's image file, which is what the thumbnails are made from
+    image = models.ImageField(upload_to=get_deck_path)
     
     def __unicode__(self):
-        return "%s position, in spread %s" % (self.title, self.spread)
\ No newline at end of file
+        return "Summary of %s (deck %s)" % (self.name, self.deck_name)
+    
+    # Helper function which returns the list of Meaning objects for the card, like
+    # Card.get_meanings, using the meanings attached by prefetch_meanings if there are any.
+    def get_meanings(self):
+        if not hasattr(self, '_meaning_cache'):
+            self._meaning_cache = list(Meaning.objects.filter(meaning_set=self.meaning_set_id,
+                                                              tarot_index=self.tarot_index))
+        return self._meaning_cache
+    
+    # Helper function to be called by the template to get the keywords for the card
+    def get_keywords(self):
+        return [meaning.keywords for meaning in self.get_meanings()]
+    
+    # Helper function to be called by the template to get the predictions for the card
+    def get_predictions(self):
+        return [meaning.predictions for meaning in self.get_meanings()]
+
+# SearchTerm class, one word of the full-text search index: a word appearing in a field of
+# a card (including the card's meanings) or of a spread, with its weight in the ranking.
+# The index is kept up to date by the signal handlers, see the search module.
+class SearchTerm(models.Model):
+    
+    # Which index the term belongs to: 'cards' or 'spreads'
+    index = models.CharField(max_length=10)
+    
+    # The id of the card or spread the word appears in
+    document = models.PositiveIntegerField()
+    
+    field = models.CharField(max_length=30)
+    word = models.CharField(max_length=100)
+    weight = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        unique_together = ('index', 'word', 'document', 'field')
+    
+    def __unicode__(self):
+        return "%s in %s of %s %d" % (self.word, self.field, self.index, self.document)
+
+# DataVersion class, a single row which counts the changes made to the data, and records
+# when the last one was made. The signal handlers bump it whenever any of the models above
+# is saved or deleted, so it can be used to tell whether a page has changed.
+class DataVersion(models.Model):
+    
+    generation = models.PositiveIntegerField(default=1)
+    modified = models.DateTimeField(default=datetime.now)
+    
+    @classmethod
+    def get_current(cls):
+        """ Returns the data version, creating it the first time. """
+        
+        version, created = cls.objects.get_or_create(pk=1)
+        return version
+    
+    @classmethod
+    def bump(cls):
+        """ Counts a change to the data, and returns the new data version. """
+        
+        if cls.objects.filter(pk=1).update(generation=models.F('generation') + 1, 
+                                           modified=datetime.now()) == 0:
+            return cls.get_current()
+        return cls.objects.get(pk=1)
+    
+    def __unicode__(self):
+        return "Data generation %d, modified %s" % (self.generation, self.modified)
+
+# Connect the signal handlers which keep the caches up to date. This has to come last,
+# since the handlers need the models defined above.
+import signals
@@ -0,0 +1,65 @@
+""" This module builds the side navigation used by the card detail pages (the major and
+    minor arcana of a deck, grouped by suit, and the other decks a card appears in). It is
+    kept in the versioned fragment cache, which the signal handlers invalidate whenever the
+    data changes, so stale entries are never used and simply expire. """
+
+from fragments import get_fragment
+from models import Card, MajorArcana, MinorArcana, Suit
+
+def _build_deck_navigation(deck_id):
+    """ Builds the navigation for a deck from two queries: one for its suits, and one for
+        all of its cards, in order, with the suit of the minor arcana. """
+    
+    suits = list(Suit.objects.filter(deck=deck_id))
+    suits_by_id = dict((suit.id, suit) for suit in suits)
+    
+    majors_list = []
+    minors_list = []
+    cards = Card.objects.filter(deck=deck_id).order_by('tarot_index')
+    for tarot_index, title, suit_id in cards.values_list('tarot_index', 'title',
+                                                         'minorarcana__suit'):
+        if suit_id is None:
+            majors_list.append(MajorArcana(deck_id=deck_id, tarot_index=tarot_index, title=title))
+        else:
+            minors_list.append(MinorArcana(deck_id=deck_id, tarot_index=tarot_index, title=title,
+                                           suit=suits_by_id[suit_id]))
+    
+    # Grouped by suit, for the template
+    minors_list.sort(key=lambda card: (card.suit_id, card.tarot_index))
+    
+    # Gives us the list of suits which have no cards in them, for completion.
+    used_suits = set(card.suit_id for card in minors_list)
+    empty_suit_list = [suit for suit in suits if suit.id not in used_suits]
+    
+    first_major = ''
+    if len(majors_list) > 0:
+        first_major = majors_list[0].tarot_index
+    
+    first_minor = ''
+    if len(minors_list) > 0:
+        first_minor = minors_list[0].tarot_index
+    
+    return {'majors_list': majors_list,
+            'minors_list': minors_list,
+            'empty_suit_list': empty_suit_list,
+            'first_major': first_major,
+            'first_minor': first_minor}
+
+def get_deck_navigation(deck_id):
+    """ Returns a dictionary with the navigation for a deck: the list of major arcana, the
+        list of minor arcana ordered by suit (with the suits loaded), the suits which have
+        no cards in them, and the tarot indices of the first major and minor arcana card,
+        or '' if there are none. """
+    
+    deck_id = int(deck_id)
+    return get_fragment('navigation', lambda: _build_deck_navigation(deck_id), [deck_id])
+
+def get_related_cards(tarot_index):
+    """ Returns a list of dictionaries with the id and name of every deck which has a card
+        with the given tarot_index. """
+    
+    tarot_index = int(tarot_index)
+    return get_fragment('related_cards',
+                        lambda: list(Card.objects.filter(tarot_index=tarot_index).order_by('deck')
+                                                                .values('deck', 'deck__name')),
+                        [tarot_index])
@@ -0,0 +1,83 @@
+""" This module caches whole rendered pages which are the same for every visitor, like the
+    static pages and the unfiltered deck and spread lists. Pages are cached as fragments
+    of the fragments module, so they are rebuilt whenever the data is edited.
+    
+    Parts of a page which have to change on every hit (like the random quote in the
+    footer) are rendered with the late_include tag, which marks them in the page. Those
+    parts are rendered again each time a cached page is served, so the rest of the page
+    isn't rendered at all. """
+
+import re
+from django.http import HttpResponse
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.encoding import force_unicode
+from django.utils.functional import wraps
+from fragments import get_fragment
+
+# Markers around a late fragment in a page, with the template name in the opening one
+LATE_START = '<!--late:%s-->'
+LATE_END = '<!--/late-->'
+
+LATE_PATTERN = re.compile(r'<!--late:([^>]+)-->.*?<!--/late-->', re.DOTALL)
+
+# Compiled late fragment templates, by name
+_templates = {}
+
+def render_late_fragment(template_name):
+    """ Renders a late fragment template, marked so that it can be found in the page. Late
+        fragments don't get the page's context, since they are rendered on their own when
+        a cached page is served. """
+    
+    template = _templates.get(template_name)
+    if template is None:
+        template = get_template(template_name)
+        _templates[template_name] = template
+    return (LATE_START % template_name) + template.render(Context()) + LATE_END
+
+def render_late_fragments(content):
+    """ Renders every late fragment of a page again, and returns the new page. """
+    
+    return LATE_PATTERN.sub(lambda match: render_late_fragment(match.group(1)), content)
+
+def cached_response(query_keys=None, session_keys=()):
+    """ Decorator for views whose pages are the same for everyone, which caches the content
+        of successful GET responses by path. If query_keys is given, only requests with no
+        other query parameters are cached, separately for each value of those parameters
+        (so a paginated list is only cached when it isn't filtered). Otherwise the query
+        string is ignored. The page is also cached separately for each value of the
+        session_keys in the session. """
+    
+    def decorator(view):
+        
+        @wraps(view)
+        def cached_view(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+            
+            # Normalize the query string, so that the order of the parameters doesn't matter
+            vary_on = [request.path]
+            if query_keys is not None:
+                if not set(request.GET.keys()).issubset(query_keys):
+                    return view(request, *args, **kwargs)
+                vary_on += ['%s=%s' % (key, request.GET[key]) for key in sorted(request.GET)]
+            vary_on += ['%s=%s' % (key, request.session.get(key, '')) for key in session_keys]
+            
+            rendered = {}
+            def build():
+                response = view(request, *args, **kwargs)
+                rendered['response'] = response
+                if response.status_code != 200:
+                    return None
+                return (force_unicode(response.content), response['Content-Type'])
+            
+            page = get_fragment('page:' + view.__name__, build, vary_on)
+            if 'response' in rendered:
+                return rendered['response']
+            
+            content, content_type = page
+            return HttpResponse(render_late_fragments(content), content_type=content_type)
+        
+        return cached_view
+    
+    return decorator
@@ -0,0 +1,222 @@
+""" This module is a small full-text search engine for cards and spreads. It keeps an
+    inverted index in the SearchTerm table, mapping each word to the fields of the cards or
+    spreads it appears in along with a relevance weight, built from the text of the cards,
+    of their meanings (keywords, predictions and their reversed versions, in the meaning set
+    of each card's deck) and of the spreads. Words are lowercased and simple plurals are
+    stemmed, queries with several words only match documents containing all of them (in
+    any of their fields), and results can be ranked by relevance.
+    
+    Searches run in the database, as a subquery which the views filter on and a relevance
+    column they can sort by, so every process sees the same index. The signal handlers
+    update the documents whose text changes, and the rebuild_search_index management
+    command builds the whole index, e.g. for existing data. """
+
+import re
+from django.db import connection
+from django.db.models import Count
+from models import Card, Meaning, Spread, SearchTerm
+
+# How much a match in each field counts towards the relevance of a result
+CARD_FIELD_WEIGHTS = {'title': 4,
+                      'caption': 2,
+                      'keywords': 2,
+                      'reversed_keywords': 1,
+                      'description': 1,
+                      'predictions': 1,
+                      'reversed_predictions': 1}
+
+SPREAD_FIELD_WEIGHTS = {'title': 4,
+                        'description': 1}
+
+def stem(word):
+    """ Strips simple English plural endings from a word, so that e.g. 'cups', 'crosses'
+        and 'prophecies' are indexed as 'cup', 'cross' and 'prophecy'. """
+    
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if word.endswith('sses') or (len(word) > 4 and word.endswith(('ches', 'shes', 'xes', 'zes'))):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+def tokenize(text):
+    """ Splits a piece of text (which may contain HTML tags) into a list of stemmed,
+        lowercase words. """
+    
+    text = re.sub(r'<[^>]*>', ' ', text.lower())
+    return [stem(word) for word in re.findall(r'[a-z0-9]+', text.replace("'", ''))]
+
+def _add_document(terms, document_id, fields, weights):
+    """ Adds the words of each field of a document to a dictionary of terms, which maps
+        (document, field, word) to its weight. """
+    
+    for field, text in fields.items():
+        for word in tokenize(text):
+            key = (document_id, field, word[:100])
+            terms[key] = terms.get(key, 0) + weights[field]
+
+def _card_terms(card_ids=None):
+    """ Returns the terms of the cards with the given ids, or of all the cards. """
+    
+    terms = {}
+    cards = Card.objects.all()
+    if card_ids is not None:
+        cards = cards.filter(id__in=card_ids)
+    
+    # Cards which share a meaning, by the meaning set of their deck and their tarot_index
+    card_fields = ['title', 'caption', 'description']
+    cards_by_meaning = {}
+    for card in cards.values('id', 'tarot_index', 'deck__meaning_set', *card_fields):
+        _add_document(terms, card['id'], dict((field, card[field]) for field in card_fields),
+                      CARD_FIELD_WEIGHTS)
+        key = (card['deck__meaning_set'], card['tarot_index'])
+        cards_by_meaning.setdefault(key, []).append(card['id'])
+    
+    if len(cards_by_meaning) == 0:
+        return terms
+    
+    meanings = Meaning.objects.all()
+    if card_ids is not None:
+        meanings = meanings.filter(meaning_set__in=set(key[0] for key in cards_by_meaning),
+                                   tarot_index__in=set(key[1] for key in cards_by_meaning))
+    
+    meaning_fields = ['keywords', 'predictions', 'reversed_keywords', 'reversed_predictions']
+    for meaning in meanings.values('meaning_set', 'tarot_index', *meaning_fields):
+        fields = dict((field, meaning[field]) for field in meaning_fields)
+        for card_id in cards_by_meaning.get((meaning['meaning_set'], meaning['tarot_index']), []):
+            _add_document(terms, card_id, fields, CARD_FIELD_WEIGHTS)
+    
+    return terms
+
+def _spread_terms(spread_ids=None):
+    """ Returns the terms of the spreads with the given ids, or of all the spreads. """
+    
+    terms = {}
+    spreads = Spread.objects.all()
+    if spread_ids is not None:
+        spreads = spreads.filter(id__in=spread_ids)
+    
+    for spread in spreads.values('id', 'title', 'description'):
+        _add_document(terms, spread['id'],
+                      {'title': spread['title'], 'description': spread['description']},
+                      SPREAD_FIELD_WEIGHTS)
+    return terms
+
+_builders = {'cards': _card_terms,
+             'spreads': _spread_terms}
+
+def _insert_terms(name, terms):
+    """ Inserts a dictionary of terms into an index, all in one statement. """
+    
+    if len(terms) == 0:
+        return
+    
+    quote_name = connection.ops.quote_name
+    columns = ['index', 'document', 'field', 'word', 'weight']
+    connection.cursor().executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                            quote_name(SearchTerm._meta.db_table),
+                            ', '.join([quote_name(column) for column in columns]),
+                            ', '.join(['%s'] * len(columns))),
+                        [(name, document_id, field, word, weight)
+                         for (document_id, field, word), weight in terms.items()])
+
+def update(name, document_ids):
+    """ Indexes the documents with the given ids in the index with the given name ('cards'
+        or 'spreads') again, dropping the ones which no longer exist. """
+    
+    document_ids = list(document_ids)
+    if len(document_ids) == 0:
+        return
+    
+    SearchTerm.objects.filter(index=name, document__in=document_ids).delete()
+    _insert_terms(name, _builders[name](document_ids))
+
+def remove(name, document_ids):
+    """ Drops the documents with the given ids from an index. """
+    
+    SearchTerm.objects.filter(index=name, document__in=list(document_ids)).delete()
+
+def update_deck(deck):
+    """ Indexes the cards of a deck again, since their meanings come from its meaning set. """
+    
+    update('cards', Card.objects.filter(deck=deck.id).values_list('id', flat=True))
+
+def update_meaning(meaning):
+    """ Indexes the cards which have a meaning again. """
+    
+    update('cards', Card.objects.filter(deck__meaning_set=meaning.meaning_set_id,
+                                        tarot_index=meaning.tarot_index)
+                                .values_list('id', flat=True))
+
+def rebuild(name):
+    """ Builds the index with the given name from scratch. """
+    
+    SearchTerm.objects.filter(index=name).delete()
+    _insert_terms(name, _builders[name]())
+
+def get_words(query):
+    """ Returns the distinct words of a query, as they are indexed. """
+    
+    return sorted(set([word[:100] for word in tokenize(query)]))
+
+def matching(name, query):
+    """ Returns a subquery of the ids of the documents in the index with the given name which
+        contain every word in the query, in any of their fields, for filtering with id__in. """
+    
+    words = get_words(query)
+    if len(words) == 0:
+        # An empty queryset would drop the filter from the outer query, so this is one
+        # which never matches anything
+        return SearchTerm.objects.filter(pk__isnull=True).values('document')
+    
+    return (SearchTerm.objects.filter(index=name, word__in=words)
+                              .values('document')
+                              .annotate(matched=Count('word', distinct=True))
+                              .filter(matched=len(words))
+                              .values('document'))
+
+def count_matching(name, queries):
+    """ Counts the documents in the index with the given name which each query matches, as
+        matching would find them. The queries of one word (e.g. tags) are all counted in a
+        single grouped query, and the others with one query each. Returns a dictionary of
+        counts keyed by query. """
+    
+    words_by_query = dict((query, get_words(query)) for query in queries)
+    single_words = set([words[0] for words in words_by_query.values() if len(words) == 1])
+    
+    word_counts = {}
+    if len(single_words) > 0:
+        word_counts = dict(SearchTerm.objects.filter(index=name, word__in=single_words)
+                                             .values('word')
+                                             .annotate(count=Count('document', distinct=True))
+                                             .values_list('word', 'count'))
+    
+    counts = {}
+    for query, words in words_by_query.items():
+        if len(words) == 1:
+            counts[query] = word_counts.get(words[0], 0)
+        else:
+            # Counting the grouped subquery itself would drop its GROUP BY
+            counts[query] = (SearchTerm.objects.filter(index=name,
+                                                       document__in=matching(name, query))
+                                               .values('document').distinct().count())
+    return counts
+
+def rank(queryset, name, query):
+    """ Adds the relevance of each result to a queryset of cards or spreads searched for the
+        query, as its 'relevance' column, which it can then be ordered by. The relevance is
+        the total weight of the query's words in the document. """
+    
+    words = get_words(query)
+    quote_name = connection.ops.quote_name
+    meta = queryset.model._meta
+    
+    sql = 'SELECT COALESCE(SUM(%s), 0) FROM %s WHERE %s = %%s AND %s = %s.%s' % (
+                quote_name('weight'), quote_name(SearchTerm._meta.db_table), quote_name('index'),
+                quote_name('document'), quote_name(meta.db_table), quote_name(meta.pk.column))
+    if len(words) > 0:
+        sql += ' AND %s IN (%s)' % (quote_name('word'), ', '.join(['%s'] * len(words)))
+    
+    # In parentheses, since it is also grouped by in querysets with aggregates
+    return queryset.extra(select={'relevance': '(%s)' % sql}, select_params=[name] + words)
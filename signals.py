@@ -0,0 +1,83 @@
+""" Signal handlers which keep the application's caches in sync with the database. They
+    are connected when the models module is loaded. """
+
+import os
+from django.db.models.signals import post_save, post_delete
+from models import Card, MajorArcana, MinorArcana, Deck, Suit, Meaning, Spread, CardPosition
+import card_index
+import drawing
+import fragments
+import search
+import summaries
+import thumbnails
+
+def card_changed(sender, **kwargs):
+    drawing.invalidate_cards()
+    card_index.invalidate()
+    fragments.invalidate()
+    
+def card_saved(sender, instance, **kwargs):
+    card_changed(sender, **kwargs)
+    summaries.summarize(instance)
+    search.update('cards', [instance.pk])
+    
+    # Generate all of the thumbnails for the card's image up front, if there is one
+    if instance.image and os.path.exists(instance.image.path):
+        thumbnails.schedule_derivatives(instance.image.path)
+    
+def card_deleted(sender, instance, **kwargs):
+    card_changed(sender, **kwargs)
+    search.remove('cards', [instance.pk])
+    
+def deck_changed(sender, **kwargs):
+    drawing.invalidate_decks()
+    card_index.invalidate()
+    fragments.invalidate()
+    
+def deck_saved(sender, instance, **kwargs):
+    deck_changed(sender, **kwargs)
+    summaries.update_deck(instance)
+    search.update_deck(instance)
+    
+def suit_changed(sender, **kwargs):
+    fragments.invalidate()
+    
+def suit_saved(sender, instance, **kwargs):
+    suit_changed(sender, **kwargs)
+    summaries.update_suit(instance)
+    
+def meaning_changed(sender, instance, **kwargs):
+    fragments.invalidate()
+    search.update_meaning(instance)
+    
+def spread_changed(sender, **kwargs):
+    drawing.invalidate_spreads()
+    fragments.invalidate()
+    
+def spread_saved(sender, instance, **kwargs):
+    spread_changed(sender, **kwargs)
+    search.update('spreads', [instance.pk])
+    
+def spread_deleted(sender, instance, **kwargs):
+    spread_changed(sender, **kwargs)
+    search.remove('spreads', [instance.pk])
+    
+def position_changed(sender, instance, **kwargs):
+    spread_changed(sender, **kwargs)
+    Spread.update_size(instance.spread_id)
+
+# Saving a card subclass only sends the signal for the subclass, so connect to all of them
+for model in [Card, MajorArcana, MinorArcana]:
+    post_save.connect(card_saved, sender=model)
+    post_delete.connect(card_deleted, sender=model)
+
+post_save.connect(deck_saved, sender=Deck)
+post_delete.connect(deck_changed, sender=Deck)
+post_save.connect(suit_saved, sender=Suit)
+post_delete.connect(suit_changed, sender=Suit)
+post_save.connect(meaning_changed, sender=Meaning)
+post_delete.connect(meaning_changed, sender=Meaning)
+post_save.connect(spread_saved, sender=Spread)
+post_delete.connect(spread_deleted, sender=Spread)
+post_save.connect(position_changed, sender=CardPosition)
+post_delete.connect(position_changed, sender=CardPosition)
@@ -0,0 +1,178 @@
+""" This module builds and reads sprite sheets (atlases) of card thumbnails, so that a page
+    showing many cards of a deck needs a single, cacheable image request. Each atlas packs
+    the cards of one deck at one size in a grid, in tarot order, with the upright cards in
+    the top half and the reversed cards in the same positions in the bottom half.
+    
+    An atlas is stored with its offset map, a JSON file mapping each card id to its image
+    name and the position of its upright and reversed cells, in the deck's "sprites"
+    directory, e.g. "diytarot/decks/1/sprites/sprite_85x150.jpg" and ".json". Atlases are
+    built by the build_sprites management command. Cards which aren't in the atlas (or
+    whose image has changed since it was built) are shown as separate thumbnails until it
+    is built again. """
+
+import json
+import os
+import tempfile
+import time
+import Image
+from django.conf import settings
+from django.core.files.storage import default_storage
+from models import Card
+from thumbnails import parse_size, RECHECK_INTERVAL
+
+# Thumbnail sizes atlases are built for
+SPRITE_SIZES = getattr(settings, 'DIYTAROT_SPRITE_SIZES', ('85x150', '62x110'))
+
+# Number of cards in each row of an atlas
+COLUMNS = 13
+
+# Maps (deck id, size) to the offset map of the atlas, or None if there isn't one, along
+# with when its file was last checked and its modification time.
+_atlases = {}
+
+def get_atlas_name(deck_id, size):
+    """ Returns the storage name of a deck's atlas at the given size, without extension. """
+    
+    return 'diytarot/decks/%s/sprites/sprite_%s' % (deck_id, size)
+
+def _replace(path, write):
+    """ Writes a file through a temporary file renamed into place, so that the old version
+        is served until the new one is complete. write is called with the open file. """
+    
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    
+    handle, temp_path = tempfile.mkstemp(prefix='.', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            write(temp_file)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+def is_outdated(deck_id, size):
+    """ Returns True if a deck's atlas at the given size is missing, doesn't have exactly
+        the deck's cards and images, or is older than one of the images. """
+    
+    atlas_name = get_atlas_name(deck_id, size)
+    try:
+        with open(default_storage.path(atlas_name + '.json')) as map_file:
+            offsets = json.load(map_file)
+        atlas_mtime = os.path.getmtime(default_storage.path(atlas_name + '.jpg'))
+    except (IOError, OSError, ValueError):
+        return True
+    
+    cards = dict(Card.objects.filter(deck=deck_id).values_list('id', 'image'))
+    packed = dict([(int(card_id), cell['image']) for card_id, cell in offsets['cards'].items()])
+    if cards != packed:
+        return True
+    
+    for image_name in cards.values():
+        try:
+            if os.path.getmtime(default_storage.path(image_name)) > atlas_mtime:
+                return True
+        except OSError:
+            pass
+    return False
+
+def build_atlas(deck_id, size):
+    """ Builds the atlas of a deck's cards at the given size, and its offset map. Each image
+        is shrunk to fit its cell, and centered in it. Returns the number of cards packed. """
+    
+    width, height = parse_size(size)
+    cards = list(Card.objects.filter(deck=deck_id).order_by('tarot_index')
+                                                  .values_list('id', 'image'))
+    rows = max((len(cards) + COLUMNS - 1) // COLUMNS, 1)
+    atlas = Image.new('RGB', (COLUMNS * width, 2 * rows * height), 'white')
+    
+    offsets = {'size': size, 'cards': {}}
+    for position, (card_id, image_name) in enumerate(cards):
+        try:
+            image = Image.open(default_storage.path(image_name))
+            image.draft('RGB', (width, height))
+            image = image.convert('RGB')
+        except IOError:
+            continue
+        image.thumbnail((width, height), Image.ANTIALIAS)
+        
+        # The cell of the reversed card is in the same place in the bottom half
+        x = (position % COLUMNS) * width
+        y = (position // COLUMNS) * height
+        reversed_y = y + rows * height
+        left = (width - image.size[0]) // 2
+        top = (height - image.size[1]) // 2
+        atlas.paste(image, (x + left, y + top))
+        atlas.paste(image.rotate(180), (x + width - image.size[0] - left,
+                                        reversed_y + height - image.size[1] - top))
+        
+        offsets['cards'][str(card_id)] = {'image': image_name,
+                                          'x': x, 'y': y, 'reversed_y': reversed_y}
+    
+    atlas_path = default_storage.path(get_atlas_name(deck_id, size))
+    _replace(atlas_path + '.jpg', lambda atlas_file: atlas.save(atlas_file, 'JPEG',
+                                                                quality=90, optimize=1))
+    _replace(atlas_path + '.json', lambda map_file: json.dump(offsets, map_file))
+    invalidate(deck_id)
+    return len(offsets['cards'])
+
+def get_atlas(deck_id, size):
+    """ Returns the offset map of a deck's atlas at the given size, with the atlas URL
+        (which changes whenever it is rebuilt, so it can be cached for good) added, or None
+        if there isn't one. The map is kept in memory and its file only checked again after
+        a while. """
+    
+    key = (deck_id, size)
+    now = time.time()
+    entry = _atlases.get(key)
+    if entry is not None and now - entry['checked'] <= RECHECK_INTERVAL:
+        return entry['offsets']
+    
+    atlas_name = get_atlas_name(deck_id, size)
+    map_path = default_storage.path(atlas_name + '.json')
+    try:
+        mtime = os.path.getmtime(map_path)
+    except OSError:
+        mtime = None
+    
+    if entry is not None and entry['mtime'] == mtime:
+        offsets = entry['offsets']
+    elif mtime is None:
+        offsets = None
+    else:
+        try:
+            with open(map_path) as map_file:
+                offsets = json.load(map_file)
+        except (IOError, ValueError):
+            offsets = None
+        else:
+            offsets['url'] = '%s?%d' % (default_storage.url(atlas_name + '.jpg'), mtime)
+    
+    _atlases[key] = {'offsets': offsets, 'checked': now, 'mtime': mtime}
+    return offsets
+
+def get_sprite(card, size, reverse=False):
+    """ Returns the atlas URL and the position of a card's cell in it, as (url, x, y), or
+        None if the card isn't in an up to date atlas. """
+    
+    offsets = get_atlas(card.deck_id, size)
+    if offsets is None:
+        return None
+    
+    cell = offsets['cards'].get(str(card.pk))
+    if cell is None or cell['image'] != card.image.name:
+        return None
+    
+    if reverse:
+        return offsets['url'], cell['x'], cell['reversed_y']
+    return offsets['url'], cell['x'], cell['y']
+
+def invalidate(deck_id=None):
+    """ Forgets the offset maps of a deck's atlases (or of all of them), so the files are
+        checked again the next time they are needed. """
+    
+    for key in list(_atlases.keys()):
+        if deck_id is None or key[0] == deck_id:
+            del _atlases[key]
@@ -0,0 +1,122 @@
+""" This module maintains the card summaries, the flattened read model of the cards used to
+    show them in lists and on the detail pages without loading their subclass and suit.
+    The signal handlers update the summary of a card whenever it is saved, and the
+    summaries of a deck's or suit's cards when it is renamed. Summaries are deleted along
+    with their card. The build_card_summaries management command makes the summaries of
+    existing cards. Pages never save summaries: the detail pages build the summary of a
+    card which doesn't have one without saving it, and the lists raise an error while any
+    card doesn't have one, rather than leaving it out. """
+
+from django.core.exceptions import ImproperlyConfigured
+from models import Card, MinorArcana, CardSummary
+from functions import downcast_cards
+from fragments import get_fragment
+
+# The card lookups made by the filter and sorting helpers, and the matching summary lookups
+SUMMARY_LOOKUPS = {'suit__suit': 'suit'}
+
+def build_summary(card):
+    """ Builds the summary of a card, which may be a Card, MajorArcana or MinorArcana,
+        without saving it. A plain Card is looked up in the minor arcana (with its suit) to
+        find out what it is. Returns the summary. """
+    
+    if not isinstance(card, MinorArcana) and card.tarot_index > 21:
+        try:
+            card = MinorArcana.objects.select_related('suit', 'deck').get(pk=card.pk)
+        except MinorArcana.DoesNotExist:
+            pass
+    
+    summary = CardSummary(card_id=card.pk,
+                          deck_id=card.deck_id,
+                          deck_name=card.deck.name,
+                          meaning_set_id=card.deck.meaning_set_id,
+                          tarot_index=card.tarot_index,
+                          name=card.title,
+                          caption=card.caption,
+                          description=card.description,
+                          image=card.image.name)
+    
+    if isinstance(card, MinorArcana):
+        summary.name = card.get_name()
+        summary.suit = card.suit.suit
+        summary.suit_name = card.suit.name
+        summary.rank = card.rank
+    
+    return summary
+
+def summarize(card):
+    """ Builds and saves the summary of a card. Returns the summary. """
+    
+    summary = build_summary(card)
+    summary.save()
+    return summary
+
+def summarize_all(batch_size=500):
+    """ Builds and saves the summaries of all the cards, a batch of cards at a time. Returns
+        the number of cards summarized. """
+    
+    card_ids = list(Card.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(card_ids), batch_size):
+        cards = Card.objects.filter(pk__in=card_ids[start:start + batch_size])
+        for card in downcast_cards(cards.select_related('deck')):
+            summarize(card)
+    return len(card_ids)
+
+def check_summaries():
+    """ Raises ImproperlyConfigured if some cards don't have a summary, since the lists are
+        shown from the summaries and would silently leave those cards out. The cards without
+        one are only counted once per data generation. """
+    
+    missing = get_fragment('missing_summaries',
+                           lambda: Card.objects.filter(summary__isnull=True).count())
+    if missing > 0:
+        raise ImproperlyConfigured('%d cards have no summary. Run "manage.py '
+                                   'build_card_summaries" to build them.' % missing)
+
+def summary_lookups(lookups):
+    """ Turns a dictionary of card lookups, or a list of card fields to sort on, as made by
+        the apply_*_filter and apply_sorting_order helpers, into the same lookups on
+        CardSummary. """
+    
+    def convert(lookup):
+        for card_lookup, summary_lookup in SUMMARY_LOOKUPS.items():
+            if lookup.lstrip('-').startswith(card_lookup):
+                return lookup.replace(card_lookup, summary_lookup, 1)
+        return lookup
+    
+    if isinstance(lookups, dict):
+        return dict((convert(lookup), value) for lookup, value in lookups.items())
+    return [convert(lookup) for lookup in lookups]
+
+def update_deck(deck):
+    """ Updates the deck name and meaning set in the summaries of a deck's cards. """
+    
+    CardSummary.objects.filter(deck=deck.id).update(deck_name=deck.name,
+                                                    meaning_set=deck.meaning_set_id)
+
+def update_suit(suit):
+    """ Updates the summaries of the cards in a suit, since their names include it. """
+    
+    for card in MinorArcana.objects.filter(suit=suit.id).select_related('suit', 'deck'):
+        summarize(card)
+
+def attach_summaries(cards):
+    """ Loads the summaries of a list of cards with a single query, and attaches each one
+        to its card as card.summary. The summaries of cards which don't have one yet are
+        built (after loading their subclasses together) but not saved, so showing a card
+        never writes to the database. Returns the list of cards. """
+    
+    cards = list(cards)
+    summaries = CardSummary.objects.in_bulk([card.pk for card in cards])
+    
+    missing_cards = [card for card in cards if card.pk not in summaries]
+    for card in downcast_cards(missing_cards):
+        summaries[card.pk] = build_summary(card)
+    
+    for card in cards:
+        summary = summaries[card.pk]
+        
+        # This is where the related object descriptor keeps card.summary once loaded
+        card._summary_cache = summary
+    
+    return cards
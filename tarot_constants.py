@@ -91,4 +91,15 @@ MINOR_ARCANA_CHOICES = (
 (76, 'Queen of Pentacles'),                     
 (77, 'King of Pentacles'))
 
-ALL_CARD_CHOICES = MAJOR_ARCANA_CHOICES + MINOR_ARCANA_CHOICES
\ No newline at end of file
+ALL_CARD_CHOICES = MAJOR_ARCANA_CHOICES + MINOR_ARCANA_CHOICES
+
+# Tags used to browse the spreads, along with their display names. A spread has a tag 
+# if searching for the tag finds it, i.e. the tag's words appear in its title or
+# description. Can be overridden with the DIYTAROT_SPREAD_TAGS setting.
+SPREAD_TAGS = (
+('daily', 'Daily life'),
+('traditional', 'Traditional'),
+('love', 'Love life'),
+('work', 'Work issues'),
+('advice', 'General advice'),
+('choice', 'Help with decisions'))
@@ -0,0 +1,39 @@
+from django.template import Library, Node, TemplateSyntaxError
+from django.utils.encoding import force_unicode
+from diyTarot.fragments import get_fragment
+
+register = Library()
+
+class FragmentCacheNode(Node):
+    
+    def __init__(self, nodelist, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+        
+    def render(self, context):
+        vary_on = [force_unicode(var.resolve(context)) for var in self.vary_on]
+        return get_fragment('template:' + self.fragment_name, 
+                            lambda: self.nodelist.render(context), vary_on)
+
+def cachefragment(parser, token):
+    """ Tag which caches the contents of a template fragment until the data is edited (when
+        the data generation changes), like the cache tag but without a timeout. It also 
+        varies on any number of variables, so that each set of values is cached separately.
+        
+        Usage: {% cachefragment reading_menu spread.id deck_options.display_deck_id %}
+               ...
+               {% endcachefragment %}
+    """
+    
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise TemplateSyntaxError("'%s' takes a fragment name and optionally variables to "
+                                  "vary on" % bits[0])
+    
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    return FragmentCacheNode(nodelist, bits[1], 
+                             [parser.compile_filter(var) for var in bits[2:]])
+
+register.tag(cachefragment)
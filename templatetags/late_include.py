@@ -0,0 +1,26 @@
+from django.template import Library, Node, TemplateSyntaxError
+from diyTarot.page_cache import render_late_fragment
+
+register = Library()
+
+class LateIncludeNode(Node):
+    
+    def __init__(self, template_name):
+        self.template_name = template_name
+        
+    def render(self, context):
+        return render_late_fragment(self.template_name.resolve(context))
+
+def late_include(parser, token):
+    """ Tag which includes a template that is rendered again every time a cached page is
+        served, like the random quote. The template doesn't get the page's context.
+        
+        Usage: {% late_include "diyTarot/quote.html" %}
+    """
+    
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise TemplateSyntaxError("'%s' takes the name of a template" % bits[0])
+    return LateIncludeNode(parser.compile_filter(bits[1]))
+
+register.tag(late_include)
@@ -2,44 +2,55 @@ from django.conf import settings
 from django.template import Library
 import os
 import random
+import time
 
 register = Library()
 
+# How long, in seconds, before checking again whether a file has changed
+RECHECK_INTERVAL = 10
+
+# Maps each file name to its non-blank lines, along with the file's modification time and
+# when that was last checked. Entries are replaced as a whole, never modified.
+_files = {}
+
+def get_lines(filename):
+    """ Returns the list of non-blank lines (stripped) of a file inside MEDIA_ROOT. The file
+        is only read the first time and again when it has been modified, which is checked
+        at most every RECHECK_INTERVAL seconds. Returns an empty list if it can't be read. """
+    
+    now = time.time()
+    entry = _files.get(filename)
+    if entry is not None and now - entry['checked'] <= RECHECK_INTERVAL:
+        return entry['lines']
+    
+    path = os.path.join(settings.MEDIA_ROOT, filename)
+    try:
+        mtime = os.path.getmtime(path)
+        if entry is not None and entry['mtime'] == mtime:
+            lines = entry['lines']
+        else:
+            target_file = open(path, 'r')
+            try:
+                lines = [line.strip() for line in target_file if line.strip()]
+            finally:
+                target_file.close()
+    except (OSError, IOError):
+        mtime = None
+        lines = []
+        
+    _files[filename] = {'lines': lines, 'mtime': mtime, 'checked': now}
+    return lines
+
 def random_line(filename):
-    """ Filter that reads a file and returns one line at random.
+    """ Filter that returns one line of a file at random, every line being equally likely,
+        or an empty string if the file can't be read.
         
         Note that the file HAS to be somewhere inside MEDIA_ROOT.
     """
-    try:
-      os.chdir(settings.MEDIA_ROOT)
-      
-      file_size = os.stat(filename)[6]
-      
-      target_file = open(filename, 'r')
     
-      #Seek to a place in the file which is a random distance away
-      #Mod by file size so that it wraps around to the beginning
-      target_file.seek(random.randint(0,file_size-1))
-  
-      #dont use the first readline since it may fall in the middle of a line
-      target_file.readline()
-      
-      #this will return the next (complete) line from the file
-      line = target_file.readline().strip()
-      
-      target_file.close()
-    
-      # If the previous line happened to be the last one, getting the next line
-      # will give us a blank line, so in that case just give the first line of the file
-      if line is None or len(line) <= 0:
-          
-          target_file = open(filename, 'r')
-          line = target_file.readline().strip()
-          target_file.close()
-          
-    except (OSError, IOError):
-      line = ""
-
-    return line
+    lines = get_lines(filename)
+    if len(lines) == 0:
+        return ""
+    return random.choice(lines)
 
-register.filter(random_line)
\ No newline at end of file
+register.filter(random_line)
@@ -12,9 +12,8 @@ def random_quote(filename):
     
     quote = random_line(filename)
     
-    divided = quote.split('~')
-    if len(divided) > 0:
-        return divided
+    if quote:
+        return quote.split('~')
     else:
         return ["OH MY GOD WHO'S FLYING THIS THING!?!!", "..oh right, that would be me."]
 
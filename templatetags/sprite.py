@@ -0,0 +1,60 @@
+from django.template import Library, Node, TemplateSyntaxError
+from django.utils.html import escape
+from diyTarot.sprites import get_sprite
+from diyTarot.thumbnails import parse_size
+from diyTarot.templatetags.thumbnail import render_picture
+
+register = Library()
+
+class SpriteNode(Node):
+    
+    def __init__(self, card, size, reverse, nodelist):
+        self.card = card
+        self.size = size
+        self.reverse = reverse
+        self.nodelist = nodelist
+    
+    def render(self, context):
+        card = self.card.resolve(context)
+        size = self.size.resolve(context)
+        reverse = bool(self.reverse and self.reverse.resolve(context))
+        
+        # The variables in the label are already escaped when it is rendered
+        label = ' '.join(self.nodelist.render(context).split())
+        
+        sprite = get_sprite(card, size, reverse)
+        if sprite is None:
+            return render_picture(card.image, size, reverse, 'alt="%s"' % label)
+        
+        url, x, y = sprite
+        width, height = parse_size(size)
+        return ('<span class="card_sprite" role="img" aria-label="%s" title="%s" '
+                'style="display: inline-block; width: %dpx; height: %dpx; '
+                'background: url(%s) %dpx %dpx no-repeat;"></span>' % (
+                        label, label, width, height, escape(url), -x, -y))
+
+def sprite(parser, token):
+    """ Tag which shows a card as its cell in the sprite atlas of its deck, so that all the
+        cards of a page share one image. The content of the tag is the text describing the
+        card. Cards which aren't in an up to date atlas are shown as a thumbnail instead.
+        Only use it on pages showing the cards of a single deck, since each deck shown
+        costs its whole atlas.
+        
+        Usage: {% sprite card '85x150' thrown_card.reversed %}{{ card.title }}{% endsprite %}
+    """
+    
+    bits = token.split_contents()
+    if len(bits) not in (3, 4):
+        raise TemplateSyntaxError("'%s' takes a card, a size and optionally whether the "
+                                  "card is reversed" % bits[0])
+    
+    nodelist = parser.parse(('endsprite',))
+    parser.delete_first_token()
+    
+    reverse = None
+    if len(bits) == 4:
+        reverse = parser.compile_filter(bits[3])
+    return SpriteNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]),
+                      reverse, nodelist)
+
+register.tag(sprite)
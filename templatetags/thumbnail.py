@@ -1,77 +1,25 @@
-import os
-import Image
-from django.template import Library
+from django.template import Library, Node, TemplateSyntaxError
+from django.utils.html import escape
+from diyTarot.thumbnails import (thumbnail_url, thumbnail_source, thumbnail_srcset, 
+                                 get_standard_formats, parse_size, MIME_TYPES)
 
 register = Library()
 
+# Style turning the original image of a reversed card upside down until its thumbnail is ready
+ROTATE_STYLE = 'transform: rotate(180deg);'
+
 # Custom filter to do thumbnail automatically -- from django-snippets.com
 # Example usage inside a template:
 # <img src="{{ object.image.url }}" alt="original image"> 
 # <img src="{{ object.image|thumbnail }}" alt="image resized to default 104x104 format"> 
 # <img src="{{ object.image|thumbnail:'200x300' }}" alt="image resized to 200x300">
+#
+# The thumbnails are generated in the background by the thumbnail service, so the original
+# image url is given until the thumbnail is ready. The original is upright, so reversed
+# thumbnails also need the reversed_thumbnail_style filter in the style of the <img>.
 def thumbnail(image_file, size='104x104', reverse=False):
     
-    # Parse out the input string into x and y dimension integers
-    x, y = [int(x) for x in size.split('x')]
-    
-    # Separate the file path into the directory location and the filename
-    # Split the filename into the actual name and the extension (including the .)
-    file_path = image_file.path
-    file_head, file_name = os.path.split(file_path)
-    base_name, file_format = os.path.splitext(file_name)
-    
-    # Create the full path to the new thumbnail. Put it in a subdirectory of the location
-    # of the input image's path, named "thumbs", and append the size of the thumb to the original name.
-    # So an input of ("C:/haters/your_mom.jpg", "100x100") would produce "C:/haters/thumbs/your_mom_100x100.jpg"
-    if reverse:
-        thumb_name = base_name + '_' + size + '_reversed' + file_format
-    else:
-        thumb_name = base_name + '_' + size + file_format
-        
-    thumb_head = os.path.join(file_head, 'thumbs')
-    thumb_path = os.path.join(thumb_head, thumb_name)
-    
-    # If the file already exists and the last modified time of the original file is more recent than 
-    # the last modified version of the thumbnail, delete the thumb.
-    if os.path.exists(thumb_path) and os.path.getmtime(file_path)>os.path.getmtime(thumb_path):
-        os.unlink(thumb_path)
-        
-    # If the thumbnail doesn't already exist (or has been deleted above), create it.
-    if not os.path.exists(thumb_path):
-        
-        # Check for existence of the thumbs subdirectory, and if it's not there, create it.
-        if not os.path.exists(thumb_head):
-            os.mkdir(thumb_head)
-        
-        image = Image.open(file_path)
-        image.thumbnail([x, y], Image.ANTIALIAS)
-        
-        # Handle the normal, upright, unreversed case
-        if not reverse:
-            
-            try:
-                image.save(thumb_path, image.format, quality=90, optimize=1)
-            except:
-                image.save(thumb_path, image.format, quality=90)
-        
-        else:
-            # Otherwise if reversed is true making a reversed thumbnail (flipped in the y direction)
-            # Rotate, unlike thumbnail, does not modify the image in place, so we need to rename.
-            reversed_image = image.rotate(180)
-            
-            try:
-                reversed_image.save(thumb_path, image.format, quality=90, optimize=1)
-            except:
-                reversed_image.save(thumb_path, image.format, quality=90)
-            
-    # Now get the URL of the image file (as opposed to its directory location), discarding
-    # the image filename part since it is the same for both url and file path,
-    # then use it to create the URL for the request thumbnail.
-    url_head = os.path.split(image_file.url)[0]
-    thumb_url = os.path.join(url_head, 'thumbs', thumb_name)
-            
-    # Finally, return the url of the thumbnail so it can be used in the template
-    return thumb_url
+    return thumbnail_url(image_file, size, reverse)
 
 # Custom filter to do vertical flip automatically -- This is just syntactic sugar and calls
 # thumbnail with a different option. Usage is the same, except use reversed_thumbnail instead.
@@ -79,5 +27,84 @@ def reversed_thumbnail(image_file, size='104x104'):
     
     return thumbnail(image_file, size, reverse=True)
 
+# Custom filter giving the style which turns a reversed card's image upside down while its
+# thumbnail isn't ready, and nothing once it is. Usage:
+# <img src="{{ card.image|reversed_thumbnail:'85x150' }}"
+#      style="{{ card.image|reversed_thumbnail_style:'85x150' }}">
+def reversed_thumbnail_style(image_file, size='104x104'):
+    
+    url, rotate = thumbnail_source(image_file, size, reverse=True)
+    if rotate:
+        return ROTATE_STYLE
+    return ''
+
 register.filter(thumbnail)
 register.filter(reversed_thumbnail)
+register.filter(reversed_thumbnail_style)
+
+def render_picture(image_file, size, reverse=False, attributes=''):
+    """ Returns the <picture> element for a thumbnail of an image, with the given extra 
+        attributes added to its <img>. """
+    
+    width, height = parse_size(size)
+    
+    # Only the formats with at least one thumbnail ready are offered, since the browser
+    # would otherwise be given the original image under the wrong type.
+    sources = []
+    for image_format in get_standard_formats()[1:]:
+        srcset = thumbnail_srcset(image_file, size, reverse, image_format)
+        if srcset:
+            sources.append('<source type="%s" srcset="%s" />' % (MIME_TYPES[image_format], 
+                                                                 escape(srcset)))
+    
+    srcset = thumbnail_srcset(image_file, size, reverse)
+    if srcset:
+        srcset = ' srcset="%s"' % escape(srcset)
+    if attributes:
+        attributes = ' ' + attributes
+    
+    # Until the thumbnail is ready the original image is shown, turned upside down with CSS
+    # if the card is reversed, rather than making the page wait for the thumbnail
+    url, rotate = thumbnail_source(image_file, size, reverse)
+    if rotate:
+        attributes += ' style="%s"' % ROTATE_STYLE
+    return '<picture>%s<img src="%s"%s width="%d" height="%d"%s /></picture>' % (
+                ''.join(sources), escape(url), srcset, width, height, attributes)
+
+class PictureNode(Node):
+    
+    def __init__(self, image_file, size, reverse, nodelist):
+        self.image_file = image_file
+        self.size = size
+        self.reverse = reverse
+        self.nodelist = nodelist
+        
+    def render(self, context):
+        reverse = bool(self.reverse and self.reverse.resolve(context))
+        return render_picture(self.image_file.resolve(context), self.size.resolve(context), 
+                              reverse, self.nodelist.render(context).strip())
+
+def picture(parser, token):
+    """ Tag which outputs a <picture> element for a thumbnail of an image, offering the 
+        browser the thumbnail in every format (such as WebP) and pixel density that is 
+        ready, with an <img> in the source format as the fallback. The thumbnail may also 
+        be reversed. The content of the tag is added to the attributes of the <img>.
+        
+        Usage: {% picture card.image '85x150' thrown_card.reversed %}alt="..."{% endpicture %}
+    """
+    
+    bits = token.split_contents()
+    if len(bits) not in (3, 4):
+        raise TemplateSyntaxError("'%s' takes an image, a size and optionally whether the "
+                                  "thumbnail is reversed" % bits[0])
+    
+    nodelist = parser.parse(('endpicture',))
+    parser.delete_first_token()
+    
+    reverse = None
+    if len(bits) == 4:
+        reverse = parser.compile_filter(bits[3])
+    return PictureNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]), 
+                       reverse, nodelist)
+
+register.tag(picture)
@@ -5,7 +5,25 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import re
+import shutil
+import tempfile
+import time
+import Image
+from django.core.files.storage import FileSystemStorage
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import unittest
+from django.core.management.color import no_style
+from django.db import connection, transaction, IntegrityError
+from django.db.models import get_models
+from django.db.models import Q
+from django.http import QueryDict
+from StringIO import StringIO
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +39,1123 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+from models import CardSummary, MeaningSet, Meaning, Deck, Suit, Card, MajorArcana, MinorArcana
+from models import Spread, CardPosition
+from functions import prefetch_meanings, assemble_reading
+from functions import load_saved_reading, encode_reading, parse_reading_string
+from functions import get_nearest_indices, attach_suits, count_spread_tags
+from functions import apply_card_search_filter, apply_spread_search_filter
+from functions import downcast_cards, get_keyset_page
+from functions import CountedPaginator
+import views
+import drawing
+import fragments
+from keyset import KeysetPaginator
+import page_cache
+from summaries import attach_summaries
+import navigation
+import search
+import sprites
+import thumbnails
+from templatetags import random_line as line_store
+from templatetags.random_quote import random_quote
+from management.commands.add_lookup_constraints import UNIQUE_TOGETHER, strip_lookup_constraints
+from management.commands import warm_thumbnails
+
+class TarotTestCase(TestCase):
+    """ Base test case which sets up a small system: one meaning set shared by two decks,
+        a few major and minor arcana cards in each, and a three card spread. """
+    
+    def setUp(self):
+        self.meaning_set = MeaningSet.objects.create(title='Serious', author='Test', 
+                                                     description='')
+        self.decks = []
+        for name in ['First', 'Second']:
+            deck = Deck.objects.create(meaning_set=self.meaning_set, name=name, 
+                                       author='Test', description='')
+            suit = Suit.objects.create(deck=deck, suit=1, name='Wands')
+            for tarot_index in range(0, 5):
+                MajorArcana.objects.create(deck=deck, tarot_index=tarot_index, title='Major %d' % tarot_index,
+                                           caption='', description='', image='card.jpg')
+            for rank in range(1, 4):
+                MinorArcana.objects.create(deck=deck, suit=suit, rank=rank, tarot_index=21 + rank,
+                                           title='%d' % rank, caption='', description='', image='card.jpg')
+            self.decks.append(deck)
+            
+        for tarot_index in [0, 1, 2, 22]:
+            Meaning.objects.create(meaning_set=self.meaning_set, tarot_index=tarot_index,
+                                   predictions='Prediction %d.' % tarot_index, 
+                                   keywords='keyword %d' % tarot_index,
+                                   reversed_predictions='Reversed %d.' % tarot_index,
+                                   reversed_keywords='reversed %d' % tarot_index)
+        
+        self.spread = Spread.objects.create(title='Three', author='Test', description='')
+        for index in range(1, 4):
+            CardPosition.objects.create(spread=self.spread, index=index, x_coordinate=index - 1,
+                                        y_coordinate=0, title='Position %d' % index, description='')
+            
+    def get_card_list(self, data=None, session=None):
+        """ Renders the card list for a GET request, and returns the content. """
+        
+        request = RequestFactory().get('/cards/', data or {})
+        request.session = session or {}
+        return views.card_list(request).content
+            
+class MeaningPrefetchTest(TarotTestCase):
+    
+    def test_prefetched_meanings_match_card_helpers(self):
+        cards = prefetch_meanings(Card.objects.select_related('deck'))
+        
+        for card in cards:
+            expected = list(Meaning.objects.filter(meaning_set=card.deck.meaning_set, 
+                                                   tarot_index=card.tarot_index))
+            self.assertEqual([meaning.keywords for meaning in expected], card.get_keywords())
+            self.assertEqual([meaning.reversed_predictions for meaning in expected], 
+                             card.get_reversed_predictions())
+        
+    def test_query_count_is_constant(self):
+        cards = list(Card.objects.select_related('deck'))
+        
+        def read_meanings():
+            prefetch_meanings(cards)
+            for card in cards:
+                card.get_keywords()
+                card.get_predictions()
+                card.get_reversed_keywords()
+                card.get_reversed_predictions()
+                
+        self.assertNumQueries(1, read_meanings)
+        
+        # Without the decks loaded, only one more query is needed to find the meaning sets
+        cards = list(Card.objects.all())
+        self.assertNumQueries(2, read_meanings)
+
+class ReadingAssemblyTest(TarotTestCase):
+    
+    def test_random_reading_uses_fixed_number_of_queries(self):
+        deck = self.decks[0]
+        
+        contexts = []
+        def assemble():
+            contexts.append(assemble_reading(self.spread.id, str(deck.id), deck.id, seed=1))
+        
+        # Spread, positions, drawn cards, their major and minor arcana and their meanings,
+        # once the deck's card ids and the deck and spread lists are cached. The seed draws
+        # both major and minor arcana.
+        drawing.get_deck_card_ids(deck.id)
+        fragments.get_deck_list()
+        fragments.get_spread_list()
+        self.assertNumQueries(6, assemble)
+        context = contexts[0]
+        
+        self.assertEqual(3, len(context['card_list']))
+        self.assertEqual([1, 2, 3], [position.index for position, thrown_card, coordinates 
+                                     in context['card_list']])
+        self.assertEqual(deck.name, context['deck_options']['session_deck_name'])
+        self.assertEqual(330, context['layout']['width'])
+        
+    def test_missing_deck_or_spread(self):
+        self.assertRaises(Deck.DoesNotExist, assemble_reading, self.spread.id, '999', 1)
+        self.assertRaises(Spread.DoesNotExist, assemble_reading, 999, str(self.decks[0].id), 1)
+        
+    def test_invalid_saved_reading_gives_error(self):
+        context = assemble_reading(self.spread.id, str(self.decks[0].id), 1, '0.1,1.0')
+        self.assertTrue('error' in context)
+
+class DrawingTest(TarotTestCase):
+    
+    def test_seeded_draws_are_reproducible(self):
+        deck_id = self.decks[0].id
+        first = drawing.draw_cards(deck_id, 5, seed=42)
+        second = drawing.draw_cards(deck_id, 5, seed=42)
+        
+        self.assertEqual([(thrown['card'].id, thrown['reversed']) for thrown in first],
+                         [(thrown['card'].id, thrown['reversed']) for thrown in second])
+        self.assertEqual(5, len(set(thrown['card'].id for thrown in first)))
+        self.assertTrue(all(thrown['card'].deck_id == deck_id for thrown in first))
+        
+    def test_reversal_chance(self):
+        reading = drawing.draw_cards(self.decks[0].id, 8, reversal_chance=0)
+        self.assertFalse(any(thrown['reversed'] for thrown in reading))
+        
+        reading = drawing.draw_cards(self.decks[0].id, 8, reversal_chance=1)
+        self.assertTrue(all(thrown['reversed'] for thrown in reading))
+        
+    def test_cache_is_invalidated_when_cards_change(self):
+        deck = self.decks[0]
+        self.assertEqual(8, len(drawing.get_deck_card_ids(deck.id)))
+        self.assertNumQueries(0, drawing.get_deck_card_ids, deck.id)
+        
+        MajorArcana.objects.create(deck=deck, tarot_index=5, title='Major 5', caption='', 
+                                   description='', image='card.jpg')
+        self.assertEqual(9, len(drawing.get_deck_card_ids(deck.id)))
+        
+        Card.objects.filter(deck=deck, tarot_index=5)[0].delete()
+        self.assertEqual(8, len(drawing.get_deck_card_ids(deck.id)))
+        
+    def test_cache_follows_edits_from_other_processes(self):
+        deck = self.decks[0]
+        other_deck = Deck.objects.create(meaning_set=self.meaning_set, name='Other', 
+                                         author='Test', description='')
+        self.assertEqual(8, len(drawing.get_deck_card_ids(deck.id)))
+        
+        # Updates don't send signals, but another process would bump the generation
+        Card.objects.filter(deck=deck, tarot_index=4).update(deck=other_deck)
+        fragments.invalidate()
+        self.assertEqual(7, len(drawing.get_deck_card_ids(deck.id)))
+        
+    def test_deleted_cards_are_drawn_again(self):
+        deck = self.decks[0]
+        
+        # A card deleted in another process, before the generation is seen to change
+        drawing.get_deck_card_ids(deck.id).append(999)
+        for seed in range(10):
+            reading = drawing.draw_cards(deck.id, 8, seed=seed)
+            self.assertEqual(8, len(set(thrown['card'].id for thrown in reading)))
+
+class SavedReadingTest(TarotTestCase):
+    
+    def test_original_format(self):
+        deck_id = self.decks[0].id
+        self.assertNumQueries(1, load_saved_reading, '22.1,0.0,4.1', 3, deck_id)
+        reading = load_saved_reading('22.1,0.0,4.1', 3, deck_id)
+        
+        self.assertEqual([22, 0, 4], [thrown['card'].tarot_index for thrown in reading])
+        self.assertEqual([True, False, True], [thrown['reversed'] for thrown in reading])
+        self.assertTrue(all(thrown['card'].deck_id == deck_id for thrown in reading))
+        
+    def test_compact_format_round_trip(self):
+        deck_id = self.decks[0].id
+        reading = load_saved_reading('22.1,0.0,4.1', 3, deck_id)
+        save_string = encode_reading(reading)
+        
+        self.assertTrue(save_string.startswith('b1'))
+        self.assertEqual([(22, True), (0, False), (4, True)], parse_reading_string(save_string))
+        self.assertEqual([thrown['card'].id for thrown in reading],
+                         [thrown['card'].id for thrown in load_saved_reading(save_string, 3, deck_id)])
+        
+    def test_invalid_strings(self):
+        deck_id = self.decks[0].id
+        self.assertRaises(IndexError, load_saved_reading, '22.1,0.0', 3, deck_id)
+        self.assertRaises(IndexError, load_saved_reading, '22.1,0,4.1', 3, deck_id)
+        self.assertRaises(ValueError, load_saved_reading, '22.1,0.2,4.1', 3, deck_id)
+        self.assertRaises(ValueError, load_saved_reading, 'b1!!', 3, deck_id)
+        
+    def test_all_missing_cards_are_reported(self):
+        try:
+            load_saved_reading('22.1,40.0,50.1', 3, self.decks[0].id)
+        except Card.DoesNotExist as error:
+            self.assertTrue('40, 50' in str(error))
+        else:
+            self.fail('Missing cards were not reported.')
+            
+    def test_saved_reading_uses_fixed_number_of_queries(self):
+        def assemble():
+            assemble_reading(self.spread.id, str(self.decks[0].id), 1, 'b1LQAJ')
+        
+        # Spread, deck and spread lists, positions, saved cards, their major and minor arcana
+        # and their meanings
+        self.assertNumQueries(8, assemble)
+
+class NearestIndicesTest(TarotTestCase):
+    
+    def test_next_and_previous_wrap_around(self):
+        deck_id = self.decks[0].id
+        self.assertEqual({'next_index': 2, 'previous_index': 0}, get_nearest_indices(1, deck_id))
+        self.assertEqual({'next_index': 22, 'previous_index': 3}, get_nearest_indices(4, deck_id))
+        self.assertEqual({'next_index': 0, 'previous_index': 23}, get_nearest_indices(24, deck_id))
+        self.assertEqual({'next_index': 1, 'previous_index': 24}, get_nearest_indices(0))
+        
+        # Gaps in the deck are skipped
+        self.assertEqual({'next_index': 22, 'previous_index': 4}, get_nearest_indices(10, deck_id))
+        
+    def test_index_is_cached_and_kept_up_to_date(self):
+        deck = self.decks[0]
+        get_nearest_indices(4, deck.id)
+        self.assertNumQueries(0, get_nearest_indices, 4, deck.id)
+        
+        MajorArcana.objects.create(deck=deck, tarot_index=10, title='Major 10', caption='', 
+                                   description='', image='card.jpg')
+        self.assertEqual({'next_index': 10, 'previous_index': 3}, get_nearest_indices(4, deck.id))
+        self.assertEqual({'next_index': 22, 'previous_index': 3}, get_nearest_indices(4, self.decks[1].id))
+        
+        # Edits from another process are seen once the generation changes
+        Card.objects.filter(deck=deck, tarot_index=10).update(tarot_index=12)
+        fragments.invalidate()
+        self.assertEqual({'next_index': 12, 'previous_index': 3}, get_nearest_indices(4, deck.id))
+
+class NavigationTest(TarotTestCase):
+    
+    def test_deck_navigation(self):
+        deck = self.decks[0]
+        deck_navigation = navigation.get_deck_navigation(deck.id)
+        
+        self.assertEqual([0, 1, 2, 3, 4], [card.tarot_index for card in deck_navigation['majors_list']])
+        self.assertEqual([22, 23, 24], [card.tarot_index for card in deck_navigation['minors_list']])
+        self.assertEqual(0, deck_navigation['first_major'])
+        self.assertEqual(22, deck_navigation['first_minor'])
+        self.assertEqual([], deck_navigation['empty_suit_list'])
+        
+        # It is built from the suits and one ordered query for the cards
+        fragments.invalidate()
+        self.assertNumQueries(2, navigation.get_deck_navigation, deck.id)
+        
+        # The cached copy doesn't need any queries, including for the suit names
+        def read_navigation():
+            cached = navigation.get_deck_navigation(deck.id)
+            [card.get_name() for card in cached['minors_list']]
+        self.assertNumQueries(0, read_navigation)
+        
+    def test_navigation_is_invalidated(self):
+        deck = self.decks[0]
+        navigation.get_deck_navigation(deck.id)
+        self.assertEqual(2, len(navigation.get_related_cards(0)))
+        
+        suit = Suit.objects.create(deck=deck, suit=2, name='Cups')
+        self.assertEqual([suit], navigation.get_deck_navigation(deck.id)['empty_suit_list'])
+        
+        Card.objects.filter(tarot_index=0, deck=self.decks[1]).delete()
+        self.assertEqual([{'deck': deck.id, 'deck__name': deck.name}], navigation.get_related_cards(0))
+
+class SuitLoadingTest(TarotTestCase):
+    
+    def test_attach_suits(self):
+        Suit.objects.create(deck=self.decks[0], suit=2, name='Cups')
+        
+        self.assertNumQueries(2, lambda: attach_suits(Deck.objects.order_by('id')))
+        decks = attach_suits(Deck.objects.order_by('id'))
+        self.assertNumQueries(0, lambda: [deck.get_suit_names() for deck in decks])
+        self.assertEqual([['Wands', 'Cups'], ['Wands']], [deck.get_suit_names() for deck in decks])
+        
+    def test_deck_list_queries_suits_once(self):
+        for number in range(0, 5):
+            deck = Deck.objects.create(meaning_set=self.meaning_set, name='Extra %d' % number,
+                                       author='Test', description='')
+            Suit.objects.create(deck=deck, suit=1, name='Wands')
+            
+        # Count, page of decks and their suits
+        request = RequestFactory().get('/decks/')
+        self.assertNumQueries(3, views.deck_list, request)
+
+class SpreadTagTest(TarotTestCase):
+    
+    def test_tags_are_counted_in_one_query(self):
+        Spread.objects.create(title='Love triangle', author='Test', description='For LOVE and work.')
+        Spread.objects.create(title='Daily draw', author='Test', description='Advice on your day.')
+        
+        tags = ['love', 'work', 'daily', 'advice', 'choice']
+        self.assertNumQueries(1, count_spread_tags, tags)
+        self.assertEqual({'love': 1, 'work': 1, 'daily': 1, 'advice': 1, 'choice': 0}, 
+                         count_spread_tags(tags))
+        
+    def test_counts_match_the_facet_searches(self):
+        Spread.objects.create(title='Lovers', author='Test',
+                              description='The loved ones at the workplace.')
+        Spread.objects.create(title='Love and work', author='Test', description='')
+        
+        tags = ['love', 'work', 'lover', 'loved one']
+        counts = count_spread_tags(tags)
+        self.assertEqual({'love': 1, 'work': 1, 'lover': 1, 'loved one': 1}, counts)
+        for tag in tags:
+            query_list = []
+            apply_spread_search_filter({'search': tag}, query_list)
+            self.assertEqual(counts[tag], Spread.objects.filter(*query_list).count())
+        
+    def test_no_spreads(self):
+        Spread.objects.all().delete()
+        self.assertEqual({'love': 0}, count_spread_tags(['love']))
+
+class CardSearchTest(TarotTestCase):
+    
+    def search(self, term, model=Card):
+        query_list = []
+        apply_card_search_filter({'search': term}, query_list)
+        return model.objects.filter(*query_list)
+    
+    def test_search_matches_meaning_keywords_in_one_query(self):
+        other_set = MeaningSet.objects.create(title='Silly', author='Test', description='')
+        Meaning.objects.create(meaning_set=other_set, tarot_index=3, predictions='', 
+                               keywords='keyword 3', reversed_predictions='', reversed_keywords='')
+        
+        cards = self.search('keyword 2')
+        self.assertNumQueries(1, list, cards)
+        self.assertEqual([(2, deck.id) for deck in self.decks], 
+                         sorted((card.tarot_index, card.deck_id) for card in cards))
+        
+        # Meanings from a meaning set which no deck uses don't match anything
+        self.assertEqual([], list(self.search('keyword 3')))
+        
+    def test_search_matches_card_fields(self):
+        self.assertEqual(2, self.search('major 4').count())
+        self.assertEqual(2, self.search('keyword 22', MinorArcana).count())
+        self.assertEqual(0, self.search('keyword 22', MajorArcana).count())
+        
+    def test_search_words_can_be_in_different_fields(self):
+        Card.objects.filter(tarot_index=1).update(title='The Magician')
+        Meaning.objects.filter(tarot_index=1).update(keywords='Skill, will')
+        search.rebuild('cards')
+        
+        self.assertEqual(2, self.search('magician').count())
+        self.assertEqual(2, self.search('skill').count())
+        self.assertEqual(2, self.search('magician skill').count())
+        self.assertEqual(0, self.search('magician keyword').count())
+
+class SearchIndexTest(TarotTestCase):
+    
+    def search(self, name, query):
+        """ Returns the ids of the documents matching a query, most relevant first, the way
+            the lists sort them. """
+        
+        model = {'cards': Card, 'spreads': Spread}[name]
+        results = model.objects.filter(id__in=search.matching(name, query))
+        results = search.rank(results, name, query)
+        return [document_id for document_id, relevance 
+                in results.order_by('-relevance', 'id').values_list('id', 'relevance')]
+        
+    def test_tokenize(self):
+        self.assertEqual(['the', 'cup', 'cross', 'prophecy', 'box', 'wand', 'its', 'bus'],
+                         search.tokenize("<p>The Cups' CROSSES, prophecies:</p> boxes & wands it's bus"))
+        
+    def test_all_words_must_match_and_results_are_ranked(self):
+        deck = self.decks[0]
+        Card.objects.filter(deck=deck, tarot_index=3).update(title='The Empress', 
+                                                             description='A queen of cups')
+        Card.objects.filter(deck=deck, tarot_index=4).update(description='The emperor and empress')
+        search.rebuild('cards')
+        
+        empress = Card.objects.get(deck=deck, tarot_index=3).id
+        emperor = Card.objects.get(deck=deck, tarot_index=4).id
+        
+        # The title match ranks higher than the description match
+        self.assertEqual([empress, emperor], self.search('cards', 'empress'))
+        self.assertEqual([emperor], self.search('cards', 'Empress emperors'))
+        self.assertEqual([empress], self.search('cards', 'cup'))
+        self.assertEqual([], self.search('cards', 'empress unicorn'))
+        self.assertEqual([], self.search('cards', ''))
+        
+    def test_index_is_kept_up_to_date(self):
+        self.assertEqual([], self.search('spreads', 'horseshoe'))
+        spread = Spread.objects.create(title='Horseshoe', author='Test', description='')
+        self.assertEqual([spread.id], self.search('spreads', 'horseshoes'))
+        
+        meaning = Meaning.objects.get(tarot_index=0)
+        meaning.reversed_predictions = 'Recklessness.'
+        meaning.save()
+        self.assertEqual(2, len(self.search('cards', 'recklessness')))
+        
+        card = Card.objects.get(deck=self.decks[0], tarot_index=0)
+        card.delete()
+        self.assertEqual(1, len(self.search('cards', 'recklessness')))
+        
+    def test_many_matches_are_filtered_in_the_database(self):
+        # Many more matches than SQLite allows parameters in a query
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO diyTarot_searchterm (%s, document, field, word, weight) '
+                           'VALUES (%%s, %%s, %%s, %%s, %%s)' % connection.ops.quote_name('index'),
+                           [('cards', document, 'title', 'major', 4) 
+                            for document in range(100000, 102000)])
+        
+        query_list = []
+        apply_card_search_filter({'search': 'major'}, query_list)
+        self.assertNumQueries(1, lambda: list(Card.objects.filter(*query_list)))
+        self.assertEqual(10, Card.objects.filter(*query_list).count())
+        
+    def test_card_list_is_sorted_by_relevance(self):
+        card = Card.objects.get(deck=self.decks[1], tarot_index=1)
+        card.description = 'Not like major 4 at all.'
+        card.save()
+        
+        content = self.get_card_list({'search': 'major 4'})
+        self.assertTrue('<span class="active_filter">Relevance</span>' in content)
+        self.assertTrue('of 3 Results' in content)
+        
+        # The title matches come before the description match
+        self.assertTrue(content.index('Major 4, Second Deck.') < 
+                        content.index('Major 1, Second Deck.'))
+
+class ImageFile(object):
+    """ Stand-in for the file of an ImageField, with just the path and the url. """
+    
+    def __init__(self, path, url):
+        self.path = path
+        self.url = url
+        
+class ThumbnailTestCase(TestCase):
+    """ Base test case which creates a card image in a temporary directory. """
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.directory, 'card.jpg')
+        Image.new('RGB', (300, 500), 'red').save(self.image_path)
+        self.image_file = ImageFile(self.image_path, '/media/decks/1/card.jpg')
+        
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        
+class ThumbnailServiceTest(ThumbnailTestCase):
+    
+    def test_thumbnails_are_generated_in_the_background(self):
+        url = thumbnails.thumbnail_url(self.image_file, '85x150')
+        self.assertEqual('/media/decks/1/card.jpg', url)
+        
+        thumbnails._queue.join()
+        thumb_path = os.path.join(self.directory, 'thumbs', 'card_85x150_reversed.jpg')
+        self.assertEqual((85, 141), Image.open(thumb_path).size)
+        self.assertEqual('/media/decks/1/thumbs/card_85x150.jpg',
+                         thumbnails.thumbnail_url(self.image_file, '85x150'))
+        
+    def test_reversed_thumbnails_are_never_upright(self):
+        # The original is turned upside down until the thumbnail is ready
+        self.assertEqual(('/media/decks/1/card.jpg', True),
+                         thumbnails.thumbnail_source(self.image_file, '62x110', reverse=True))
+        
+        thumbnails._queue.join()
+        self.assertEqual(('/media/decks/1/thumbs/card_62x110_reversed.jpg', False),
+                         thumbnails.thumbnail_source(self.image_file, '62x110', reverse=True))
+        thumb_path = os.path.join(self.directory, 'thumbs', 'card_62x110_reversed.jpg')
+        self.assertEqual((62, 103), Image.open(thumb_path).size)
+        
+    def test_reversed_thumbnails_are_turned_while_locked(self):
+        os.mkdir(os.path.join(self.directory, 'thumbs'))
+        lock_path = os.path.join(self.directory, 'thumbs', '.card.jpg.lock')
+        open(lock_path, 'w').close()
+        
+        template = Template("{% load thumbnail %}"
+                            "<img src=\"{{ image|reversed_thumbnail:'62x110' }}\" "
+                            "style=\"{{ image|reversed_thumbnail_style:'62x110' }}\" />")
+        context = Context({'image': self.image_file})
+        for attempt in range(2):
+            self.assertEqual('<img src="/media/decks/1/card.jpg" '
+                             'style="transform: rotate(180deg);" />', template.render(context))
+            thumbnails._queue.join()
+        self.assertEqual(['.card.jpg.lock'], os.listdir(os.path.join(self.directory, 'thumbs')))
+        
+        os.unlink(lock_path)
+        template.render(context)
+        thumbnails._queue.join()
+        self.assertEqual('<img src="/media/decks/1/thumbs/card_62x110_reversed.jpg" style="" />',
+                         template.render(context))
+        
+    def test_warm_thumbnails_are_not_checked_on_disk(self):
+        thumbnails.generate_thumbnail(self.image_path, '62x110')
+        thumbnails.thumbnail_url(self.image_file, '62x110')
+        
+        # Once known, the thumbnail is used even if the files are gone
+        shutil.rmtree(os.path.join(self.directory, 'thumbs'))
+        self.assertEqual('/media/decks/1/thumbs/card_62x110.jpg',
+                         thumbnails.thumbnail_url(self.image_file, '62x110'))
+        
+    def test_derivatives_are_generated_together(self):
+        written = thumbnails.generate_derivatives(self.image_path, ['85x150', '62x110'])
+        self.assertEqual([('85x150', False, None), ('85x150', True, None), 
+                          ('62x110', False, None), ('62x110', True, None)], written)
+        self.assertEqual((62, 103), Image.open(os.path.join(self.directory, 'thumbs', 
+                                                           'card_62x110_reversed.jpg')).size)
+        
+        # Up to date thumbnails are skipped
+        self.assertEqual([('199x350', False, None)], thumbnails.generate_derivatives(
+                            self.image_path, ['85x150', '199x350'], [False], only_outdated=True))
+        
+    def test_thumbnails_are_not_generated_while_locked(self):
+        os.mkdir(os.path.join(self.directory, 'thumbs'))
+        lock_path = os.path.join(self.directory, 'thumbs', '.card.jpg.lock')
+        open(lock_path, 'w').close()
+        self.assertEqual([], thumbnails.generate_derivatives(self.image_path, ['62x110']))
+        
+        # An abandoned lock is taken over, and only the thumbnails are left behind
+        os.utime(lock_path, (0, 0))
+        self.assertEqual([('62x110', False, None), ('62x110', True, None)],
+                         thumbnails.generate_derivatives(self.image_path, ['62x110']))
+        self.assertEqual(['card_62x110.jpg', 'card_62x110_reversed.jpg'],
+                         sorted(os.listdir(os.path.join(self.directory, 'thumbs'))))
+        
+    def test_failed_images_are_retried_after_a_while(self):
+        broken_path = os.path.join(self.directory, 'broken.jpg')
+        open(broken_path, 'w').write('not an image')
+        
+        thumbnails.schedule_derivatives(broken_path)
+        thumbnails._queue.join()
+        self.assertEqual(1, thumbnails._failures[broken_path][0])
+        
+        # It isn't queued again until the backoff is over
+        thumbnails.schedule_derivatives(broken_path)
+        self.assertEqual(0, thumbnails._queue.qsize())
+        self.assertFalse(any(job[0] == broken_path for job in thumbnails._pending))
+        
+        thumbnails._failures[broken_path] = (1, 0)
+        thumbnails.schedule_derivatives(broken_path)
+        thumbnails._queue.join()
+        self.assertEqual(2, thumbnails._failures.pop(broken_path)[0])
+        
+    def test_only_owned_locks_are_released(self):
+        lock_path = os.path.join(self.directory, '.card.jpg.lock')
+        token = thumbnails._acquire_lock(lock_path)
+        self.assertEqual(None, thumbnails._acquire_lock(lock_path))
+        
+        # Another process took the lock over, so it isn't ours to release any more
+        open(lock_path, 'w').write('someone else')
+        thumbnails._release_lock(lock_path, token)
+        self.assertTrue(os.path.exists(lock_path))
+        
+        os.unlink(lock_path)
+        token = thumbnails._acquire_lock(lock_path)
+        thumbnails._release_lock(lock_path, token)
+        self.assertFalse(os.path.exists(lock_path))
+        
+    def test_cards_without_image_files_are_not_scheduled(self):
+        scheduled = []
+        schedule_derivatives = thumbnails.schedule_derivatives
+        thumbnails.schedule_derivatives = scheduled.append
+        try:
+            meaning_set = MeaningSet.objects.create(title='Serious', author='Test', description='')
+            deck = Deck.objects.create(meaning_set=meaning_set, name='First', author='Test', 
+                                       description='')
+            MajorArcana.objects.create(deck=deck, tarot_index=0, title='Fool', caption='', 
+                                       description='', image='missing.jpg')
+        finally:
+            thumbnails.schedule_derivatives = schedule_derivatives
+        self.assertEqual([], scheduled)
+        
+    @unittest.skipUnless(thumbnails.can_save('WEBP'), 'PIL cannot write WebP images here.')
+    def test_webp_derivatives_at_each_density(self):
+        self.assertEqual(['85x150', '170x300'], 
+                         [thumbnails.scale_size('85x150', density) for density in [1, 2]])
+        thumbnails.generate_derivatives(self.image_path, ['85x150', '170x300'], [False],
+                                        formats=[None, 'WEBP'])
+        thumb_path = os.path.join(self.directory, 'thumbs', 'card_170x300.webp')
+        self.assertEqual('WEBP', Image.open(thumb_path).format)
+        self.assertEqual((170, 283), Image.open(thumb_path).size)
+        
+        self.assertEqual('/media/decks/1/thumbs/card_85x150.webp 1x, '
+                         '/media/decks/1/thumbs/card_170x300.webp 2x',
+                         thumbnails.thumbnail_srcset(self.image_file, '85x150', 
+                                                     image_format='WEBP'))
+        
+    @unittest.skipUnless(thumbnails.can_save('WEBP'), 'PIL cannot write WebP images here.')
+    def test_picture_tag_only_offers_ready_thumbnails(self):
+        template = Template("{% load thumbnail %}"
+                            "{% picture image '62x110' reverse %}alt=\"{{ name }}\"{% endpicture %}")
+        context = Context({'image': self.image_file, 'reverse': True, 'name': 'Fool'})
+        self.assertEqual('<picture><img src="/media/decks/1/card.jpg" width="62" height="110" '
+                         'alt="Fool" style="transform: rotate(180deg);" /></picture>', 
+                         template.render(context))
+        
+        thumbnails._queue.join()
+        self.assertEqual('<picture><source type="image/webp" srcset="'
+                         '/media/decks/1/thumbs/card_62x110_reversed.webp 1x, '
+                         '/media/decks/1/thumbs/card_124x220_reversed.webp 2x" />'
+                         '<img src="/media/decks/1/thumbs/card_62x110_reversed.jpg" srcset="'
+                         '/media/decks/1/thumbs/card_62x110_reversed.jpg 1x, '
+                         '/media/decks/1/thumbs/card_124x220_reversed.jpg 2x" '
+                         'width="62" height="110" alt="Fool" /></picture>', 
+                         template.render(context))
+        
+class SpriteTest(TarotTestCase):
+    
+    def setUp(self):
+        super(SpriteTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        Image.new('RGB', (300, 500), 'red').save(os.path.join(self.directory, 'card.jpg'))
+        self.storage = sprites.default_storage
+        sprites.default_storage = FileSystemStorage(self.directory, '/media/')
+        sprites.invalidate()
+        
+    def tearDown(self):
+        sprites.default_storage = self.storage
+        sprites.invalidate()
+        shutil.rmtree(self.directory)
+        
+    def test_atlas_packs_every_card_upright_and_reversed(self):
+        deck = self.decks[0]
+        self.assertTrue(sprites.is_outdated(deck.id, '62x110'))
+        self.assertEqual(8, sprites.build_atlas(deck.id, '62x110'))
+        self.assertFalse(sprites.is_outdated(deck.id, '62x110'))
+        
+        atlas = Image.open(os.path.join(self.directory, 'diytarot', 'decks', str(deck.id), 
+                                        'sprites', 'sprite_62x110.jpg'))
+        self.assertEqual((13 * 62, 2 * 110), atlas.size)
+        
+        card = Card.objects.get(deck=deck, tarot_index=22)
+        url, x, y = sprites.get_sprite(card, '62x110', reverse=True)
+        self.assertTrue(url.startswith('/media/diytarot/decks/%d/sprites/sprite_62x110.jpg?' 
+                                       % deck.id))
+        self.assertEqual((5 * 62, 110), (x, y))
+        
+    def test_sprite_tag_falls_back_to_thumbnails(self):
+        card = Card.objects.get(deck=self.decks[0], tarot_index=1)
+        template = Template("{% load sprite %}{% sprite card '62x110' %}The {{ name }}{% endsprite %}")
+        
+        sprites.build_atlas(self.decks[0].id, '62x110')
+        self.assertTrue('aria-label="The Magician" title="The Magician" style="display: '
+                        'inline-block; width: 62px; height: 110px; background: url(' 
+                        in template.render(Context({'card': card, 'name': 'Magician'})))
+        self.assertTrue(template.render(Context({'card': card, 'name': 'Magician'}))
+                        .endswith('-62px 0px no-repeat;"></span>'))
+        
+        # The atlas is out of date once the card's image has changed
+        card.image = 'other.jpg'
+        self.assertFalse('card_sprite' in template.render(Context({'card': card, 
+                                                                   'name': 'Magician'})))
+        
+class WarmThumbnailsTest(TarotTestCase):
+    
+    def setUp(self):
+        super(WarmThumbnailsTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        Image.new('RGB', (300, 500), 'red').save(os.path.join(self.directory, 'card.jpg'))
+        self.storage = warm_thumbnails.default_storage
+        warm_thumbnails.default_storage = FileSystemStorage(self.directory, '/media/')
+        
+    def tearDown(self):
+        warm_thumbnails.default_storage = self.storage
+        shutil.rmtree(self.directory)
+        
+    def test_thumbnails_are_generated_once(self):
+        total = len(thumbnails.get_standard_sizes()) * len(thumbnails.get_standard_formats()) * 2
+        
+        stdout = StringIO()
+        call_command('warm_thumbnails', processes=1, stdout=stdout)
+        self.assertTrue('%d thumbnails of 1 images to generate, 0 already up to date.' % total
+                        in stdout.getvalue())
+        self.assertEqual(total, len(os.listdir(os.path.join(self.directory, 'thumbs'))))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'thumbs', 
+                                                    'card_85x150_reversed.jpg')))
+        
+        # Up to date thumbnails are skipped, until the image changes
+        stdout = StringIO()
+        call_command('warm_thumbnails', processes=1, stdout=stdout)
+        self.assertEqual('0 thumbnails of 0 images to generate, %d already up to date.\n' % total,
+                         stdout.getvalue())
+        
+        os.utime(os.path.join(self.directory, 'card.jpg'), (time.time() + 10, time.time() + 10))
+        stdout = StringIO()
+        call_command('warm_thumbnails', processes=1, stdout=stdout)
+        self.assertTrue('%d thumbnails of 1 images to generate' % total in stdout.getvalue())
+
+class RandomLineTest(TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'quotes.txt')
+        self.write('A long first quote, which used to make the next one more likely~Someone\n'
+                   '\n'
+                   'Short~Me\n')
+        
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        
+    def write(self, text):
+        quote_file = open(self.filename, 'w')
+        quote_file.write(text)
+        quote_file.close()
+        
+    def test_lines_are_loaded_once_and_reloaded_when_changed(self):
+        self.assertEqual(2, len(line_store.get_lines(self.filename)))
+        self.assertEqual(set(['Short', 'A long first quote, which used to make the next one '
+                              'more likely']), 
+                         set([random_quote(self.filename)[0] for i in range(100)]))
+        
+        self.write('Only~One\n')
+        os.utime(self.filename, (0, 0))
+        self.assertEqual(2, len(line_store.get_lines(self.filename)))
+        
+        # The file is checked again after a while
+        line_store._files[self.filename]['checked'] = 0
+        self.assertEqual(['Only~One'], line_store.get_lines(self.filename))
+        self.assertEqual(['Only', 'One'], random_quote(self.filename))
+        
+    def test_missing_files_give_nothing(self):
+        self.assertEqual('', line_store.random_line(os.path.join(self.directory, 'none.txt')))
+        
+class FragmentCacheTest(TarotTestCase):
+    
+    def test_lists_are_cached_until_data_changes(self):
+        self.assertEqual(['First', 'Second'], [deck['name'] for deck in fragments.get_deck_list()])
+        self.assertNumQueries(0, fragments.get_deck_list)
+        
+        Deck.objects.create(meaning_set=self.meaning_set, name='Third', author='Test', 
+                            description='')
+        self.assertEqual(['First', 'Second', 'Third'], 
+                         [deck['name'] for deck in fragments.get_deck_list()])
+        
+    def test_template_fragments_vary_on_variables(self):
+        template = Template("{% load fragment_cache %}"
+                            "{% cachefragment test name %}{{ name }} {{ count }}{% endcachefragment %}")
+        self.assertEqual('a 1', template.render(Context({'name': 'a', 'count': 1})))
+        self.assertEqual('a 1', template.render(Context({'name': 'a', 'count': 2})))
+        self.assertEqual('b 2', template.render(Context({'name': 'b', 'count': 2})))
+        
+        # Editing any of the data starts a new generation
+        Suit.objects.create(deck=self.decks[0], suit=2, name='Cups')
+        self.assertEqual('a 3', template.render(Context({'name': 'a', 'count': 3})))
+        
+class PageCacheTest(TarotTestCase):
+    
+    def test_unfiltered_deck_list_is_cached_until_data_changes(self):
+        request = RequestFactory().get('/decks/', {'page': '1'})
+        response = views.deck_list(request)
+        self.assertTrue('<!--late:diyTarot/quote.html-->' in response.content)
+        
+        # Only the quote is rendered again
+        self.assertNumQueries(0, views.deck_list, request)
+        cached = views.deck_list(request).content
+        self.assertEqual(page_cache.LATE_PATTERN.sub('', response.content), 
+                         page_cache.LATE_PATTERN.sub('', cached))
+        
+        # Other query parameters aren't cached
+        request = RequestFactory().get('/decks/', {'page': '1', 'other': 'x'})
+        self.assertNumQueries(3, views.deck_list, request)
+        
+        Deck.objects.create(meaning_set=self.meaning_set, name='Third', author='Test', 
+                            description='')
+        self.assertTrue('Third' in views.deck_list(RequestFactory().get('/decks/')).content)
+        
+    def test_missing_decks_and_spreads_redirect_to_the_lists(self):
+        response = views.deck_detail(RequestFactory().get('/decks/999/'), 999)
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(response['Location'].endswith('/diytarot/decks/'))
+        
+        request = RequestFactory().get('/reading/999/%d/' % self.decks[0].id)
+        request.session = {}
+        response = views.reading(request, 999, self.decks[0].id)
+        self.assertEqual(302, response.status_code)
+        self.assertTrue(response['Location'].endswith('/diytarot/spreads/'))
+        
+class ConditionalGetTest(TarotTestCase):
+    
+    def test_card_detail_is_not_modified_until_data_changes(self):
+        deck = self.decks[0]
+        response = views.card_detail(RequestFactory().get('/cards/1/%d/' % deck.id), 1, deck.id)
+        self.assertEqual(200, response.status_code)
+        
+        request = RequestFactory().get('/cards/1/%d/' % deck.id, 
+                                       HTTP_IF_NONE_MATCH=response['ETag'],
+                                       HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertNumQueries(0, lambda: self.assertEqual(
+                                    304, views.card_detail(request, 1, deck.id).status_code))
+        
+        Meaning.objects.filter(tarot_index=1).delete()
+        Meaning.objects.create(meaning_set=self.meaning_set, tarot_index=1, predictions='New.',
+                               keywords='new', reversed_predictions='', reversed_keywords='')
+        self.assertEqual(200, views.card_detail(request, 1, deck.id).status_code)
+        
+    def test_only_saved_readings_are_conditional(self):
+        deck = self.decks[0]
+        request = RequestFactory().get('/reading/%d/%d/' % (self.spread.id, deck.id))
+        request.session = {}
+        self.assertFalse(views.reading(request, self.spread.id, deck.id).has_header('ETag'))
+        
+        request = RequestFactory().get('/reading/%d/%d/' % (self.spread.id, deck.id), 
+                                       {'cards': 'b1LQAJ'})
+        request.session = {}
+        etag = views.reading(request, self.spread.id, deck.id)['ETag']
+        
+        request.META['HTTP_IF_NONE_MATCH'] = etag
+        self.assertEqual(304, views.reading(request, self.spread.id, deck.id).status_code)
+        
+        # The page shows the preferred deck, so it's different once that changes
+        request.session['deck'] = self.decks[1].id
+        self.assertEqual(200, views.reading(request, self.spread.id, deck.id).status_code)
+        
+class CardSummaryTest(TarotTestCase):
+    
+    def test_summaries_follow_cards_decks_and_suits(self):
+        card = MinorArcana.objects.get(deck=self.decks[0], tarot_index=23)
+        summary = CardSummary.objects.get(card=card.id)
+        self.assertEqual(('2 of Wands', 'First', 1, 2), 
+                         (summary.name, summary.deck_name, summary.suit, summary.rank))
+        
+        suit = card.suit
+        suit.name = 'Batons'
+        suit.save()
+        deck = self.decks[0]
+        deck.name = 'Renamed'
+        deck.save()
+        
+        summary = CardSummary.objects.get(card=card.id)
+        self.assertEqual(('2 of Batons', 'Renamed'), (summary.name, summary.deck_name))
+        
+        card.delete()
+        self.assertFalse(CardSummary.objects.filter(card=card.id).exists())
+        
+    def test_summaries_are_attached_with_one_query(self):
+        cards = list(Card.objects.filter(deck=self.decks[1]).order_by('tarot_index'))
+        self.assertNumQueries(1, attach_summaries, cards)
+        self.assertEqual(['Major 0', 'Major 1', 'Major 2', 'Major 3', 'Major 4', 
+                          '1 of Wands', '2 of Wands', '3 of Wands'],
+                         [card.summary.name for card in cards])
+        
+        # Missing summaries are built when needed, but only saved by build_card_summaries
+        CardSummary.objects.all().delete()
+        self.assertEqual('3 of Wands', attach_summaries(cards)[-1].summary.name)
+        self.assertFalse(CardSummary.objects.exists())
+        
+        call_command('build_card_summaries')
+        self.assertEqual(16, CardSummary.objects.count())
+        self.assertEqual('3 of Wands', CardSummary.objects.get(pk=cards[-1].pk).name)
+        
+    def test_lists_fail_until_every_card_has_a_summary(self):
+        CardSummary.objects.filter(card__deck=self.decks[1], tarot_index=0).delete()
+        fragments.invalidate()
+        self.assertRaises(ImproperlyConfigured, self.get_card_list)
+        request = RequestFactory().get('/decks/%d/' % self.decks[0].id)
+        self.assertRaises(ImproperlyConfigured, views.deck_detail, request, self.decks[0].id)
+        
+        call_command('build_card_summaries')
+        self.assertTrue('of 16 Results' in self.get_card_list())
+        
+    def test_card_lists_are_shown_from_the_summaries(self):
+        # The summaries and the meanings, once the counts and the menus are cached
+        self.get_card_list({'cards': 'minors', 'order_by': 'rank'})
+        self.assertNumQueries(2, self.get_card_list, {'cards': 'minors', 'order_by': 'rank'})
+        
+        content = self.get_card_list({'cards': 'minors', 'order_by': 'rank', 'suit': '1'})
+        self.assertTrue('1 of Wands</a>:' in content)
+        self.assertTrue('keyword 22' in content)
+        self.assertEqual(['1', '1', '2', '2', '3', '3'], 
+                         re.findall(r'(\d) of Wands</a>:', content))
+        
+class DowncastTest(TarotTestCase):
+    
+    def test_cards_are_downcast_in_two_queries(self):
+        cards = list(Card.objects.filter(deck=self.decks[0]).order_by('-tarot_index'))
+        
+        downcast = []
+        self.assertNumQueries(2, lambda: downcast.extend(downcast_cards(cards)))
+        self.assertEqual([card.pk for card in cards], [card.pk for card in downcast])
+        self.assertEqual([MinorArcana] * 3 + [MajorArcana] * 5, 
+                         [type(card) for card in downcast])
+        
+        # The suits and decks are loaded along with them, for the names
+        self.assertNumQueries(0, lambda: [(card.get_name(), card.deck.name) for card in downcast])
+        self.assertEqual('3 of Wands', downcast[0].get_name())
+        
+    def test_minor_arcana_only_need_one_query(self):
+        cards = list(Card.objects.filter(deck=self.decks[0], tarot_index__gt=21))
+        self.assertNumQueries(1, downcast_cards, cards)
+        self.assertNumQueries(0, downcast_cards, downcast_cards(cards))
+        
+class KeysetPaginationTest(TarotTestCase):
+    
+    def walk(self, pages, cursor_name):
+        page = pages.page()
+        if cursor_name == 'previous_cursor':
+            page = pages.last_page()
+        
+        walked = [page.object_list]
+        while getattr(page, cursor_name)():
+            page = pages.page(getattr(page, cursor_name)())
+            walked.append(page.object_list)
+        return walked
+    
+    def test_pages_follow_the_sort_order(self):
+        cards = MinorArcana.objects.select_related('suit')
+        pages = KeysetPaginator(cards, 4, ['rank', 'suit__suit'])
+        expected = [card.pk for card in cards.order_by('rank', 'suit__suit', 'pk')]
+        
+        forwards = self.walk(pages, 'next_cursor')
+        self.assertEqual([4, 2], [len(object_list) for object_list in forwards])
+        self.assertEqual(expected, [card.pk for object_list in forwards for card in object_list])
+        
+        # Going back from the last page, the pages line up with the end instead
+        backwards = self.walk(pages, 'previous_cursor')
+        backwards.reverse()
+        self.assertEqual([2, 4], [len(object_list) for object_list in backwards])
+        self.assertEqual(expected, [card.pk for object_list in backwards for card in object_list])
+        
+    def test_null_keys_are_paged_through(self):
+        # The major arcana have no rank or suit
+        summaries = CardSummary.objects.all()
+        pages = KeysetPaginator(summaries, 5, ['rank', 'suit'])
+        expected = [summary.pk for summary in summaries.order_by('rank', 'suit', 'pk')]
+        
+        forwards = self.walk(pages, 'next_cursor')
+        self.assertEqual([5, 5, 5, 1], [len(object_list) for object_list in forwards])
+        self.assertEqual(expected, [card.pk for object_list in forwards for card in object_list])
+        
+        backwards = self.walk(pages, 'previous_cursor')
+        backwards.reverse()
+        self.assertEqual(expected, [card.pk for object_list in backwards for card in object_list])
+        
+        pages = KeysetPaginator(summaries, 5, ['-rank', 'suit'])
+        expected = [summary.pk for summary in summaries.order_by('-rank', 'suit', 'pk')]
+        forwards = self.walk(pages, 'next_cursor')
+        self.assertEqual(expected, [card.pk for object_list in forwards for card in object_list])
+        
+    def test_card_list_sorted_by_rank_links_to_every_card(self):
+        content = self.get_card_list({'order_by': 'rank'})
+        names = re.findall(r'([\w ]+), (?:First|Second) Deck\.', content)
+        next_link = re.search(r'page=([\w-]+)">Next', content)
+        while next_link is not None:
+            content = self.get_card_list({'order_by': 'rank', 'page': next_link.group(1)})
+            next_link = re.search(r'page=([\w-]+)">Next', content)
+            names += re.findall(r'([\w ]+), (?:First|Second) Deck\.', content)
+        self.assertEqual(16, len(names))
+        
+    def test_spreads_with_the_same_size_are_paged_through(self):
+        for index in range(12):
+            spread = Spread.objects.create(title='Spread %d' % index, author='Test', description='')
+            if index % 3 == 0:
+                CardPosition.objects.create(spread=spread, index=1, x_coordinate=0, y_coordinate=0,
+                                            title='Position 1', description='')
+        self.assertEqual(3, Spread.objects.get(pk=self.spread.pk).size)
+        
+        pages = KeysetPaginator(Spread.objects.all(), 5, ['size', 'pk'])
+        expected = [spread.pk for spread in Spread.objects.order_by('size', 'pk')]
+        
+        forwards = self.walk(pages, 'next_cursor')
+        self.assertEqual([5, 5, 3], [len(object_list) for object_list in forwards])
+        self.assertEqual(expected, [spread.pk for object_list in forwards for spread in object_list])
+        
+        backwards = self.walk(pages, 'previous_cursor')
+        backwards.reverse()
+        self.assertEqual(expected, [spread.pk for object_list in backwards for spread in object_list])
+        
+        # Removing a position moves its spread to the smaller ones
+        CardPosition.objects.filter(spread=self.spread, index=3).delete()
+        self.assertEqual(2, Spread.objects.get(pk=self.spread.pk).size)
+        
+    def test_pages_cost_one_query_without_the_count(self):
+        pages = KeysetPaginator(Card.objects.all(), 5, ['tarot_index', 'deck'])
+        cursor = pages.page().next_cursor()
+        
+        self.assertNumQueries(1, pages.page, cursor)
+        self.assertNumQueries(1, lambda: pages.count)
+        self.assertEqual(16, pages.count)
+        self.assertEqual(3, KeysetPaginator(Card.objects.all(), 5, ['tarot_index'], 
+                                            count=lambda: 3).count)
+        
+    def test_invalid_cursors_show_the_first_page(self):
+        pages = KeysetPaginator(Spread.objects.all(), 10, ['title'])
+        
+        for cursor in ['2', 'not a cursor', 'W10', pages.get_cursor(self.spread, 'x')]:
+            active_options = QueryDict('page=%s' % cursor).copy()
+            page = get_keyset_page(active_options, pages)
+            self.assertEqual([self.spread], page.object_list)
+            self.assertFalse('page' in active_options)
+            
+    def test_card_list_links_to_the_next_page(self):
+        content = self.get_card_list()
+        self.assertTrue('of 16 Results' in content)
+        self.assertTrue('Major 4, Second Deck.' in content)
+        
+        cursor = re.search(r'page=([\w-]+)">Next', content).group(1)
+        content = self.get_card_list({'page': cursor})
+        self.assertTrue('3 of Wands, Second Deck.' in content)
+        self.assertFalse('Major 4, Second Deck.' in content)
+        
+class LookupConstraintTest(TarotTestCase):
+    
+    def test_duplicates_are_rejected(self):
+        deck = self.decks[0]
+        self.assertRaises(IntegrityError, Card.objects.create, deck=deck, tarot_index=0, 
+                          title='Fool', caption='', description='', image='card.jpg')
+        self.assertRaises(IntegrityError, Suit.objects.create, deck=deck, suit=1, name='Cups')
+        self.assertRaises(IntegrityError, Meaning.objects.create, meaning_set=self.meaning_set, 
+                          tarot_index=0, predictions='', keywords='', reversed_predictions='', 
+                          reversed_keywords='')
+        self.assertRaises(IntegrityError, CardPosition.objects.create, spread=self.spread, 
+                          index=1, x_coordinate=0, y_coordinate=0, title='', description='')
+
+def rebuild_tables(models):
+    """ Creates the tables of the given models again from their current definition, keeping
+        their rows. """
+    
+    quote_name = connection.ops.quote_name
+    style = no_style()
+    cursor = connection.cursor()
+    for model in models:
+        table = quote_name(model._meta.db_table)
+        copy = quote_name(model._meta.db_table + '_copy')
+        cursor.execute('CREATE TABLE %s AS SELECT * FROM %s' % (copy, table))
+        cursor.execute('DROP TABLE %s' % table)
+        
+        statements = connection.creation.sql_create_model(model, style, set(get_models()))[0]
+        statements += connection.creation.sql_indexes_for_model(model, style)
+        for sql in statements:
+            cursor.execute(sql)
+        cursor.execute('INSERT INTO %s SELECT * FROM %s' % (table, copy))
+        cursor.execute('DROP TABLE %s' % copy)
+    transaction.commit_unless_managed()
+
+class AddLookupConstraintsTest(TransactionTestCase):
+    """ Runs add_lookup_constraints on tables created before the constraints were declared.
+        Creating tables commits, so this can't run in a transaction like the other tests. """
+    
+    def setUp(self):
+        meaning_set = MeaningSet.objects.create(title='Serious', author='Test', description='')
+        self.deck = Deck.objects.create(meaning_set=meaning_set, name='First', author='Test',
+                                        description='')
+        Suit.objects.create(deck=self.deck, suit=1, name='Wands')
+        
+        restore = strip_lookup_constraints()
+        try:
+            rebuild_tables(UNIQUE_TOGETHER)
+        finally:
+            restore()
+        
+    def tearDown(self):
+        rebuild_tables(UNIQUE_TOGETHER)
+        
+    def test_constraints_are_added_once_duplicates_are_removed(self):
+        Suit.objects.create(deck=self.deck, suit=1, name='Cups')
+        stderr = StringIO()
+        self.assertRaises(SystemExit, call_command, 'add_lookup_constraints', stderr=stderr)
+        self.assertTrue('2 rows of diyTarot_suit have deck_id = %d, suit = 1' % self.deck.id
+                        in stderr.getvalue())
+        
+        Suit.objects.filter(name='Cups').delete()
+        for expected in ['Created', 'already exists']:
+            stdout = StringIO()
+            call_command('add_lookup_constraints', stdout=stdout)
+            self.assertEqual(5, stdout.getvalue().count(expected))
+        self.assertRaises(IntegrityError, Suit.objects.create, deck=self.deck, suit=1, name='Cups')
+
+class SuitMenuTest(TarotTestCase):
+    
+    def test_card_list_names_suits_after_the_session_deck(self):
+        # The first deck by name is no longer the first one by id
+        Deck.objects.filter(pk=self.decks[0].pk).update(name='Zodiac')
+        suit = Suit.objects.get(deck=self.decks[1])
+        suit.name = 'Batons'
+        suit.save()
+        
+        content = self.get_card_list({'cards': 'minors'})
+        self.assertTrue('&suit=1">\n            Wands</a>' in content)
+        self.assertFalse('&suit=1">\n            Batons</a>' in content)
+        
+        content = self.get_card_list({'cards': 'minors'}, {'deck': self.decks[1].id})
+        self.assertTrue('&suit=1">\n            Batons</a>' in content)
+        
+class CountCacheTest(TarotTestCase):
+    
+    def test_counts_are_made_once_per_filters(self):
+        cards = Card.objects.filter(deck=self.decks[0].id, tarot_index__gt=21)
+        count = lambda filter_args: fragments.get_count('cards', cards, filter_args)
+        
+        self.assertNumQueries(1, count, {'deck': self.decks[0].id, 'tarot_index__gt': 21})
+        self.assertNumQueries(0, count, {'tarot_index__gt': '21', 'deck': str(self.decks[0].id)})
+        self.assertEqual(3, count({'deck': self.decks[0].id, 'tarot_index__gt': 21}))
+        
+        # Other filters are counted separately
+        self.assertNumQueries(1, count, {'deck': self.decks[0].id})
+        
+    def test_search_filters_are_normalized(self):
+        spreads = Spread.objects.all()
+        count = lambda query_list: fragments.get_count('spreads', spreads, query_list=query_list)
+        
+        self.assertNumQueries(1, count, [Q(id__in=set([3, 1, 2])), Q(title='Three')])
+        self.assertNumQueries(0, count, [Q(title='Three'), Q(id__in=[2, 3, 1])])
+        self.assertNumQueries(1, count, [Q(id__in=[2, 3, 1]) | Q(title='Three')])
+        
+    def test_counts_are_made_again_after_edits(self):
+        cards = Card.objects.filter(deck=self.decks[0].id)
+        pages = lambda: CountedPaginator(cards, 10, count=lambda: fragments.get_count(
+                                                        'cards', cards, {'deck': self.decks[0].id}))
+        self.assertEqual(8, pages().count)
+        self.assertNumQueries(0, lambda: pages().page(1))
+        
+        MajorArcana.objects.create(deck=self.decks[0], tarot_index=5, title='Major 5',
+                                   caption='', description='', image='card.jpg')
+        self.assertEqual(9, pages().count)
@@ -0,0 +1,458 @@
+""" This module is the thumbnail service used by the thumbnail template filters. Thumbnails
+    are stored next to the original image, in a "thumbs" subdirectory, with the size (and
+    whether the card is reversed) appended to the original name. So an input of 
+    ("C:/haters/your_mom.jpg", "100x100") would produce "C:/haters/thumbs/your_mom_100x100.jpg".
+    
+    What is known about each thumbnail is kept in memory, along with the modification time
+    of its source image, and the filesystem is only checked again after a while, so warm
+    thumbnails don't cost any system calls while rendering a page. Missing or outdated 
+    thumbnails are generated by background worker threads, and until they are ready the 
+    URL of the original image is used instead, turned upside down with CSS for reversed
+    cards. Each image is decoded only once to generate all of its thumbnails.
+    
+    Besides the source format, thumbnails are also made in the other formats of 
+    DIYTAROT_THUMBNAIL_FORMATS (WebP by default, if PIL can write it), with that format's 
+    extension instead of the original one, and at every pixel density of 
+    DIYTAROT_THUMBNAIL_DENSITIES, a 2x thumbnail of '85x150' simply being one of '170x300'. """
+
+import errno
+import logging
+import os
+import tempfile
+import threading
+import time
+import Queue
+import Image
+from django.conf import settings
+
+# How long, in seconds, to trust what is known about a thumbnail before checking the 
+# filesystem again in case the source image has changed.
+RECHECK_INTERVAL = getattr(settings, 'DIYTAROT_THUMBNAIL_RECHECK_INTERVAL', 60)
+
+# How long, in seconds, before a lock on generating an image's thumbnails is considered 
+# abandoned by a process which died.
+LOCK_TIMEOUT = 60
+
+# How long, in seconds, to wait before trying again to generate the thumbnails of an image
+# which failed, doubled after each further failure up to FAILURE_BACKOFF_MAX.
+FAILURE_BACKOFF = 60
+FAILURE_BACKOFF_MAX = 60 * 60 * 24
+
+# Number of background threads generating thumbnails
+WORKER_COUNT = getattr(settings, 'DIYTAROT_THUMBNAIL_WORKERS', 2)
+
+# Whether thumbnails are generated in the background. If not, they are generated while 
+# rendering, the first time they are needed.
+ASYNC = getattr(settings, 'DIYTAROT_THUMBNAIL_ASYNC', True)
+
+# Formats the thumbnails are also made in, besides the format of the source image, if PIL 
+# can write them.
+FORMATS = getattr(settings, 'DIYTAROT_THUMBNAIL_FORMATS', ('WEBP',))
+
+# Pixel densities the thumbnails are made at, for high resolution screens
+DENSITIES = getattr(settings, 'DIYTAROT_THUMBNAIL_DENSITIES', (1, 2))
+
+# Quality of WebP thumbnails, and whether they are lossless instead
+WEBP_QUALITY = getattr(settings, 'DIYTAROT_THUMBNAIL_WEBP_QUALITY', 80)
+WEBP_LOSSLESS = getattr(settings, 'DIYTAROT_THUMBNAIL_WEBP_LOSSLESS', False)
+
+# File extensions and MIME types of the formats thumbnails can be made in
+FORMAT_EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg', 'PNG': '.png'}
+MIME_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+# Thumbnail sizes used by the templates. The reading layout size is calculated separately,
+# by calculate_layout.
+TEMPLATE_SIZES = ('85x150', '199x350', '62x110')
+
+# Maps (path, size, reverse, format) to a dictionary with the modification time of the source 
+# image, when that was last checked, and whether the thumbnail is ready.
+_metadata = {}
+
+# Maps the path of each image whose thumbnails failed to (number of failures in a row, 
+# time before which it isn't tried again).
+_failures = {}
+
+_lock = threading.Lock()
+_pending = set()
+_queue = Queue.Queue()
+_workers = []
+
+logger = logging.getLogger('diyTarot.thumbnails')
+
+def parse_size(size):
+    """ Parses a size string like '85x150' into a tuple of integers. """
+    
+    return tuple([int(x) for x in size.split('x')])
+
+def scale_size(size, density):
+    """ Returns the size string of a thumbnail at the given pixel density, which is just a 
+        larger size. """
+    
+    return '%dx%d' % tuple([x * density for x in parse_size(size)])
+
+def get_thumbnail_name(file_name, size, reverse=False, image_format=None):
+    """ Returns the file name of a thumbnail of the given image file name. If an image
+        format is given, the thumbnail has that format's extension. """
+    
+    base_name, file_format = os.path.splitext(file_name)
+    if image_format is not None:
+        file_format = FORMAT_EXTENSIONS[image_format]
+    if reverse:
+        return base_name + '_' + size + '_reversed' + file_format
+    else:
+        return base_name + '_' + size + file_format
+
+def get_thumbnail_path(file_path, size, reverse=False, image_format=None):
+    """ Returns the full path of a thumbnail of the image at file_path. """
+    
+    file_head, file_name = os.path.split(file_path)
+    return os.path.join(file_head, 'thumbs', 
+                        get_thumbnail_name(file_name, size, reverse, image_format))
+
+def get_thumbnail_url(image_url, size, reverse=False, image_format=None):
+    """ Returns the URL of a thumbnail of the image with the given URL. """
+    
+    # The URL of the thumbnail is built the same way as its path, since the image filename 
+    # part is the same for both url and file path.
+    url_head, file_name = os.path.split(image_url)
+    return os.path.join(url_head, 'thumbs', 
+                        get_thumbnail_name(file_name, size, reverse, image_format))
+
+def is_up_to_date(file_path, thumb_path):
+    """ Returns True if the thumbnail exists and is more recent than its source image. """
+    
+    try:
+        return os.path.getmtime(thumb_path) >= os.path.getmtime(file_path)
+    except OSError:
+        return False
+
+def get_standard_sizes():
+    """ Returns every thumbnail size used by the templates, including the size of the cards
+        in the reading layout, at every pixel density. """
+    
+    # Imported here since the functions module indirectly imports this one
+    from functions import calculate_layout
+    
+    sizes = []
+    layout_size = calculate_layout([], 0, 0)['sizes']['thumbnail_string']
+    for size in list(TEMPLATE_SIZES) + [layout_size]:
+        for density in DENSITIES:
+            if scale_size(size, density) not in sizes:
+                sizes.append(scale_size(size, density))
+    return sizes
+
+def can_save(image_format):
+    """ Returns True if PIL can write images in the given format. """
+    
+    Image.init()
+    return image_format in Image.SAVE
+
+def get_standard_formats():
+    """ Returns the formats thumbnails are made in: None for the format of the source 
+        image, followed by the other formats which PIL can write. """
+    
+    return [None] + [image_format for image_format in FORMATS if can_save(image_format)]
+
+def _save(image, thumb_path, image_format):
+    """ Saves an image to a temporary file next to thumb_path, then renames it into place,
+        so that nobody ever sees (or serves) a partially written thumbnail. """
+    
+    thumb_head, thumb_name = os.path.split(thumb_path)
+    handle, temp_path = tempfile.mkstemp(prefix='.' + thumb_name, dir=thumb_head)
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            if image_format == 'WEBP':
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA')
+                image.save(temp_file, image_format, quality=WEBP_QUALITY, 
+                           lossless=WEBP_LOSSLESS, method=4)
+            else:
+                try:
+                    image.save(temp_file, image_format, quality=90, optimize=1)
+                except:
+                    temp_file.seek(0)
+                    temp_file.truncate()
+                    image.save(temp_file, image_format, quality=90)
+        os.rename(temp_path, thumb_path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+def _read_lock(lock_path):
+    """ Returns the owner written in a lock file, or None if it can't be read. """
+    
+    try:
+        with open(lock_path) as lock_file:
+            return lock_file.read()
+    except IOError:
+        return None
+
+def _acquire_lock(lock_path):
+    """ Tries to create the lock file for generating an image's thumbnails, which only one
+        process (or thread) can do at once. The lock file holds a token naming its owner.
+        A lock left behind by a process which died is taken over once it is older than 
+        LOCK_TIMEOUT. Returns the token if the lock was acquired, or None. """
+    
+    token = '%d:%d:%s' % (os.getpid(), threading.current_thread().ident, 
+                          os.urandom(8).encode('hex'))
+    
+    for attempt in range(2):
+        try:
+            handle = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        else:
+            os.write(handle, token)
+            os.close(handle)
+            return token
+        
+        try:
+            if time.time() - os.path.getmtime(lock_path) <= LOCK_TIMEOUT:
+                return None
+        except OSError:
+            continue
+        
+        # Move the stale lock out of the way rather than deleting it, since another process
+        # may have replaced it with its own in the meantime. If the lock that was moved 
+        # isn't the stale one, it is put back.
+        stale_owner = _read_lock(lock_path)
+        moved_path = '%s.%s' % (lock_path, token.replace(':', '.'))
+        try:
+            os.rename(lock_path, moved_path)
+        except OSError:
+            continue
+        
+        if _read_lock(moved_path) != stale_owner:
+            try:
+                os.link(moved_path, lock_path)
+            except OSError:
+                pass
+            os.unlink(moved_path)
+            return None
+        os.unlink(moved_path)
+        
+    return None
+
+def _release_lock(lock_path, token):
+    """ Deletes a lock file, unless it was taken over by another process since. """
+    
+    if _read_lock(lock_path) == token:
+        os.unlink(lock_path)
+
+def generate_derivatives(file_path, sizes, orientations=(False, True), only_outdated=False,
+                         formats=(None,)):
+    """ Generates the thumbnails of the image at file_path for every size, orientation 
+        (False for upright, True for reversed) and format (None for the source format) 
+        requested, decoding the image only once. JPEG images are decoded directly at a 
+        reduced scale which is still large enough for the largest size, which is much cheaper
+        than decoding them in full. If only_outdated is True, the thumbnails that are already
+        more recent than the image are skipped.
+        
+        Only one process at a time generates the thumbnails of an image, using a lock file,
+        and if another one is already doing it nothing is done here. Each thumbnail is 
+        written to a temporary file and renamed into place. Returns the list of 
+        (size, reverse, format) tuples that were written. """
+    
+    def outdated(wanted):
+        return [(size, reverse, image_format) for size, reverse, image_format in wanted 
+                if not is_up_to_date(file_path, 
+                                     get_thumbnail_path(file_path, size, reverse, image_format))]
+    
+    wanted = [(size, reverse, image_format) 
+              for size in sizes for reverse in orientations for image_format in formats]
+    if only_outdated:
+        wanted = outdated(wanted)
+    if len(wanted) == 0:
+        return []
+    
+    # Create the thumbs subdirectory, unless it's already there (possibly because another
+    # process has just created it).
+    thumb_head = os.path.join(os.path.dirname(file_path), 'thumbs')
+    try:
+        os.mkdir(thumb_head)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    
+    lock_path = os.path.join(thumb_head, '.%s.lock' % os.path.basename(file_path))
+    token = _acquire_lock(lock_path)
+    if token is None:
+        return []
+    
+    try:
+        # Another process may have finished the thumbnails while we were getting the lock
+        if only_outdated:
+            wanted = outdated(wanted)
+        if len(wanted) == 0:
+            return []
+        
+        image = Image.open(file_path)
+        source_format = image.format
+        
+        # Draft mode only applies to JPEGs, and is ignored for other formats
+        largest = max([parse_size(size) for size, reverse, image_format in wanted])
+        image.draft(image.mode, largest)
+        image.load()
+        
+        written = []
+        for size in sorted(set([wanted_size for wanted_size, reverse, image_format in wanted]), 
+                           key=parse_size, reverse=True):
+            resized = image.copy()
+            resized.thumbnail(parse_size(size), Image.ANTIALIAS)
+            
+            for reverse in orientations:
+                wanted_formats = [image_format for image_format in formats 
+                                  if (size, reverse, image_format) in wanted]
+                if len(wanted_formats) == 0:
+                    continue
+                
+                # If reversed is true make a reversed thumbnail (flipped in the y direction)
+                if reverse:
+                    output = resized.rotate(180)
+                else:
+                    output = resized
+                    
+                for image_format in wanted_formats:
+                    _save(output, get_thumbnail_path(file_path, size, reverse, image_format), 
+                          image_format or source_format)
+                    written.append((size, reverse, image_format))
+                
+        return written
+    
+    finally:
+        _release_lock(lock_path, token)
+
+def generate_thumbnail(file_path, size, reverse=False, image_format=None):
+    """ Resizes the image at file_path to fit within size, rotating it if it is reversed,
+        and saves the result at the thumbnail's path. """
+    
+    generate_derivatives(file_path, [size], [reverse], formats=[image_format])
+
+def _worker():
+    """ Background thread which generates the thumbnails put in the queue. """
+    
+    while True:
+        job = _queue.get()
+        file_path, sizes, formats = job
+        try:
+            generate_derivatives(file_path, sizes, only_outdated=True, formats=formats)
+        except Exception:
+            logger.exception('Generating the thumbnails of %s failed.', file_path)
+            with _lock:
+                failures = _failures.get(file_path, (0, 0))[0] + 1
+                backoff = min(FAILURE_BACKOFF * 2 ** (failures - 1), FAILURE_BACKOFF_MAX)
+                _failures[file_path] = (failures, time.time() + backoff)
+        else:
+            with _lock:
+                _failures.pop(file_path, None)
+        
+        # Check what is actually there, since another process may still be generating them
+        with _lock:
+            _pending.discard(job)
+            for size in sizes:
+                for reverse in [False, True]:
+                    for image_format in formats:
+                        entry = _metadata.get((file_path, size, reverse, image_format))
+                        if entry is not None:
+                            thumb_path = get_thumbnail_path(file_path, size, reverse, 
+                                                            image_format)
+                            entry['ready'] = is_up_to_date(file_path, thumb_path)
+                            entry['checked'] = time.time()
+        _queue.task_done()
+
+def schedule_derivatives(file_path, sizes=None):
+    """ Puts the thumbnails of an image in the queue to be generated in the background, in
+        every standard size (plus any other sizes given) and format, upright and reversed, 
+        unless they are already waiting or the image failed recently. Starts the worker
+        threads the first time. Does nothing if generation isn't asynchronous, since the 
+        thumbnails are then made when needed. """
+    
+    if not ASYNC:
+        return
+    
+    job = (file_path, tuple(sorted(set(get_standard_sizes() + list(sizes or [])))),
+           tuple(get_standard_formats()))
+    with _lock:
+        if job in _pending:
+            return
+        if file_path in _failures and time.time() < _failures[file_path][1]:
+            return
+        _pending.add(job)
+        
+        if len(_workers) == 0:
+            for number in range(WORKER_COUNT):
+                worker = threading.Thread(target=_worker, name='thumbnail-worker-%d' % number)
+                worker.daemon = True
+                worker.start()
+                _workers.append(worker)
+                
+    _queue.put(job)
+
+def ready_thumbnail_url(image_file, size, reverse=False, image_format=None):
+    """ Returns the URL of a thumbnail of an image field file if it is ready, or None. If it
+        isn't ready yet, all of the image's thumbnails are scheduled to be generated 
+        together (or it is generated right away if generation isn't asynchronous). """
+    
+    file_path = image_file.path
+    key = (file_path, size, reverse, image_format)
+    now = time.time()
+    
+    entry = _metadata.get(key)
+    if entry is None or now - entry['checked'] > RECHECK_INTERVAL:
+        try:
+            source_mtime = os.path.getmtime(file_path)
+        except OSError:
+            return None
+        
+        # Only look at the thumbnail itself if it's new to us or the source has changed
+        thumb_path = get_thumbnail_path(file_path, size, reverse, image_format)
+        ready = (entry is not None and entry['ready'] and entry['source_mtime'] == source_mtime 
+                 or is_up_to_date(file_path, thumb_path))
+        entry = {'source_mtime': source_mtime,
+                 'checked': now,
+                 'ready': ready}
+        _metadata[key] = entry
+        
+    if not entry['ready']:
+        if not ASYNC:
+            generate_thumbnail(file_path, size, reverse, image_format)
+            entry['ready'] = is_up_to_date(file_path, get_thumbnail_path(file_path, size, 
+                                                                         reverse, image_format))
+            if not entry['ready']:
+                return None
+        else:
+            schedule_derivatives(file_path, [size])
+            return None
+    
+    return get_thumbnail_url(image_file.url, size, reverse, image_format)
+
+def thumbnail_source(image_file, size, reverse=False, image_format=None):
+    """ Returns the URL to show for a thumbnail of an image field file, and whether it has to
+        be turned upside down, as a (url, rotate) pair. Until the thumbnail is ready that is
+        the original image, which is upright, so a reversed card has to be turned with CSS
+        rather than waiting for its thumbnail. """
+    
+    url = ready_thumbnail_url(image_file, size, reverse, image_format)
+    if url is None:
+        return image_file.url, reverse
+    return url, False
+
+def thumbnail_url(image_file, size, reverse=False, image_format=None):
+    """ Returns the URL to use for a thumbnail of an image field file, which is the URL of 
+        the original image until the thumbnail is ready. For reversed thumbnails, 
+        thumbnail_source also tells whether the image has to be turned upside down. """
+    
+    return thumbnail_source(image_file, size, reverse, image_format)[0]
+
+def thumbnail_srcset(image_file, size, reverse=False, image_format=None):
+    """ Returns the srcset attribute value listing the thumbnails of an image field file at
+        each pixel density which are ready, like 'a_85x150.jpg 1x, a_170x300.jpg 2x'. """
+    
+    candidates = []
+    for density in DENSITIES:
+        url = ready_thumbnail_url(image_file, scale_size(size, density), reverse, image_format)
+        if url is not None:
+            candidates.append('%s %dx' % (url, density))
+    return ', '.join(candidates)
@@ -1,15 +1,20 @@
 from django.conf.urls.defaults import patterns
+from django.views.generic.simple import direct_to_template
+from page_cache import cached_response
+
+# The static pages are the same for everyone, so they are cached whole
+cached_template = cached_response()(direct_to_template)
 
 # All of the static content pages, which render directly to a template.
-urlpatterns = patterns('django.views.generic.simple',
+urlpatterns = patterns('',
                        
-    (r'^$', 'direct_to_template', {'template': 'diyTarot/index.html'}),
-    (r'^faq/$', 'direct_to_template', {'template': 'diyTarot/faq.html'}),
-    (r'^tarot/$', 'direct_to_template', {'template': 'diyTarot/tarot.html'}),
-    (r'^reading/howitworks/$', 'direct_to_template', {'template': 'diyTarot/howitworks.html'}),
-    (r'^about/$', 'direct_to_template', {'template': 'diyTarot/about.html'}),
-    (r'^about/features/$', 'direct_to_template',  {'template': 'diyTarot/features.html'}),
-    (r'^about/technical/$', 'direct_to_template', {'template': 'diyTarot/technical.html'})
+    (r'^$', cached_template, {'template': 'diyTarot/index.html'}),
+    (r'^faq/$', cached_template, {'template': 'diyTarot/faq.html'}),
+    (r'^tarot/$', cached_template, {'template': 'diyTarot/tarot.html'}),
+    (r'^reading/howitworks/$', cached_template, {'template': 'diyTarot/howitworks.html'}),
+    (r'^about/$', cached_template, {'template': 'diyTarot/about.html'}),
+    (r'^about/features/$', cached_template,  {'template': 'diyTarot/features.html'}),
+    (r'^about/technical/$', cached_template, {'template': 'diyTarot/technical.html'})
 )
 
 # All of the dynamic content pages, which specify a view to process the information.
@@ -1,51 +1,69 @@
+from django.conf import settings
 from django.core.paginator import Paginator
-from django.db.models import Count
 from django.shortcuts import render_to_response, redirect
 from django.template import RequestContext
+from django.views.decorators.http import condition
 from django.db.models import Q
 from functions import *
-from models import Deck, Suit, Meaning, MinorArcana, MajorArcana
+from models import Deck, Suit, Meaning, MinorArcana, MajorArcana, CardSummary
 from models import Spread, CardPosition
+from drawing import get_card_keys, get_deck_ids, get_spread_ids
+from navigation import get_deck_navigation, get_related_cards
+from fragments import get_deck_list, get_suit_list, get_generation, get_data_version, get_count
+from keyset import KeysetPaginator
+from page_cache import cached_response
+from search import rank
+from summaries import attach_summaries, check_summaries, summary_lookups
 from random import choice
+import tarot_constants
 
+def data_etag(request, *args, **kwargs):
+    """ Returns the ETag of the pages which only change when the data is edited, which is
+        the data generation, so that browsers revisiting them get a 304 response. """
+    
+    return get_generation()
+
+def data_last_modified(request, *args, **kwargs):
+    """ Returns when the data was last edited, as the last modified time of those pages. """
+    
+    return get_data_version().modified
+
+def saved_reading_etag(request, *args, **kwargs):
+    """ Returns the ETag of a saved reading, which also depends on the preferred deck in
+        the session, or None for random readings, which are different every time. """
+    
+    if request.method == 'GET' and 'cards' in request.GET:
+        return '%s-%s' % (get_generation(), request.session.get('deck', '1'))
+    return None
+
+@cached_response(query_keys=('page',))
 def deck_list(request):
     """ This is a view to show a list of all available decks with a few details 
         about each one. We can't use a generic view because we need to cross-reference
         the suits associated with each deck. """
     
-    decks = Deck.objects.all()
-    
-    # Pull the suits for each deck and put them in a tuple with each deck
-    deck_list = []
-    for deck in decks:
-        
-        suits = Suit.objects.filter(deck=deck.id)
-        deck_list += [ (deck, suits) ]
+    active_options = request.GET.copy()
     
-    pages = Paginator(deck_list, 10, 3)
+    # Paginate the decks first, so only the suits of the decks being shown are loaded
+    pages = Paginator(Deck.objects.all(), 10, 3)
+    current_page = get_current_page(active_options, pages)
     
-    # Check if page is an int, if not deliver page 1
-    try:
-        page = int(request.GET.get('page', '1'))
-    except ValueError:
-        page = 1 
-        
-    # Check if page is in range, if not deliver last page
-    try:
-        result_list = pages.page(page)
-    except (EmptyPage, InvalidPage):
-        result_list = pages.page( pages.num_pages ) 
+    # Pull the suits for every deck on the page at once and put them in a tuple with each deck
+    decks = attach_suits(current_page.object_list)
+    current_page.object_list = [(deck, deck.get_suits()) for deck in decks]
         
-    context = {'result_list': result_list}
-
+    context = {'result_list': current_page,
+               'active_options': active_options}
+    
     return render_to_response('diyTarot/deck_list.html', 
                               context_instance=RequestContext(request, context))     
     
+@cached_response(query_keys=('page',), session_keys=('deck',))
 def spread_list(request):
     """ This is a view to display the list of spreads. Can't use a generic 
         view because want to cross-reference with the card positions to 
         give information like the number of cards in a spread. """
-
+    
     # Set up the structures used to add successive filters and handle the query string
     active_options = request.GET.copy()
     query_list = []
@@ -54,20 +72,28 @@ def spread_list(request):
     apply_spread_search_filter(active_options, query_list)
     apply_spread_size_filter(active_options, query_list)
     
-    # Annotate each spread with the number of positions associated with it, for sorting
-    # and also for filtering by size
-    spreads = Spread.objects.annotate(size=Count('cardposition')).filter(*query_list).order_by('size')
-
-    # Paginate the results
-    pages = Paginator(spreads, 10, 3)
-    current_page = get_current_page(active_options, pages)
-
-    # Temporary, limited tag list before tags are added to the model
-    tags = ['daily', 'traditional', 'love', 'work', 'advice', 'choice']        
-    tag_results = {}
-    for tag in tags:
-      tag_query = [Q(title__icontains=tag) | Q(description__icontains=tag)]
-      tag_results[tag] = Spread.objects.filter(*tag_query).count()
+    # Each spread stores its number of positions, which it is sorted and filtered by
+    spreads = Spread.objects.filter(*query_list)
+    count = lambda: get_count('spreads', spreads, query_list=query_list)
+    
+    if len(active_options.get('search', '')) > 0:
+        # Searches are sorted by relevance within each size, which is computed in the query,
+        # so they can't be paginated by keyset
+        spreads = rank(spreads, 'spreads', active_options['search'])
+        pages = CountedPaginator(spreads.order_by('size', '-relevance', 'pk'), 10, 3, count=count)
+        current_page = get_current_page(active_options, pages)
+        list_template = 'diyTarot/list.html'
+    else:
+        # Paginate the results by keyset on the size and the id, so deep pages don't have to
+        # skip over the earlier ones, with the count only made once for each search and size
+        pages = KeysetPaginator(spreads, 10, ['size', 'pk'], count=count)
+        current_page = get_keyset_page(active_options, pages)
+        list_template = 'diyTarot/keyset_list.html'
+    
+    # Count the spreads with each tag, for the facets in the navigation menu
+    tags = getattr(settings, 'DIYTAROT_SPREAD_TAGS', tarot_constants.SPREAD_TAGS)
+    tag_counts = count_spread_tags([tag for tag, name in tags])
+    tag_results = [{'tag': tag, 'name': name, 'count': tag_counts[tag]} for tag, name in tags]
     
     # Check if there is a default deck stored in the current session
     # This determines which deck to point you to in the links on the spread list, 
@@ -79,6 +105,7 @@ def spread_list(request):
         deck = 1
             
     context = {'result_list': current_page,
+               'list_template': list_template,
                'deck': deck,
                'active_options': active_options,
                'tag_results': tag_results}
@@ -107,69 +134,69 @@ def card_list(request):
     apply_suit_filter(active_options, filter_args)
     apply_rank_filter(active_options, filter_args)
         
-    apply_sorting_order(active_options, order_args)
+    apply_sorting_order(active_options, order_args, relevance=True)
+    
+    # The cards are listed from their summaries, which have everything the list shows,
+    # including the suit and rank of the minor arcana
+    check_summaries()
+    filter_args = summary_lookups(filter_args)
+    order_args = summary_lookups(order_args)
+    cards = CardSummary.objects.filter(*query_list).filter(**filter_args)
     
-    # To search the meanings as well as the Cards, need to get the list of tarot indexes which
-    # link to meanings that match the search
-    if 'search' in active_options:
-        
-        meaning_query_list = []
-        apply_keyword_search_filter(active_options, meaning_query_list)
-        
-        # Get all tarot_indexes which have keyword strings containing the search term.
-        meanings = Meaning.objects.filter(*meaning_query_list).values('tarot_index', 'meaning_set').order_by('meaning_set')
-        
-        # Get the id of each card (or set of cards) which matches each tarot_index / meaning_set pair
-        # This assures that only the cards that use the matching meaning set get pulled, instead of all cards
-        # with a certain tarot index.
-        ids = []
-        for meaning in meanings:
-          ids += Card.objects.filter(tarot_index=meaning['tarot_index'], 
-                                    deck__meaning_set=meaning['meaning_set']).values_list('id')                                  
-        
-        # Reformat list so it can be read directly by the id__in parameter  
-        id_list = [card_id[0] for card_id in ids]
-
-        # Pull only the cards that have the same tarot index AND whose deck has the same meaning_set
-        query_list[0] |= Q(id__in=id_list)
-
-    # Some of the options only apply to the MinorArcana schema.
-    # The rank and suit filters will set the card option automatically.
-    if ('cards' in active_options and
-        active_options['cards'] =='minors'):
-            cards = MinorArcana.objects.filter(*query_list).filter(**filter_args).order_by(*order_args)
-    else:
-        cards = Card.objects.filter(*query_list).filter(**filter_args).order_by(*order_args)
-
     # Used by the shared sidebar navigation menu
     base_url = "/diytarot/cards/"
     
-    # Populate the deck and suit lists used in navigation
-    deck_list = Deck.objects.values('name', 'id')
-    suit_list = Suit.objects.filter(deck=deck_list[0]['id']).values('suit', 'name')
+    # Populate the deck and suit lists used in navigation, which are cached until edited.
+    # The suit names come from the deck in the session, or else the first deck by id.
+    deck_list = get_deck_list()
+    suit_list = []
+    deck_ids = [deck['id'] for deck in deck_list]
+    if len(deck_ids) > 0:
+        deck_id = request.session.get('deck')
+        if deck_id not in deck_ids:
+            deck_id = min(deck_ids)
+        suit_list = get_suit_list(deck_id)
+    
+    # The count is cached for each set of filters
+    count = lambda: get_count('card_summaries', cards, filter_args, query_list)
+    
+    if active_options['order_by'] == 'relevance':
+        # The relevance is computed in the query, so it can't be paginated by keyset
+        ranked_cards = rank(cards, 'cards', active_options['search'])
+        pages = CountedPaginator(ranked_cards.order_by(*order_args + ['pk']), 10, 3, count=count)
+        current_page = get_current_page(active_options, pages)
+        list_template = 'diyTarot/list.html'
+    else:
+        # Paginate the queryset by keyset in the sorting order and fetch the page for the 
+        # cursor in the URL, with validation
+        pages = KeysetPaginator(cards, 10, order_args, count=count)
+        current_page = get_keyset_page(active_options, pages)
+        list_template = 'diyTarot/keyset_list.html'
     
-    # Paginate the queryset and fetch the current page from the URL, with validation
-    pages = Paginator(cards, 10, 3)
-    current_page = get_current_page(active_options, pages)
+    # Load the meanings for every card on the page at once
+    current_page.object_list = prefetch_meanings(current_page.object_list)
     
     context = {'result_list': current_page,
+               'list_template': list_template,
                'base_url': base_url,
                'active_options': active_options,
                'deck_list': deck_list,
                'suit_list': suit_list}
-
+    
     return render_to_response('diyTarot/card_list.html',
                               context_instance=RequestContext(request, context))   
 
+@condition(etag_func=data_etag, last_modified_func=data_last_modified)
 def deck_detail(request, deck_id):
     """ This is a view to show all the cards associated with a particular 
         tarot deck. """
         
-    # Get the list of cards, return the deck listing page if deck doesn't exist.
+    # Get the list of cards, redirect to the deck listing page if deck doesn't exist, so
+    # the listing is only cached at its own URL.
     try:
         deck = Deck.objects.get(pk=deck_id)
     except Deck.DoesNotExist:
-        return deck_list(request)
+        return redirect('/diytarot/decks/')
     
     # Set up the structures used to add successive filters and handle the query string
     active_options = request.GET.copy()
@@ -182,30 +209,33 @@ def deck_detail(request, deck_id):
     apply_rank_filter(active_options, filter_args)
     apply_sorting_order(active_options, order_args)
     
-    # Some of the options only apply to the MinorArcana schema.
-    # The rank and suit filters will set the card option automatically.
-    if ('cards' in active_options and
-        active_options['cards'] =='minors'):
-            cards = MinorArcana.objects.filter(**filter_args).order_by(*order_args)
-    else:
-        cards = Card.objects.filter(**filter_args).order_by(*order_args)
-
+    # The cards are listed from their summaries, which have everything the list shows,
+    # including the suit and rank of the minor arcana
+    check_summaries()
+    filter_args = summary_lookups(filter_args)
+    cards = CardSummary.objects.filter(**filter_args).order_by(*summary_lookups(order_args))
+    
     # The base url, since there is a different one for deck view and all cards view
     base_url = "/diytarot/decks/%s/" % deck_id
     
-    # Populate the suit list used in navigation
-    suit_list = Suit.objects.filter(deck=deck_id).values('suit', 'name')
+    # Populate the suit list used in navigation, which also gives the deck its suit names
+    suit_list = deck.get_suits()
     
-    # Paginate the queryset and fetch the current page from the URL, with validation
-    pages = Paginator(cards, 10, 3)
+    # Paginate the queryset and fetch the current page from the URL, with validation. The
+    # count is cached for each set of filters.
+    pages = CountedPaginator(cards, 10, 3, 
+                             count=lambda: get_count('card_summaries', cards, filter_args))
     current_page = get_current_page(active_options, pages)
     
+    # Load the meanings for every card on the page at once
+    current_page.object_list = prefetch_meanings(current_page.object_list)
+    
     context = {'deck': deck,
                'result_list': current_page,
                'base_url': base_url,
                'suit_list': suit_list,
                'active_options': active_options}
-
+    
     return render_to_response('diyTarot/deck_detail.html',
                               context_instance=RequestContext(request, context))
 
@@ -213,77 +243,64 @@ def random_card(request):
     """ This is a view which simply chooses a card at random and gives you the 
         detail view for it. """
     
-    # Get a list of all ids, choose one randomly, and get a handle to that Card object.
-    card_ids = Card.objects.values('id')
-    random_id = choice( card_ids )['id']
-    card = Card.objects.get(pk=random_id)
+    # Choose one of the cached card keys at random, which is enough to show it without 
+    # having to load the card itself.
+    card_id, tarot_index, deck_id = choice(get_card_keys())
     
     # Display the card detail view for the random card. Don't redirect, because this way you
     # can refresh the page and get another random card.
-    return card_detail(request, card.tarot_index, card.deck.id)
+    return render_card_detail(request, tarot_index, deck_id)
 
+@condition(etag_func=data_etag, last_modified_func=data_last_modified)
 def card_detail(request, tarot_index, deck_id):
     """ This is a view to show all information about a specific card in a 
         specific deck. """ 
     
+    return render_card_detail(request, tarot_index, deck_id)
+
+def render_card_detail(request, tarot_index, deck_id):
+    """ Renders the card detail page, without the conditional GET handling (since the
+        random card view also uses it). """
+    
     # If the card isn't in this deck, load the list of all cards in the deck
     try:
-        card = Card.objects.get(tarot_index=tarot_index, deck=deck_id)
+        card = Card.objects.select_related('deck').get(tarot_index=tarot_index, deck=deck_id)
     except Deck.DoesNotExist:
         return tarot_card_detail(request, tarot_index)
     except Card.DoesNotExist:
         return deck_detail(request, deck_id)
     
+    # The card's display name and suit come from its summary
+    card = attach_summaries([card])[0]
+    
     try:
-        meaning = Meaning.objects.get(meaning_set=card.deck.meaning_set, tarot_index=tarot_index)
+        meaning = Meaning.objects.get(meaning_set=card.deck.meaning_set_id, tarot_index=tarot_index)
     except Meaning.DoesNotExist:
         meaning = Meaning()
     
     # For next and previous page links
     indices = get_nearest_indices(tarot_index, deck_id)
     
-    # For the side navigation
-    majors_list = MajorArcana.objects.filter(deck=deck_id).order_by('tarot_index')
-    first_major = ''
-    if majors_list.count() > 0:
-        first_major = majors_list[0].tarot_index
-    
-    minors_list = MinorArcana.objects.filter(deck=deck_id).order_by('suit', 'tarot_index')
-    first_minor = ''
-    if minors_list.count() > 0:
-        first_minor = minors_list[0].tarot_index
-    
-    # Gives us the list of suits which have no cards in them, for completion.
-    empty_suit_list = []
-    suits = Suit.objects.filter(deck=deck_id)
-    for suit in suits:
-        cards = MinorArcana.objects.filter(suit=suit.id)
-        if cards.count() == 0:
-            empty_suit_list += [suit]
-            
-    related_cards = Card.objects.filter(tarot_index=tarot_index).values('deck', 'deck__name')
-
-    context = {'card': card,
-               'meaning': meaning,
-               'majors_list': majors_list,
-               'minors_list': minors_list,
-               'empty_suit_list': empty_suit_list,
-               'related_cards': related_cards,
-               'first_major': first_major,
-               'first_minor': first_minor,
-               'next_card_index': indices['next_index'],
-               'previous_card_index': indices['previous_index'], }
+    # For the side navigation, shared with the tarot card detail view and cached
+    context = get_deck_navigation(deck_id).copy()
+    context['related_cards'] = get_related_cards(tarot_index)
+    
+    context.update({'card': card,
+                    'meaning': meaning,
+                    'next_card_index': indices['next_index'],
+                    'previous_card_index': indices['previous_index'], })
     
     return render_to_response('diyTarot/card_detail.html',
                               context_instance=RequestContext(request, context))                              
 
+@condition(etag_func=data_etag, last_modified_func=data_last_modified)
 def tarot_card_detail(request, tarot_index):
     """ This is a view to show all of the tarot cards of a particular index, 
         across all decks in the system. So, if you send it 1 (The Magician), it
         will display all Magician cards. """
      
     # Retrieve the card with the matching tarot_index from the right deck
-    cards = Card.objects.filter(tarot_index=tarot_index).order_by('deck')
+    cards = Card.objects.filter(tarot_index=tarot_index).order_by('deck').select_related('deck')
     meanings = Meaning.objects.filter(tarot_index=tarot_index)
     if meanings.count() > 0:
         meaning = meanings[0]
@@ -291,7 +308,9 @@ def tarot_card_detail(request, tarot_index):
         meaning = {'keywords': 'None provided.',
                    'reversed_keywords': 'None provided.'}
     
-    if len(cards) == 0:
+    # Count the cards once per edit of the data, rather than loading all of them
+    card_count = get_count('cards', cards, {'tarot_index': tarot_index})
+    if card_count == 0:
         # If there is no matching tarot_index in any of the decks, then load
         # the view with all the cards
         return card_list(request)
@@ -300,8 +319,9 @@ def tarot_card_detail(request, tarot_index):
         active_options = request.GET.copy()
         
         # Paginate the queryset and fetch the current page from the URL, with validation
-        pages = Paginator(cards, 10, 3)
+        pages = CountedPaginator(cards, 10, 3, count=lambda: card_count)
         current_page = get_current_page(active_options, pages)
+        current_page.object_list = attach_summaries(prefetch_meanings(current_page.object_list))
         
         # The base url, since there is a different one for deck view and all cards view
         base_url = "/diytarot/cards/%s/" % tarot_index
@@ -309,133 +329,45 @@ def tarot_card_detail(request, tarot_index):
         # For the next and previous links
         indices = get_nearest_indices(tarot_index)
         
-        # For the side navigation
+        # For the side navigation, shared with the card detail view and cached
         default_deck_id = 1
-        majors_list = MajorArcana.objects.filter(deck=default_deck_id).order_by('tarot_index')
-        first_major = ''
-        if majors_list.count() > 0:
-            first_major = majors_list[0].tarot_index
-        
-        minors_list = MinorArcana.objects.filter(deck=default_deck_id).order_by('suit', 'tarot_index')
-        first_minor = ''
-        if minors_list.count() > 0:
-            first_minor = minors_list[0].tarot_index
+        context = get_deck_navigation(default_deck_id).copy()
+        context['related_cards'] = get_related_cards(tarot_index)
         
-        # Gives us the list of suits which have no cards in them, for completion.
-        empty_suit_list = []
-        suits = Suit.objects.filter(deck=default_deck_id)
-        for suit in suits:
-            cards = MinorArcana.objects.filter(suit=suit.id)
-            if cards.count() == 0:
-                empty_suit_list += [suit]
-                
-        related_cards = Card.objects.filter(tarot_index=tarot_index).values('deck', 'deck__name')
-        
-        context = {'result_list': current_page,
-                   'active_options': active_options,
-                   'base_url': base_url,
-                   'meaning': meaning,
-                   'previous_card_index': indices['previous_index'],
-                   'next_card_index': indices['next_index'],
-                   'majors_list': majors_list,
-                   'minors_list': minors_list,
-                   'empty_suit_list': empty_suit_list,
-                   'related_cards': related_cards,
-                   'first_major': first_major,
-                   'first_minor': first_minor}
+        context.update({'result_list': current_page,
+                        'active_options': active_options,
+                        'base_url': base_url,
+                        'meaning': meaning,
+                        'previous_card_index': indices['previous_index'],
+                        'next_card_index': indices['next_index']})
         
         return render_to_response('diyTarot/tarot_card_detail.html',
                                   context_instance=RequestContext(request, context))
 
+@condition(etag_func=saved_reading_etag)
 def reading(request, spread_id, deck_id):
     """ This is a view for displaying card readings on a given spread and deck. 
         By default the cards drawn are random, but if a string of saved cards called
         'cards' is passed in via query string it will try to load those cards, returning
         an error if the string is invalid."""
     
-    try:
-        spread = Spread.objects.get(pk=spread_id)
-    except Spread.DoesNotExist:
-        return spread_list(request)
-    
-    try:
-        deck = Deck.objects.get(pk=deck_id)
-        deck_name = deck.name
-    except Deck.DoesNotExist:
-        return deck_list(request)
- 
-    # Get all the positions in the spread and pull out the maximums for layout
-    positions = CardPosition.objects.filter(spread=spread.id).order_by('index')
-    num_positions = positions.count()
-    max_x_coordinate = positions.aggregate(Max('x_coordinate'))['x_coordinate__max'] 
-    max_y_coordinate = positions.aggregate(Max('y_coordinate'))['y_coordinate__max']  
-    
-    # Get all of the layout information for the template to use later
-    layout = calculate_layout(positions, max_x_coordinate, max_y_coordinate)
+    # Check if there is a default deck stored in the current session
+    session_deck_id = request.session.get('deck', '1')
     
     # If we have a query string, try to display the saved reading 
-    if request.method == 'GET' and request.GET.get('cards') is not None:
-        
-        # Get the query string
+    reading_string = None
+    if request.method == 'GET':
         reading_string = request.GET.get('cards')
-        try:
-            # Try to parse out the saved reading encoding, and catch the exceptions.
-            reading = load_saved_reading(reading_string, num_positions, deck.id)
-        
-        except (IndexError, TypeError, ValueError, Card.DoesNotExist):
-            # Exceptions with custom messages are raised in the helper function,
-            # then they are caught and their text is passed to the template for display
-            return render_to_response('diyTarot/reading.html',
-                                      {'error': 'Problem loading saved reading.',
-                                       'spread': spread,
-                                       'deck': deck })
-    else : 
-        # Otherwise, create a random reading that is different every time the page is loaded.
-        # Select all cards, filter by the chosen deck, put in random order and then 
-        # slice off the number of cards that appear in the spread
-        random_cards = Card.objects.all().filter(deck=deck_id).order_by('?')[:num_positions]
-        reversal_odds = [False, False, False, False, False, False, False, True, True, True]
-        
-        reading = []
-        for card in random_cards:
-            reading += [{'card': card,
-                     'reversed': choice(reversal_odds)}]
-            
-    # Put together the card object, position object, layout coordinates for display in the template
-    # and generate a save string for the thrown cards.
-    card_list = []
-    saved_card_list = []
-    for (thrown_card, position, coordinates) in zip(reading, positions, layout['coordinates']):
-        
-        card_list += [(position, thrown_card, coordinates)]
-        saved_card_list  += ["%d.%d" % (thrown_card['card'].tarot_index, 
-                                        int(thrown_card['reversed']))]
     
-    # Build the string to re-create this reading.  
-    save_string = (',').join(saved_card_list)
-    
-    # Lists for use in the navigation menu
-    deck_list = Deck.objects.values('id', 'name').order_by('name')
-    spread_list = Spread.objects.values('id', 'title').order_by('title')
+    try:
+        context = assemble_reading(spread_id, deck_id, session_deck_id, reading_string)
+    except Spread.DoesNotExist:
+        return redirect('/diytarot/spreads/')
+    except Deck.DoesNotExist:
+        return redirect('/diytarot/decks/')
     
-    deck_options = {}
-    # Check if there is a default deck stored in the current session
-    if 'deck' in request.session:
-        deck_options['session_deck_id'] = request.session['deck']
-    else:
-        deck_options['session_deck_id'] = '1'
-        
-    deck_options['session_deck_name'] = Deck.objects.get(id=deck_options['session_deck_id']).name
-    deck_options['display_deck_id'] = deck_id
-    deck_options['display_deck_name'] = deck_name
-    
-    context = {'spread': spread,
-               'card_list': card_list,
-               'save_string': save_string,
-               'layout': layout['sizes'],
-               'deck_options': deck_options,
-               'deck_list': deck_list,
-               'spread_list': spread_list,} 
+    if 'error' in context:
+        return render_to_response('diyTarot/reading.html', context)
         
     return render_to_response('diyTarot/reading.html',
                               context_instance=RequestContext(request, context))
@@ -456,7 +388,7 @@ def update_reading_settings(request, spread_id):
     deck = Deck.objects.filter(id=deck_id)
     if deck.count() > 0:
         request.session['deck'] = deck_id
-
+    
     # Then just invoke the reading view
     target = "/diytarot/reading/%s/%s/" % (spread_id, deck_id)
     return redirect(target)
@@ -465,11 +397,8 @@ def random_reading(request):
     """ This is a view to get you directly to a tarot reading without browsing through
         the various spreads. Then, you can change the reading settings via the sidebar. """
         
-    deck_id_list = Deck.objects.values_list('id')
-    deck_id = int(choice(deck_id_list)[0])
-    
-    spread_id_list = Spread.objects.values_list('id')
-    spread_id = int(choice(spread_id_list)[0])
+    deck_id = choice(get_deck_ids())
+    spread_id = choice(get_spread_ids())
     
     # Then just invoke the reading view
     target = "/diytarot/reading/%s/%s/" % (spread_id, deck_id)